@@ -6,9 +6,21 @@ import os
 import uuid
 import time
 import json
+import base64
+import io
 from datetime import datetime
 from config import Config
-from models import StableDiffusionModel, StableDiffusionModelOpenVINO
+from models import (
+    StableDiffusionModel, StableDiffusionModelOpenVINO, FakeStableDiffusionModel,
+    PartitionedCPUModel, partition_count, partition_cpus, cpu_topology, pin_current_thread,
+    add_breaker_listener, breaker_status
+)
+from services import (
+    ModelManager, ModelRegistry, OutputStore, ThumbnailGenerator,
+    ImagePostProcessor, OutputTarget, DeviceSlots, RequestTraceRecorder, Tracer, JobTracker, request_key, metrics,
+    JobQueue, create_job_queue, LoadShedder
+)
+from services.tracing import activate, add_span, span
 import threading
 
 # Initialize Flask app
@@ -20,26 +32,282 @@ CORS(app)  # Enable CORS for frontend requests
 # Initialize configuration
 Config.validate()
 
-# Initialize Stable Diffusion model (singleton)
+def normalize_device(device):
+    """Validate a device name for the active backend, returning it normalized or None"""
+    if Config.USE_OPENVINO:
+        valid_devices = ['CPU', 'GPU'] + [f'GPU.{i}' for i in range(10)]
+        if device.upper() not in valid_devices and not device.upper().startswith('GPU'):
+            return None
+        return device.upper()
+    if device.lower() not in ['cpu', 'cuda', 'mps']:
+        return None
+    return device.lower()
+
+# Initialize Stable Diffusion model manager (singleton)
 # Use OpenVINO model if enabled, otherwise use PyTorch model
-if Config.USE_OPENVINO:
+if Config.FAKE_MODEL:
+    print(f"Using fake fixed-latency backend ({Config.FAKE_STEP_SECONDS}s per step)")
+    model_factory = FakeStableDiffusionModel
+elif Config.USE_OPENVINO:
     print("Using OpenVINO backend for acceleration")
-    sd_model = StableDiffusionModelOpenVINO()
+    model_factory = StableDiffusionModelOpenVINO
 else:
     print("Using PyTorch backend")
-    sd_model = StableDiffusionModel()
+    model_factory = StableDiffusionModel
+
+standby_device = normalize_device(Config.STANDBY_DEVICE) if Config.STANDBY_DEVICE else None
+if Config.STANDBY_DEVICE and not standby_device:
+    print(f"Warning: Ignoring invalid STANDBY_DEVICE {Config.STANDBY_DEVICE}")
+
+# Inference threads per wrapper on CPU, set per gunicorn worker by init_worker()
+worker_cpu_threads = None
+
+def build_model(device, model_id):
+    """Create a wrapper for ``model_id`` on ``device``
+
+    On the CPU with CPU_PARTITIONS set, this is one wrapper per core
+    partition behind a PartitionedCPUModel.
+    """
+    if device.lower() == 'cpu' and Config.CPU_PARTITIONS != '1':
+        topology = cpu_topology()
+        count = partition_count(Config.CPU_PARTITIONS, topology)
+        if count > 1:
+            return PartitionedCPUModel(
+                lambda: model_factory(device, model_id=model_id),
+                partition_cpus(count, topology),
+                device=device,
+                model_id=model_id
+            )
+    model = model_factory(device, model_id=model_id)
+    if worker_cpu_threads and hasattr(model, 'cpu_threads'):
+        model.cpu_threads = worker_cpu_threads
+    return model
+
+def create_model_manager(model_id, device=None):
+    """Build the device-swapping manager for one model id, starting on ``device``"""
+    return ModelManager(
+        lambda device: build_model(device, model_id),
+        device=device,
+        standby_device=standby_device
+    )
+
+# Registry of every served model id; MODEL_ID is the default
+model_registry = ModelRegistry(
+    create_model_manager,
+    [Config.MODEL_ID] + Config.MODEL_IDS,
+    default_model_id=Config.MODEL_ID,
+    memory_budget_mb=Config.MODEL_MEMORY_BUDGET_MB,
+    footprint_estimate_mb=Config.MODEL_FOOTPRINT_ESTIMATE_MB,
+    device=Config.DEVICE
+)
+
+def on_breaker_transition(device, old_state, new_state):
+    """Return models to an accelerator once probes close its breaker"""
+    if new_state != 'closed':
+        return
+    for model_id in model_registry.model_ids:
+        try:
+            model_registry.get(model_id).recover(device)
+        except Exception as e:
+            print(f"[BREAKER] Could not switch {model_id} back to {device}: {e}")
+
+add_breaker_listener(on_breaker_transition)
 
 # Ensure output directory exists
 os.makedirs(Config.OUTPUT_DIR, exist_ok=True)
 
-# Progress tracking
-progress_data = {
-    'current_step': 0,
-    'total_steps': 0,
-    'is_generating': False,
-    'session_id': None,
-    'should_stop': False
-}
+# Sharded image store with SQLite metadata index and retention
+output_store = OutputStore(
+    Config.OUTPUT_DIR,
+    max_age_days=Config.OUTPUT_MAX_AGE_DAYS,
+    max_count=Config.OUTPUT_MAX_COUNT,
+    max_bytes=Config.OUTPUT_MAX_MB * 1024 * 1024,
+    retention_interval=Config.OUTPUT_RETENTION_INTERVAL
+)
+output_store.start_retention()
+
+# Gallery thumbnails are built off the request thread
+thumbnail_generator = ThumbnailGenerator(
+    output_store,
+    size=Config.THUMBNAIL_SIZE,
+    quality=Config.THUMBNAIL_QUALITY,
+    max_workers=Config.THUMBNAIL_WORKERS
+)
+
+# Response encoding and asynchronous persistence of generated images
+postprocessor = ImagePostProcessor(
+    output_store,
+    thumbnail_generator,
+    response_target=OutputTarget(Config.RESPONSE_IMAGE_FORMAT, Config.RESPONSE_IMAGE_LEVEL),
+    disk_target=OutputTarget(Config.OUTPUT_IMAGE_FORMAT, Config.OUTPUT_IMAGE_LEVEL),
+    fsync=Config.OUTPUT_FSYNC,
+    max_workers=Config.POSTPROCESS_WORKERS,
+    max_pending=Config.POSTPROCESS_MAX_PENDING
+)
+
+# Limits how many gunicorn workers run on one accelerator at a time
+device_slots = DeviceSlots(Config.DEVICE_LOCK_DIR, gpu_slots=Config.GPU_WORKER_SLOTS)
+
+def preload_weights():
+    """Read the default model's weights in the gunicorn master before forking
+
+    Workers inherit the pages copy-on-write (OpenVINO IR is memory-mapped), so
+    N workers do not hold N private copies of the weights.
+    """
+    load_start = time.time()
+    model_registry.load_weights()
+    print(f"[PREFORK] Model weights read in {time.time() - load_start:.2f} seconds")
+
+def init_worker(worker_count=1, worker_index=None):
+    """Reset per-process state in a freshly forked gunicorn worker
+
+    Threads do not survive fork(), so the index connection is reopened here
+    and the inherited pipeline is compiled on a background thread (a long
+    compile in the fork hook would trip the gunicorn worker timeout). Requests
+    that arrive first wait for that load through the registry. With
+    CPU_PARTITIONS the worker is pinned to its ``worker_index``-th share of
+    the cores and partitions only those.
+    """
+    global worker_cpu_threads
+    output_store.reopen_after_fork()
+
+    if Config.CPU_PARTITIONS != '1' and worker_count > 1 and worker_index is not None:
+        share = partition_cpus(worker_count)[worker_index % worker_count]
+        cores = share.cores[:Config.WORKER_CPU_THREADS] if Config.WORKER_CPU_THREADS else share.cores
+        # Still the only thread of the process: every thread started later inherits the mask
+        pin_current_thread(sorted(cpu for core in cores for cpu in core))
+        model = model_registry.default.model
+        if isinstance(model, PartitionedCPUModel):
+            topology = cpu_topology()
+            model.repartition(partition_cpus(partition_count(Config.CPU_PARTITIONS, topology), topology))
+        print(f"[PREFORK] Worker {os.getpid()} partitioning {len(cores)} of the cores")
+
+    # Split the cores between workers so they do not oversubscribe the host
+    worker_cpu_threads = Config.WORKER_CPU_THREADS
+    if not worker_cpu_threads and worker_count > 1:
+        worker_cpu_threads = max(1, (os.cpu_count() or 1) // worker_count)
+    if worker_cpu_threads:
+        if Config.USE_OPENVINO:
+            model_registry.default.model.cpu_threads = worker_cpu_threads
+        else:
+            import torch
+            torch.set_num_threads(worker_cpu_threads)
+        print(f"[PREFORK] Worker {os.getpid()} using {worker_cpu_threads} CPU threads")
+
+    if Config.PRELOAD_MODEL:
+        threading.Thread(
+            target=model_registry.load_model,
+            name='worker-model-load',
+            daemon=True
+        ).start()
+
+# Optional JSONL record of generation requests for load-test replay
+request_trace = RequestTraceRecorder(Config.REQUEST_TRACE_FILE) if Config.REQUEST_TRACE_FILE else None
+
+def record_request_trace(received_at, parameters, status, timings=None, error=None):
+    """Append one request to REQUEST_TRACE_FILE if tracing is enabled"""
+    if request_trace is None:
+        return
+    request_trace.record({
+        'ts': received_at,
+        'request': parameters,
+        'status': status,
+        'latency': round(time.time() - received_at, 4),
+        'timings': timings,
+        'error': error
+    })
+
+# Sampled per-job timelines in Chrome trace-event format
+tracer = Tracer(
+    sample_rate=Config.TRACE_SAMPLE_RATE,
+    max_traces=Config.TRACE_MAX_TRACES,
+    retention_seconds=Config.TRACE_RETENTION_SECONDS,
+    trace_dir=Config.TRACE_DIR or None
+)
+
+# Generation jobs and their progress; identical in-flight requests share one job
+job_tracker = JobTracker(
+    retention_seconds=Config.JOB_RETENTION_SECONDS,
+    event_buffer=Config.PROGRESS_REPLAY_EVENTS
+)
+
+# Shared job queue in distributed mode (QUEUE_BACKEND): this node only
+# enqueues, and inference workers (worker.py) run the jobs
+job_queue = create_job_queue(
+    Config.QUEUE_BACKEND,
+    Config.QUEUE_URL,
+    retention_seconds=Config.QUEUE_RETENTION_SECONDS,
+    worker_timeout=Config.QUEUE_WORKER_TIMEOUT,
+    poll_interval=Config.QUEUE_POLL_SECONDS
+)
+if job_queue is not None:
+    print(f"[QUEUE] Distributed mode: jobs go to the {job_queue.backend} queue")
+
+# Quality ladder for requests that allow degradation (None = off)
+load_shedder = None
+if Config.LOAD_SHED:
+    load_shedder = LoadShedder(
+        Config.LOAD_SHED_LEVELS,
+        reject_at=Config.LOAD_SHED_REJECT_AT,
+        signal=Config.LOAD_SHED_SIGNAL,
+        capacity=Config.LOAD_SHED_CAPACITY,
+        job_seconds=Config.LOAD_SHED_JOB_SECONDS,
+        deep_cache_branch=Config.DEEP_CACHE_BRANCH
+    )
+
+def shed_load(parameters, allow_degrade):
+    """Apply the load shedding ladder to ``parameters``
+
+    Returns ``(degraded, rejection)``: what was changed (None when nothing
+    was) and a 429 response once the pressure is past LOAD_SHED_REJECT_AT.
+    """
+    job_seconds = None
+    if job_queue is not None:
+        # Workers report the average service time of their recent jobs, so
+        # the estimate follows async requests this node never sees finish
+        depth = sum(job_queue.depth().values())
+        workers = job_queue.workers()
+        capacity = sum(worker.get('concurrency') or 1 for worker in workers)
+        reported = [worker['service_seconds'] for worker in workers if worker.get('service_seconds')]
+        if reported:
+            job_seconds = sum(reported) / len(reported)
+    else:
+        depth = job_tracker.status()['active']
+        capacity = None
+    decision = load_shedder.decide(depth, capacity, job_seconds)
+    pressure = {key: decision[key] for key in ('signal', 'depth', 'estimated_wait')}
+    if decision['reject']:
+        metrics.inc('generate.shed_rejected')
+        print(f"[LOAD_SHED] Rejecting request: {depth} job(s) ahead, ~{decision['estimated_wait']}s wait")
+        response = jsonify(dict(
+            pressure,
+            success=False,
+            error='Server is overloaded, retry later',
+            retry_after=decision['retry_after']
+        ))
+        response.headers['Retry-After'] = str(decision['retry_after'])
+        return None, (response, 429)
+    if decision['level'] is None or not allow_degrade:
+        return None, None
+    changes = load_shedder.apply(parameters, decision['level'], model_registry.model_ids)
+    if not changes:
+        return None, None
+    metrics.inc('generate.degraded')
+    metrics.inc(f"generate.degraded.level{decision['level']}")
+    print(f"[LOAD_SHED] Level {decision['level']}: {', '.join(changes)}")
+    return dict(pressure, level=decision['level'], changes=changes), None
+
+def settle_degraded(degraded, result):
+    """``degraded`` with the changes the backend could not apply marked as not applied"""
+    unsupported = result.get('unsupported') or {}
+    if not degraded or not unsupported:
+        return degraded
+    changes = {
+        field: dict(change, applied=change['requested'], unsupported=unsupported[field])
+        if field in unsupported else change
+        for field, change in degraded['changes'].items()
+    }
+    return dict(degraded, changes=changes)
 
 @app.route('/')
 def home():
@@ -60,69 +328,185 @@ def api_info():
 
 @app.route('/api/progress/<session_id>')
 def stream_progress(session_id):
-    """Stream generation progress via Server-Sent Events"""
-    print(f"[SSE] Progress stream connection requested for session: {session_id}")
+    """Stream generation progress via Server-Sent Events
+    
+    Progress and completion events carry the job's monotonic event ids. A
+    reconnecting EventSource sends the last one as Last-Event-ID (or
+    ``?last_event_id=``) and the stream replays what it missed from the job's
+    buffer. Comments are sent as heartbeats while nothing happens.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    print(f"[SSE] Progress stream connection requested for session: {session_id}"
+          + (f" (resuming after event {last_event_id})" if last_event_id is not None else ""))
     
     def generate():
-        print(f"[SSE] Starting SSE generator for session: {session_id}")
-        # Send initial connection message
-        yield f"data: {json.dumps({'type': 'connected', 'session_id': session_id})}\n\n"
+        # Reconnect delay for the browser
+        yield f"retry: {Config.SSE_RETRY_MS}\n\n"
+        if last_event_id is None:
+            yield f"data: {json.dumps({'type': 'connected', 'session_id': session_id})}\n\n"
         
-        # Stream progress updates
-        last_step = -1
-        while progress_data['is_generating'] or progress_data['current_step'] > 0:
-            if progress_data['session_id'] == session_id:
-                current_step = progress_data['current_step']
-                total_steps = progress_data['total_steps']
-                
-                # Only send update if step changed
-                if current_step != last_step:
-                    last_step = current_step
-                    percentage = int((current_step / total_steps * 100)) if total_steps > 0 else 0
-                    
-                    data = {
-                        'type': 'progress',
-                        'current_step': current_step,
-                        'total_steps': total_steps,
-                        'percentage': percentage
-                    }
-                    print(f"[SSE] Sending progress: {current_step}/{total_steps} ({percentage}%)")
-                    yield f"data: {json.dumps(data)}\n\n"
-                
-                # Check if completed
-                if not progress_data['is_generating'] and current_step >= total_steps:
-                    print(f"[SSE] Generation complete, sending complete message")
-                    yield f"data: {json.dumps({'type': 'complete'})}\n\n"
+        # The frontend connects before it posts the request, so wait for the job
+        job = None
+        wait_until = time.time() + Config.PROGRESS_WAIT_SECONDS
+        next_heartbeat = time.time() + Config.SSE_HEARTBEAT_SECONDS
+        while job is None and time.time() < wait_until:
+            job = job_tracker.get(session_id)
+            if job is None:
+                time.sleep(0.1)
+                if time.time() >= next_heartbeat:
+                    next_heartbeat = time.time() + Config.SSE_HEARTBEAT_SECONDS
+                    yield ": heartbeat\n\n"
+        
+        # Replay missed events, then stream new ones as the job records them
+        cursor = last_event_id or 0
+        while job is not None:
+            events = job_tracker.events_after(job, cursor, Config.SSE_HEARTBEAT_SECONDS)
+            for event_id, data in events:
+                cursor = event_id
+                yield f"id: {event_id}\ndata: {json.dumps(data)}\n\n"
+                if data['type'] == 'complete':
+                    job = None
                     break
+            if job is None:
+                break
             
-            time.sleep(0.1)  # Check every 100ms
+            if job.finished and not events:
+                # Completion already delivered before this connection
+                break
+            if session_id not in job.subscribers:
+                print(f"[SSE] Session {session_id} detached, ending stream")
+                yield f"data: {json.dumps({'type': 'complete', 'status': 'stopped'})}\n\n"
+                break
+            if not events:
+                yield ": heartbeat\n\n"
         
-        # Send done message
         print(f"[SSE] Stream ending, sending done message")
         yield f"data: {json.dumps({'type': 'done'})}\n\n"
     
-    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    events = generate() if job_queue is None else queued_progress_events(session_id, last_event_id)
+    response = Response(stream_with_context(events), mimetype='text/event-stream')
     response.headers['Cache-Control'] = 'no-cache'
     response.headers['X-Accel-Buffering'] = 'no'
     return response
 
+def queued_job_progress(record):
+    """Progress of a shared-queue job in the shape of Job.progress()"""
+    total_steps = record['total_steps']
+    finished = record['status'] in JobQueue.FINISHED
+    return {
+        'job_id': record['job_id'],
+        'status': record['status'],
+        'current_step': record['current_step'],
+        'total_steps': total_steps,
+        'is_generating': not finished,
+        'percentage': int(record['current_step'] / total_steps * 100) if total_steps else 0,
+        # Queue event ids are step numbers, completion comes after the last step
+        'last_event_id': total_steps + 1 if finished else record['current_step']
+    }
+
+def queued_job_events(record, last_event_id):
+    """Progress and completion events of a shared-queue job after ``last_event_id``"""
+    progress = queued_job_progress(record)
+    events = []
+    if 0 < record['current_step'] <= record['total_steps'] and record['current_step'] > last_event_id:
+        events.append((record['current_step'], {
+            'type': 'progress',
+            'current_step': record['current_step'],
+            'total_steps': record['total_steps'],
+            'percentage': progress['percentage']
+        }))
+    if record['status'] in JobQueue.FINISHED and progress['last_event_id'] > last_event_id:
+        events.append((progress['last_event_id'], {'type': 'complete', 'status': record['status']}))
+    return events
+
+def queued_progress_events(session_id, last_event_id):
+    """SSE stream of a session's job in the shared queue
+
+    A worker on another node runs the job, so its record is polled every
+    QUEUE_POLL_SECONDS. Event ids are step numbers, so a reconnecting stream
+    resumes from Last-Event-ID like the in-process one; intermediate steps
+    between two polls are not replayed.
+    """
+    yield f"retry: {Config.SSE_RETRY_MS}\n\n"
+    if last_event_id is None:
+        yield f"data: {json.dumps({'type': 'connected', 'session_id': session_id})}\n\n"
+    
+    job_id = None
+    wait_until = time.time() + Config.PROGRESS_WAIT_SECONDS
+    next_heartbeat = time.time() + Config.SSE_HEARTBEAT_SECONDS
+    cursor = last_event_id or 0
+    while True:
+        if job_id is None:
+            job_id = job_queue.job_for_session(session_id)
+            if job_id is None and time.time() >= wait_until:
+                break
+        record = job_queue.get(job_id) if job_id else None
+        if job_id and record is None:
+            break
+        if record is not None:
+            events = queued_job_events(record, cursor)
+            for event_id, data in events:
+                cursor = event_id
+                yield f"id: {event_id}\ndata: {json.dumps(data)}\n\n"
+            if events:
+                next_heartbeat = time.time() + Config.SSE_HEARTBEAT_SECONDS
+            if record['status'] in JobQueue.FINISHED:
+                break
+        if time.time() >= next_heartbeat:
+            next_heartbeat = time.time() + Config.SSE_HEARTBEAT_SECONDS
+            yield ": heartbeat\n\n"
+        time.sleep(Config.QUEUE_POLL_SECONDS)
+    
+    print(f"[SSE] Stream ending, sending done message")
+    yield f"data: {json.dumps({'type': 'done'})}\n\n"
+
 @app.route('/api/progress-poll/<session_id>', methods=['GET'])
 def poll_progress(session_id):
-    """Poll-based progress endpoint as fallback for SSE"""
-    if progress_data['session_id'] == session_id:
-        return jsonify({
-            'current_step': progress_data['current_step'],
-            'total_steps': progress_data['total_steps'],
-            'is_generating': progress_data['is_generating'],
-            'percentage': int((progress_data['current_step'] / progress_data['total_steps'] * 100)) if progress_data['total_steps'] > 0 else 0
-        })
-    else:
+    """Poll-based progress endpoint as fallback for SSE
+    
+    With ``?after=<event id>`` the response also lists the job's buffered
+    events after that id, so a poller sees every step it missed.
+    """
+    if job_queue is not None:
+        return jsonify(poll_queued_progress(session_id))
+    job = job_tracker.get(session_id)
+    if job is None:
         return jsonify({
             'current_step': 0,
             'total_steps': 0,
             'is_generating': False,
             'percentage': 0
         })
+    
+    progress = job.progress()
+    progress['last_event_id'] = job.last_event_id
+    after = request.args.get('after', type=int)
+    if after is not None:
+        progress['events'] = [
+            dict(data, id=event_id)
+            for event_id, data in job_tracker.events_after(job, after, 0)
+        ]
+    return jsonify(progress)
+
+def poll_queued_progress(session_id):
+    job_id = job_queue.job_for_session(session_id)
+    record = job_queue.get(job_id) if job_id else None
+    if record is None:
+        return {
+            'current_step': 0,
+            'total_steps': 0,
+            'is_generating': False,
+            'percentage': 0
+        }
+    progress = queued_job_progress(record)
+    after = request.args.get('after', type=int)
+    if after is not None:
+        progress['events'] = [dict(data, id=event_id) for event_id, data in queued_job_events(record, after)]
+    return progress
 
 @app.route('/api/generate', methods=['POST'])
 def generate_image():
@@ -137,9 +521,30 @@ def generate_image():
         "height": 512,  # optional
         "num_inference_steps": 20,  # optional
         "guidance_scale": 7.5,  # optional
-        "seed": null  # optional, for reproducibility
+        "guidance_truncation": 0.0,  # optional, fraction of final steps without CFG
+        "hires": false,  # optional, two-pass generation at width x height
+        "hires_scale": 0.5,  # optional, base pass size as a fraction of the target
+        "hires_strength": 0.35,  # optional, fraction of steps refined at the target size
+        "hires_upscale": "image",  # optional, 'image' or 'latent'
+        "early_exit": false,  # optional, stop once the image has converged
+        "early_exit_threshold": 0.01,  # optional, relative x0 change counted as converged
+        "deep_cache_interval": 1,  # optional, run the full UNet every N steps (PyTorch, 1 = off)
+        "allow_degrade": false,  # optional, accept cheaper settings while the queue is backed up
+        "seed": null,  # optional, for reproducibility
+        "model_id": null,  # optional, one of /api/models
+        "async": false  # optional, distributed mode: answer 202 with a status_url at once
     }
+    
+    Requests with a seed whose normalized parameters match a queued or
+    running job attach to that job instead of starting another run. In
+    distributed mode (QUEUE_BACKEND) the job goes to the shared queue and a
+    worker node runs it. With LOAD_SHED on, ``degraded`` in the response lists
+    what the ladder changed, and past its hard limit the answer is 429.
     """
+    received_at = time.time()
+    received_perf = time.perf_counter()
+    trace = tracer.sample()
+    parameters = None
     try:
         data = request.get_json()
         
@@ -153,97 +558,139 @@ def generate_image():
         height = data.get('height', Config.DEFAULT_HEIGHT)
         num_inference_steps = data.get('num_inference_steps', Config.DEFAULT_STEPS)
         guidance_scale = data.get('guidance_scale', Config.DEFAULT_GUIDANCE_SCALE)
+        guidance_truncation = data.get('guidance_truncation', Config.DEFAULT_GUIDANCE_TRUNCATION)
         seed = data.get('seed', None)
         
         # Validate prompt
         if not prompt or len(prompt.strip()) == 0:
             return jsonify({'error': 'Prompt cannot be empty'}), 400
         
+        try:
+            guidance_truncation = float(guidance_truncation or 0.0)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'guidance_truncation must be a number'}), 400
+        if not 0.0 <= guidance_truncation <= 1.0:
+            return jsonify({'error': 'guidance_truncation must be between 0 and 1'}), 400
+        
+        hires = None
+        if data.get('hires'):
+            try:
+                hires = {
+                    'scale': float(data.get('hires_scale', Config.HIRES_SCALE)),
+                    'strength': float(data.get('hires_strength', Config.HIRES_STRENGTH)),
+                    'upscale': str(data.get('hires_upscale', Config.HIRES_UPSCALE)).lower()
+                }
+            except (TypeError, ValueError):
+                return jsonify({'error': 'hires_scale and hires_strength must be numbers'}), 400
+            if not 0.25 <= hires['scale'] < 1.0:
+                return jsonify({'error': 'hires_scale must be at least 0.25 and below 1'}), 400
+            if not 0.0 < hires['strength'] <= 1.0:
+                return jsonify({'error': 'hires_strength must be above 0 and at most 1'}), 400
+            if hires['upscale'] not in ('image', 'latent'):
+                return jsonify({'error': "hires_upscale must be 'image' or 'latent'"}), 400
+        
+        early_exit = None
+        if data.get('early_exit', Config.EARLY_EXIT):
+            try:
+                early_exit = {
+                    'threshold': float(data.get('early_exit_threshold', Config.EARLY_EXIT_THRESHOLD)),
+                    'patience': Config.EARLY_EXIT_PATIENCE,
+                    'min_steps': Config.EARLY_EXIT_MIN_STEPS
+                }
+            except (TypeError, ValueError):
+                return jsonify({'error': 'early_exit_threshold must be a number'}), 400
+            if early_exit['threshold'] <= 0:
+                return jsonify({'error': 'early_exit_threshold must be above 0'}), 400
+        
+        try:
+            deep_cache_interval = int(data.get('deep_cache_interval', Config.DEEP_CACHE_INTERVAL))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'deep_cache_interval must be a number'}), 400
+        if deep_cache_interval < 1:
+            return jsonify({'error': 'deep_cache_interval must be at least 1'}), 400
+        deep_cache = None
+        if deep_cache_interval > 1:
+            deep_cache = {'interval': deep_cache_interval, 'branch': Config.DEEP_CACHE_BRANCH}
+        
+        try:
+            model_id = model_registry.resolve(data.get('model_id'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         print(f"Received generation request: {prompt[:50]}...")
         
         # Use session ID from request if provided, otherwise generate new one
         session_id = data.get('session_id', str(uuid.uuid4()))
         print(f"Session ID: {session_id}")
         
-        # Initialize progress tracking
-        progress_data['current_step'] = 0
-        progress_data['total_steps'] = num_inference_steps
-        progress_data['is_generating'] = True
-        progress_data['session_id'] = session_id
-        progress_data['should_stop'] = False
+        parameters = {
+            'prompt': prompt,
+            'negative_prompt': negative_prompt,
+            'width': width,
+            'height': height,
+            'num_inference_steps': num_inference_steps,
+            'guidance_scale': guidance_scale,
+            'guidance_truncation': guidance_truncation,
+            'hires': hires,
+            'early_exit': early_exit,
+            'deep_cache': deep_cache,
+            'seed': seed,
+            'model_id': model_id
+        }
         
-        # Define progress callback
-        def progress_callback(step, total):
-            # Check if we should stop
-            if progress_data['should_stop']:
-                print(f"[CALLBACK] Stop requested at step {step + 1}/{total}, raising StopIteration")
-                # Use StopIteration instead of Exception for cleaner stop
-                raise StopIteration("Generation stopped by user")
-            
-            progress_data['current_step'] = step + 1  # step is 0-indexed
-            progress_data['total_steps'] = total
-            print(f"[CALLBACK] Progress callback invoked: step {step + 1}/{total}, session_id: {session_id}")
+        degraded = None
+        if load_shedder is not None:
+            degraded, rejection = shed_load(parameters, bool(data.get('allow_degrade')))
+            if rejection is not None:
+                return rejection
         
-        print(f"[DEBUG] Progress callback function created, passing to model.generate_image()")
+        if trace is not None:
+            trace.add_span('http.parse', received_perf, time.perf_counter(), cat='http')
         
-        # Start timing
-        start_time = time.time()
+        if job_queue is not None:
+            return enqueue_generation(parameters, session_id, received_at, bool(data.get('async')), degraded)
         
-        # Generate image with progress callback
-        image = sd_model.generate_image(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            width=width,
-            height=height,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            seed=seed,
-            callback=progress_callback
+        submitted_perf = time.perf_counter()
+        job, created = job_tracker.submit(
+            request_key(parameters) if Config.COALESCE_REQUESTS else None,
+            session_id,
+            parameters['num_inference_steps'],
+            lambda job: run_generation_job(job, parameters, received_at, submitted_perf),
+            trace=trace
         )
+        if not created:
+            metrics.inc('generate.coalesced')
+        elif trace is not None:
+            tracer.register(job.job_id, trace)
+        # An attached request records into the timeline of the job it joined
+        trace = job.trace
+        outcome = job_tracker.wait(job, session_id)
+        if trace is not None:
+            trace.add_span('job.wait', submitted_perf, time.perf_counter(), cat='http',
+                           session_id=session_id, coalesced=not created)
         
-        # Mark generation as complete
-        progress_data['is_generating'] = False
-        
-        # Calculate generation time
-        generation_time = time.time() - start_time
+        if outcome in ('detached', 'stopped'):
+            raise StopIteration("Generation stopped by user")
+        if outcome == 'failed':
+            raise RuntimeError(job.error)
         
-        # Save image
-        image_id = str(uuid.uuid4())
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{timestamp}_{image_id}.png"
-        filepath = os.path.join(Config.OUTPUT_DIR, filename)
-        image.save(filepath)
+        response_start = time.perf_counter()
+        result = dict(job.result, session_id=session_id, coalesced=not created)
+        result['degraded'] = settle_degraded(degraded, result)
+        result['timings'] = dict(result['timings'], total=round(time.time() - received_at, 4))
+        metrics.observe('generate.latency', result['timings']['total'])
+        record_request_trace(received_at, parameters, 'ok', result['timings'])
         
-        # Convert to base64 for response
-        image_base64 = sd_model.image_to_base64(image)
-        
-        print(f"Image generated successfully in {generation_time:.2f} seconds")
-        
-        return jsonify({
-            'success': True,
-            'session_id': session_id,
-            'image_id': image_id,
-            'filename': filename,
-            'image_data': f"data:image/png;base64,{image_base64}",
-            'generation_time': round(generation_time, 2),
-            'generation_time_formatted': f"{generation_time:.2f}s",
-            'parameters': {
-                'prompt': prompt,
-                'negative_prompt': negative_prompt,
-                'width': width,
-                'height': height,
-                'num_inference_steps': num_inference_steps,
-                'guidance_scale': guidance_scale,
-                'seed': seed
-            }
-        })
+        response = jsonify(result)
+        if trace is not None:
+            trace.add_span('response', response_start, time.perf_counter(), cat='http',
+                           bytes=response.content_length)
+        return response
         
     except StopIteration as e:
         print(f"[STOP] Generation stopped: {e}")
-        
-        # Mark generation as complete
-        progress_data['is_generating'] = False
-        progress_data['should_stop'] = False
+        metrics.inc('generate.stopped')
+        record_request_trace(received_at, parameters, 'stopped')
         
         return jsonify({
             'success': False,
@@ -256,23 +703,370 @@ def generate_image():
         import traceback
         traceback.print_exc()
         
-        # Mark generation as complete even on error
-        progress_data['is_generating'] = False
-        progress_data['should_stop'] = False
+        metrics.inc('generate.errors')
+        if parameters is not None:
+            record_request_trace(received_at, parameters, 'error', error=str(e)[:300])
         
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+def enqueue_generation(parameters, session_id, received_at, asynchronous=False, degraded=None):
+    """Push a generation to the shared queue and wait for a worker's result
+
+    Answers 202 with the job's status_url when the caller asked for ``async``
+    or no result arrived within QUEUE_RESULT_TIMEOUT; any API node serves
+    that URL.
+    """
+    job_id = job_queue.enqueue(parameters, session_id)
+    print(f"[QUEUE] Job {job_id} queued for session {session_id}")
+    if asynchronous:
+        record = job_queue.get(job_id)
+    else:
+        record = job_queue.wait(job_id, Config.QUEUE_RESULT_TIMEOUT)
+        if record is None:
+            raise RuntimeError(f"Job {job_id} expired from the queue")
+    
+    if record is None or record['status'] not in JobQueue.FINISHED:
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'session_id': session_id,
+            'status': record['status'] if record else JobQueue.QUEUED,
+            'status_url': f"/api/jobs/{job_id}",
+            'degraded': degraded
+        }), 202
+    if record['status'] == JobQueue.STOPPED:
+        raise StopIteration("Generation stopped by user")
+    if record['status'] == JobQueue.FAILED:
+        raise RuntimeError(record['error'])
+    
+    result = dict(record['result'], session_id=session_id, coalesced=False)
+    result['degraded'] = settle_degraded(degraded, result)
+    result['timings'] = dict(result['timings'], total=round(time.time() - received_at, 4))
+    metrics.observe('generate.latency', result['timings']['total'])
+    record_request_trace(received_at, parameters, 'ok', result['timings'])
+    return jsonify(result)
+
+def run_generation_job(job, parameters, received_at, submitted_perf=None, on_step=None):
+    """Run one generation for every request subscribed to ``job``; returns the shared response body
+
+    ``on_step(step, total_steps)`` is called after each step's progress is
+    recorded (worker.py reports it to the shared queue); it may raise
+    StopIteration to cancel the run.
+    """
+    # Spans recorded below (and on the threads the work is handed to) go
+    # into the job's timeline when it was sampled
+    with activate(job.trace):
+        if submitted_perf is not None:
+            add_span('job.queue', submitted_perf, cat='queue')
+        return _run_generation_job(job, parameters, received_at, on_step)
+
+def _run_generation_job(job, parameters, received_at, on_step=None):
+    # Define progress callback
+    def progress_callback(step, total):
+        # Raises StopIteration once every subscriber has been detached
+        job_tracker.step(job, step + 1, total)  # step is 0-indexed
+        if on_step is not None:
+            on_step(step + 1, total)
+        print(f"[CALLBACK] Progress callback invoked: step {step + 1}/{total}, job: {job.job_id}")
+    
+    # Start timing
+    start_time = time.time()
+    
+    # Generate image with progress callback
+    # The registry keeps the model resident for the duration of the job and
+    # the manager pins the active pipeline so a concurrent device switch
+    # lets this job drain on the old one; the device slot keeps other
+    # gunicorn workers off the same GPU meanwhile. The slot is per process,
+    # so this process's staged or infer-slot jobs still overlap on it
+    stats = {}
+    with model_registry.use(parameters['model_id']) as model_manager, \
+            device_slots.acquire(model_manager.device), \
+            span('generate', model_id=parameters['model_id']):
+        image, sd_model = model_manager.generate_image(
+            prompt=parameters['prompt'],
+            negative_prompt=parameters['negative_prompt'],
+            width=parameters['width'],
+            height=parameters['height'],
+            num_inference_steps=parameters['num_inference_steps'],
+            guidance_scale=parameters['guidance_scale'],
+            guidance_truncation=parameters['guidance_truncation'],
+            seed=parameters['seed'],
+            callback=progress_callback,
+            stats=stats,
+            hires=parameters['hires'],
+            early_exit=parameters.get('early_exit'),
+            deep_cache=parameters.get('deep_cache')
+        )
+    
+    # Calculate generation time
+    generation_time = time.time() - start_time
+    # An early exit ends on an earlier step than the job announced
+    timings = request_timings(received_at, job.first_step_at, job.current_step or job.total_steps)
+    if load_shedder is not None and timings['service_time'] is not None:
+        load_shedder.observe(timings['service_time'])
+    if timings['queue_time'] is not None:
+        metrics.observe('generate.queue_time', timings['queue_time'])
+    if stats.get('guidance'):
+        metrics.observe('generate.cfg_estimated_speedup', stats['guidance']['estimated_speedup'])
+    early_exit = (stats.get('guidance') or {}).get('early_exit')
+    if early_exit:
+        metrics.observe('generate.steps_used', early_exit['steps_used'])
+        if early_exit['exited']:
+            metrics.inc('generate.early_exit')
+            metrics.inc('generate.early_exit_saved_steps', early_exit['saved_steps'])
+    deep_cache = (stats.get('guidance') or {}).get('deep_cache')
+    if deep_cache and deep_cache['supported']:
+        metrics.inc('generate.deep_cache')
+        if deep_cache['measured_speedup']:
+            metrics.observe('generate.deep_cache_speedup', deep_cache['measured_speedup'])
+    # Parameters the backend accepted but could not apply are flagged, not
+    # reported as applied
+    unsupported = {}
+    if stats.get('guidance') and not stats['guidance']['truncation_supported']:
+        metrics.inc('generate.truncation_unsupported')
+        unsupported['guidance_truncation'] = 'needs callback_on_step_end or a torch UNet; ran full guidance'
+    if stats.get('hires'):
+        metrics.inc('generate.hires')
+        metrics.observe('generate.hires_estimated_speedup', stats['hires']['estimated_speedup'])
+    
+    # Save image into its shard and record its metadata in the index
+    image_id = str(uuid.uuid4())
+    # Encode once for the response; the disk write, index update and
+    # thumbnail run on the post-processing pool
+    image_bytes, mime_type, filename, persisted = postprocessor.process(image_id, image, dict(
+        parameters,
+        width=image.width,
+        height=image.height,
+        device=sd_model.device,
+        generation_time=round(generation_time, 3),
+        parameters=parameters
+    ))
+    image_base64 = base64.b64encode(image_bytes).decode()
+    if job.trace is not None:
+        # The file copy is written once the disk write is in the timeline too
+        persisted.add_done_callback(lambda _: tracer.save(job.trace))
+    
+    print(f"Image generated successfully in {generation_time:.2f} seconds")
+    
+    return {
+        'success': True,
+        'job_id': job.job_id,
+        'image_id': image_id,
+        'filename': filename,
+        'image_url': f"/api/images/{image_id}",
+        'image_data': f"data:{mime_type};base64,{image_base64}",
+        'device': sd_model.device,
+        'generation_time': round(generation_time, 2),
+        'generation_time_formatted': f"{generation_time:.2f}s",
+        'steps_used': early_exit['steps_used'] if early_exit else job.total_steps,
+        'unsupported': unsupported or None,
+        'timings': timings,
+        'stats': stats,
+        'trace_url': f"/api/jobs/{job.job_id}/trace" if job.trace is not None else None,
+        'parameters': parameters
+    }
+
+def request_timings(received_at, first_step_at, num_steps):
+    """Split a request's latency into queueing and denoising
+
+    The first progress callback fires after one step, so queue time is the
+    wait until then minus the average step time. It includes prompt encoding,
+    which is small next to the denoising loop. Service time is the rest: the
+    job's run on the device, without model loads or lock and slot waits.
+    """
+    now = time.time()
+    if first_step_at is None:
+        return {'queue_time': None, 'time_to_first_step': None, 'step_time': None, 'service_time': None}
+    step_time = (now - first_step_at) / (num_steps - 1) if num_steps > 1 else 0.0
+    return {
+        'queue_time': round(max(0.0, first_step_at - received_at - step_time), 4),
+        'time_to_first_step': round(first_step_at - received_at, 4),
+        'step_time': round(step_time, 4),
+        'service_time': round(now - first_step_at + step_time, 4)
+    }
+
+@app.route('/api/images/<image_id>', methods=['GET'])
+def get_image(image_id):
+    """Serve a stored image by id"""
+    path = output_store.path(image_id)
+    if not path or not os.path.exists(path):
+        # Just generated: served from memory until the pool has written it
+        pending = postprocessor.pending(image_id)
+        if pending is not None:
+            data, mime_type = pending
+            return send_file(io.BytesIO(data), mimetype=mime_type, max_age=0)
+        return jsonify({'error': 'Image not found'}), 404
+    return send_file(path, max_age=86400)
+
+@app.route('/api/images/<image_id>/info', methods=['GET'])
+def get_image_info(image_id):
+    """Return the indexed generation metadata of a stored image"""
+    record = output_store.get(image_id)
+    if not record:
+        return jsonify({'error': 'Image not found'}), 404
+    return jsonify(record)
+
+@app.route('/api/images/<image_id>/thumbnail', methods=['GET'])
+def get_thumbnail(image_id):
+    """Serve the small WebP thumbnail of a stored image"""
+    path = thumbnail_generator.ensure(image_id)
+    if not path or not os.path.exists(path):
+        return jsonify({'error': 'Image not found'}), 404
+    return send_file(path, mimetype='image/webp', max_age=86400)
+
+def parse_history_time(value):
+    """Accept epoch seconds or an ISO 8601 date/datetime"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+@app.route('/api/history', methods=['GET'])
+def get_history():
+    """
+    List past generations newest first, one page at a time
+    
+    Query parameters (all optional):
+        limit   - page size (default HISTORY_PAGE_SIZE)
+        cursor  - next_cursor from the previous page
+        prompt  - prompt substring
+        since   - only images created at or after this time (epoch or ISO date)
+        until   - only images created before this time (epoch or ISO date)
+        width, height - exact image size
+    """
+    try:
+        limit = request.args.get('limit', Config.HISTORY_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, Config.HISTORY_MAX_PAGE_SIZE))
+        items, next_cursor = output_store.query(
+            limit=limit,
+            cursor=request.args.get('cursor'),
+            prompt=request.args.get('prompt'),
+            since=parse_history_time(request.args.get('since')),
+            until=parse_history_time(request.args.get('until')),
+            width=request.args.get('width', type=int),
+            height=request.args.get('height', type=int)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'items': [{
+            'image_id': item['image_id'],
+            'created_at': item['created_at'],
+            'prompt': item['prompt'],
+            'negative_prompt': item['negative_prompt'],
+            'width': item['width'],
+            'height': item['height'],
+            'num_inference_steps': item['num_inference_steps'],
+            'guidance_scale': item['guidance_scale'],
+            'seed': item['seed'],
+            'model_id': item['model_id'],
+            'device': item['device'],
+            'generation_time': item['generation_time'],
+            'size_bytes': item['size_bytes'],
+            'image_url': f"/api/images/{item['image_id']}",
+            'thumbnail_url': f"/api/images/{item['image_id']}/thumbnail"
+        } for item in items],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/storage', methods=['GET'])
+def storage_stats():
+    """Output store size, retention policy and write queue"""
+    stats = output_store.stats()
+    stats['postprocess'] = postprocessor.status()
+    return jsonify(stats)
+
+@app.route('/api/memory', methods=['GET'])
+def memory_status():
+    """Memory samples and watchdog decisions for each resident model"""
+    models = []
+    for model_id in model_registry.model_ids:
+        model = model_registry.get(model_id).model
+        watchdog = getattr(model, 'memory_watchdog', None)
+        models.append({
+            'model_id': model_id,
+            'device': model.device,
+            'loaded': model.model_loaded,
+            'memory_watchdog': watchdog.status() if watchdog else None
+        })
+    return jsonify({'models': models})
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """In-process counters, gauges and timers"""
+    return jsonify(metrics.snapshot())
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """Queued and running generation jobs with their subscriber counts"""
+    return jsonify(dict(
+        job_tracker.status(),
+        tracing=tracer.status(),
+        load_shedding=load_shedder.status() if load_shedder is not None else None
+    ))
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status, progress and (once done) the response body of one job
+
+    In distributed mode any API node answers for any job of the shared queue.
+    """
+    if job_queue is not None:
+        record = job_queue.get(job_id)
+        if record is None:
+            return jsonify({'error': 'Job not found (unknown or expired)'}), 404
+        body = queued_job_progress(record)
+        body.update(worker_id=record['worker_id'], error=record['error'], result=record['result'])
+        return jsonify(body)
+    
+    job = job_tracker.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found (unknown or expired)'}), 404
+    body = job.progress()
+    body['last_event_id'] = job.last_event_id
+    body.update(error=job.error, result=job.result)
+    return jsonify(body)
+
+@app.route('/api/queue', methods=['GET'])
+def queue_status():
+    """Shared queue depth and per-worker throughput in distributed mode"""
+    if job_queue is None:
+        return jsonify({'enabled': False, 'message': 'Distributed mode is off (QUEUE_BACKEND is empty)'})
+    return jsonify(dict(job_queue.stats(), enabled=True))
+
+@app.route('/api/jobs/<job_id>/trace', methods=['GET'])
+def get_job_trace(job_id):
+    """Timeline of a sampled job as Chrome trace-event JSON (open in Perfetto)"""
+    trace = tracer.get(job_id)
+    if trace is None:
+        if not tracer.enabled:
+            return jsonify({'error': 'Tracing is disabled (TRACE_SAMPLE_RATE=0)'}), 404
+        return jsonify({'error': 'No trace for this job (not sampled or expired)'}), 404
+    response = jsonify(trace.to_chrome())
+    if request.args.get('download'):
+        response.headers['Content-Disposition'] = f'attachment; filename="trace-{job_id}.json"'
+    return response
+
 @app.route('/api/stop/<session_id>', methods=['POST'])
 def stop_generation(session_id):
-    """Stop the current generation"""
+    """Stop waiting for a generation (cancels the job if nobody else waits for it)"""
     try:
-        if progress_data['session_id'] == session_id and progress_data['is_generating']:
+        if job_queue is not None:
+            # No coalescing across the queue, so the session's job is cancelled
+            job_id = job_queue.job_for_session(session_id)
+            stopped = job_id is not None and job_queue.cancel(job_id)
+        else:
+            # Only this session is detached; a job shared with other requests
+            # keeps running until its last subscriber stops
+            stopped = job_tracker.detach(session_id)
+        if stopped:
             print(f"[STOP] Stop requested for session: {session_id}")
-            progress_data['should_stop'] = True
-            progress_data['is_generating'] = False
             return jsonify({
                 'success': True,
                 'message': 'Generation stop requested'
@@ -304,8 +1098,18 @@ def get_config():
         'default_steps': Config.DEFAULT_STEPS,
         'max_steps': Config.MAX_STEPS,
         'default_guidance_scale': Config.DEFAULT_GUIDANCE_SCALE,
+        'default_guidance_truncation': Config.DEFAULT_GUIDANCE_TRUNCATION,
+        'hires_scale': Config.HIRES_SCALE,
+        'hires_strength': Config.HIRES_STRENGTH,
+        'hires_upscale': Config.HIRES_UPSCALE,
+        'early_exit': Config.EARLY_EXIT,
+        'early_exit_threshold': Config.EARLY_EXIT_THRESHOLD,
+        'early_exit_min_steps': Config.EARLY_EXIT_MIN_STEPS,
+        'deep_cache_interval': Config.DEEP_CACHE_INTERVAL,
+        'load_shed': Config.LOAD_SHED,
         'model_id': Config.MODEL_ID,
-        'device': Config.DEVICE
+        'model_ids': model_registry.model_ids,
+        'device': model_registry.default.device
     })
 
 @app.route('/api/health', methods=['GET'])
@@ -313,29 +1117,40 @@ def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
-        'model_loaded': sd_model.model_loaded,
+        'model_loaded': model_registry.default.model_loaded,
         'timestamp': datetime.now().isoformat()
     })
 
 @app.route('/api/load-model', methods=['POST'])
 def load_model():
-    """Preload the model into memory"""
+    """Preload a model into memory"""
     try:
-        sd_model.load_model()
+        data = request.get_json(silent=True) or {}
+        model_registry.load_model(data.get('model_id'))
         return jsonify({
             'success': True,
             'message': 'Model loaded successfully'
         })
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
     except Exception as e:
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+@app.route('/api/models', methods=['GET'])
+def list_models():
+    """List served model ids and their memory residency"""
+    return jsonify(model_registry.status())
+
 @app.route('/api/device', methods=['GET', 'POST'])
 def device_control():
     """Get or set the device (CPU/GPU)"""
-    global sd_model
+    model_manager = model_registry.default
     
     if request.method == 'GET':
         # Return current device and available devices
@@ -352,10 +1167,18 @@ def device_control():
             available_devices = ['cpu', 'cuda', 'mps']
         
         return jsonify({
-            'current_device': sd_model.device if hasattr(sd_model, 'device') else Config.DEVICE,
+            'current_device': model_manager.device,
             'available_devices': available_devices,
             'backend': 'OpenVINO' if Config.USE_OPENVINO else 'PyTorch',
-            'model_loaded': sd_model.model_loaded
+            'model_loaded': model_manager.model_loaded,
+            'preferred_device': model_manager.preferred_device,
+            'switch': model_manager.switch_status(),
+            'standby': model_manager.standby_status(),
+            'health': breaker_status(),
+            'cpu_partitions': (
+                model_manager.model.status()
+                if isinstance(model_manager.model, PartitionedCPUModel) else None
+            )
         })
     
     elif request.method == 'POST':
@@ -363,73 +1186,54 @@ def device_control():
         try:
             data = request.get_json()
             new_device = data.get('device')
+            wait = bool(data.get('wait', False))
             
             if not new_device:
                 return jsonify({'error': 'Device parameter is required'}), 400
             
             # Validate device based on backend
-            if Config.USE_OPENVINO:
-                valid_devices = ['CPU', 'GPU'] + [f'GPU.{i}' for i in range(10)]
-                if new_device.upper() not in valid_devices and not new_device.upper().startswith('GPU'):
-                    return jsonify({'error': f'Invalid device for OpenVINO: {new_device}'}), 400
-                new_device = new_device.upper()
-            else:
-                if new_device.lower() not in ['cpu', 'cuda', 'mps']:
-                    return jsonify({'error': f'Invalid device for PyTorch: {new_device}'}), 400
-                new_device = new_device.lower()
+            normalized = normalize_device(new_device)
+            if not normalized:
+                backend = 'OpenVINO' if Config.USE_OPENVINO else 'PyTorch'
+                return jsonify({'error': f'Invalid device for {backend}: {new_device}'}), 400
+            new_device = normalized
             
-            print(f"Switching device from {sd_model.device} to {new_device}")
+            print(f"Switching device from {model_manager.device} to {new_device}")
             
-            # Unload current model with proper cleanup
-            if sd_model.model_loaded:
-                print("Unloading current model...")
-                try:
-                    sd_model.unload_model()
-                except Exception as unload_error:
-                    print(f"Warning: Error during model unloading: {unload_error}")
-                    # Continue with device switch even if unload fails
+            # The target pipeline is loaded in the background while the current
+            # one keeps serving; the swap itself is atomic
+            switch = model_registry.switch_device(new_device, wait=wait)
             
-            # Update device
-            sd_model.device = new_device
-            Config.DEVICE = new_device
+            if switch['status'] == 'failed':
+                return jsonify({
+                    'success': False,
+                    'error': switch['error'],
+                    'switch': switch
+                }), 500
             
-            # Reinitialize model with new device
-            if Config.USE_OPENVINO:
-                from models import StableDiffusionModelOpenVINO
-                old_model = sd_model
-                sd_model = StableDiffusionModelOpenVINO()
-                sd_model.device = new_device
-                
-                # Clean up old model reference
-                try:
-                    del old_model
-                except Exception:
-                    pass
+            if switch['status'] == 'switching':
+                message = f'Switching to {new_device} in the background. Current device keeps serving until it is ready.'
+            elif model_manager.model_loaded:
+                message = f'Device switched to {model_manager.device}.'
             else:
-                from models import StableDiffusionModel
-                old_model = sd_model
-                sd_model = StableDiffusionModel()
-                sd_model.device = new_device
-                
-                # Clean up old model reference
-                try:
-                    del old_model
-                except Exception:
-                    pass
+                message = f'Device switched to {model_manager.device}. Model will be loaded on next generation.'
             
-            # Force garbage collection after device switch
-            import gc
-            gc.collect()
-            
-            print(f"Device switched to {new_device}. Model will be loaded on next generation.")
+            print(message)
             
             return jsonify({
                 'success': True,
                 'device': new_device,
-                'message': f'Device switched to {new_device}. Model will be loaded on next generation.',
+                'current_device': model_manager.device,
+                'switch': switch,
+                'message': message,
                 'backend': 'OpenVINO' if Config.USE_OPENVINO else 'PyTorch'
             })
             
+        except RuntimeError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 409
         except Exception as e:
             print(f"Error switching device: {e}")
             return jsonify({
@@ -451,6 +1255,8 @@ if __name__ == '__main__':
     print("=" * 60)
     print(f"Backend: {'OpenVINO' if Config.USE_OPENVINO else 'PyTorch'}")
     print(f"Model: {Config.MODEL_ID}")
+    if Config.MODEL_IDS:
+        print(f"Additional models: {', '.join(Config.MODEL_IDS)}")
     print(f"Device: {Config.DEVICE}")
     print(f"NSFW Allowed: {Config.NSFW_ALLOWED}")
     print(f"Safety Checker: {Config.SAFETY_CHECKER_ENABLED}")
@@ -458,7 +1264,7 @@ if __name__ == '__main__':
     
     # Optionally preload model at startup
     # Uncomment the next line to preload:
-    # sd_model.load_model()
+    # model_registry.load_model()
     
     # Run with increased timeout for long-running requests
     app.run(
@@ -1,6 +1,8 @@
 # Copyright 2025 by trongton@gmail.com
 
+import json
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -12,16 +14,69 @@ class Config:
     MODEL_ID = os.getenv('MODEL_ID', 'runwayml/stable-diffusion-v1-5')
     USE_OPENVINO = os.getenv('USE_OPENVINO', 'True').lower() == 'true'
     
+    # Additional model ids that can be selected per request (comma separated)
+    # MODEL_ID is always served and is the default
+    MODEL_IDS = [m.strip() for m in os.getenv('MODEL_IDS', '').split(',') if m.strip()]
+    # Memory budget for resident pipelines in MB (0 = unlimited)
+    MODEL_MEMORY_BUDGET_MB = int(os.getenv('MODEL_MEMORY_BUDGET_MB', 0))
+    # Footprint assumed for a model that has not been measured yet
+    MODEL_FOOTPRINT_ESTIMATE_MB = int(os.getenv('MODEL_FOOTPRINT_ESTIMATE_MB', 4096))
+    
     # Set default device based on backend
     # Default to CPU for stability, users can switch to GPU via API
     _default_device = 'CPU' if USE_OPENVINO else 'cpu'
     DEVICE = os.getenv('DEVICE', _default_device)
     
+    # Fixed-latency fake backend for load tests without weights
+    FAKE_MODEL = os.getenv('FAKE_MODEL', 'False').lower() == 'true'
+    FAKE_STEP_SECONDS = float(os.getenv('FAKE_STEP_SECONDS', 0.05))
+    FAKE_LOAD_SECONDS = float(os.getenv('FAKE_LOAD_SECONDS', 0))
+    FAKE_DECODE_SECONDS = float(os.getenv('FAKE_DECODE_SECONDS', 0))
+    
+    # OpenVINO per-submodel placement, e.g. "unet=GPU,text_encoder=CPU,vae_decoder=CPU,vae_encoder=CPU"
+    # Parts not listed run on DEVICE
+    OV_SUBMODEL_DEVICES = dict(
+        item.split('=', 1) for item in os.getenv('OV_SUBMODEL_DEVICES', '').replace(' ', '').split(',')
+        if '=' in item
+    )
+    # Per-submodel compile options as JSON, e.g. {"vae_decoder": {"INFERENCE_PRECISION_HINT": "f32"}}
+    OV_SUBMODEL_CONFIG = json.loads(os.getenv('OV_SUBMODEL_CONFIG') or '{}')
+    
+    # Persist compiled OpenVINO blobs (OpenVINO CACHE_DIR) so restarts and
+    # device switches import them instead of compiling, and compile the
+    # submodels on parallel threads
+    OV_COMPILE_CACHE = os.getenv('OV_COMPILE_CACHE', 'True').lower() == 'true'
+    OV_COMPILE_CACHE_DIR = (os.getenv('OV_COMPILE_CACHE_DIR')
+                            or os.path.join(os.path.dirname(__file__), '..', 'ov_cache'))
+    OV_PARALLEL_COMPILE = os.getenv('OV_PARALLEL_COMPILE', 'True').lower() == 'true'
+    
+    # Concurrent generations on one compiled OpenVINO model, each with its own
+    # infer requests and scheduler (1 = one generation at a time). Compiles
+    # with the THROUGHPUT hint so the plugin has a stream per slot.
+    OV_INFER_SLOTS = int(os.getenv('OV_INFER_SLOTS', 1))
+    
+    # Optional warm standby device for instant failover (e.g. CPU behind a GPU)
+    # Leave empty to disable
+    STANDBY_DEVICE = os.getenv('STANDBY_DEVICE', '')
+    
     # Server settings
     HOST = os.getenv('HOST', '0.0.0.0')
     PORT = int(os.getenv('PORT', 5000))
     DEBUG = os.getenv('DEBUG', 'True').lower() == 'true'
     
+    # Multi-worker serving with gunicorn (gunicorn -c gunicorn.conf.py wsgi:app)
+    # Weights are read once in the master and shared copy-on-write by workers
+    WEB_WORKERS = int(os.getenv('WEB_WORKERS', 1))
+    WEB_THREADS = int(os.getenv('WEB_THREADS', 8))
+    WEB_TIMEOUT = int(os.getenv('WEB_TIMEOUT', 600))
+    PRELOAD_MODEL = os.getenv('PRELOAD_MODEL', 'True').lower() == 'true'
+    # Inference threads per worker on CPU (0 = cores divided by WEB_WORKERS)
+    WORKER_CPU_THREADS = int(os.getenv('WORKER_CPU_THREADS', 0))
+    # Workers allowed to run on one accelerator at a time (0 = unlimited);
+    # CPU jobs are never limited
+    GPU_WORKER_SLOTS = int(os.getenv('GPU_WORKER_SLOTS', 1))
+    DEVICE_LOCK_DIR = os.getenv('DEVICE_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'sd-webapp-locks'))
+    
     # Security settings
     SAFETY_CHECKER_ENABLED = os.getenv('SAFETY_CHECKER_ENABLED', 'False').lower() == 'true'
     NSFW_ALLOWED = os.getenv('NSFW_ALLOWED', 'True').lower() == 'true'
@@ -34,10 +89,162 @@ class Config:
     DEFAULT_STEPS = int(os.getenv('DEFAULT_STEPS', 20))
     MAX_STEPS = int(os.getenv('MAX_STEPS', 100))
     DEFAULT_GUIDANCE_SCALE = float(os.getenv('DEFAULT_GUIDANCE_SCALE', 7.5))
+    # Fraction of the final steps run conditional-only (no unconditional UNet
+    # pass); 0 keeps full classifier-free guidance. Requests can override it
+    DEFAULT_GUIDANCE_TRUNCATION = float(os.getenv('DEFAULT_GUIDANCE_TRUNCATION', 0.0))
+    # Two-pass generation for "hires" requests: base size as a fraction of
+    # the target, img2img refinement strength (fraction of steps re-run at the
+    # target size) and what is upscaled between the passes ('image' or 'latent')
+    HIRES_SCALE = float(os.getenv('HIRES_SCALE', 0.5))
+    HIRES_STRENGTH = float(os.getenv('HIRES_STRENGTH', 0.35))
+    HIRES_UPSCALE = os.getenv('HIRES_UPSCALE', 'image').lower()
+    # Convergence-based early exit (opt-in, requests can override it): stop
+    # once the predicted image changes by less than EARLY_EXIT_THRESHOLD
+    # (relative) for EARLY_EXIT_PATIENCE steps in a row, never before
+    # EARLY_EXIT_MIN_STEPS
+    EARLY_EXIT = os.getenv('EARLY_EXIT', 'False').lower() == 'true'
+    EARLY_EXIT_THRESHOLD = float(os.getenv('EARLY_EXIT_THRESHOLD', 0.01))
+    EARLY_EXIT_PATIENCE = int(os.getenv('EARLY_EXIT_PATIENCE', 3))
+    EARLY_EXIT_MIN_STEPS = int(os.getenv('EARLY_EXIT_MIN_STEPS', 20))
+    # UNet feature reuse (DeepCache, PyTorch backend): run the full UNet every
+    # DEEP_CACHE_INTERVAL steps and only the outer DEEP_CACHE_BRANCH down/up
+    # blocks in between (1 = off). Requests can override the interval
+    DEEP_CACHE_INTERVAL = int(os.getenv('DEEP_CACHE_INTERVAL', 1))
+    DEEP_CACHE_BRANCH = int(os.getenv('DEEP_CACHE_BRANCH', 1))
+    
+    # Device circuit breaker: consecutive device faults before a device is taken
+    # out of service, and how probes bring it back
+    BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 3))
+    BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', 30))
+    BREAKER_MAX_OPEN_SECONDS = float(os.getenv('BREAKER_MAX_OPEN_SECONDS', 600))
+    BREAKER_PROBE_INTERVAL = float(os.getenv('BREAKER_PROBE_INTERVAL', 5))
+    BREAKER_PROBE_SUCCESSES = int(os.getenv('BREAKER_PROBE_SUCCESSES', 3))
+    
+    # Memory watchdog: escalate collect -> trim -> reload only above these
+    # usage percentages (of MEMORY_LIMIT_MB, or host RAM if 0, and of device
+    # memory where the backend reports it). 0 disables a level.
+    MEMORY_WATCHDOG_ENABLED = os.getenv('MEMORY_WATCHDOG_ENABLED', 'True').lower() == 'true'
+    MEMORY_WATCHDOG_INTERVAL = float(os.getenv('MEMORY_WATCHDOG_INTERVAL', 5))
+    MEMORY_LIMIT_MB = int(os.getenv('MEMORY_LIMIT_MB', 0))
+    MEMORY_COLLECT_PERCENT = float(os.getenv('MEMORY_COLLECT_PERCENT', 75))
+    MEMORY_TRIM_PERCENT = float(os.getenv('MEMORY_TRIM_PERCENT', 85))
+    MEMORY_RELOAD_PERCENT = float(os.getenv('MEMORY_RELOAD_PERCENT', 95))
+    MEMORY_ACTION_COOLDOWN = float(os.getenv('MEMORY_ACTION_COOLDOWN', 30))
     
     # File paths
     OUTPUT_DIR = os.path.join(os.path.dirname(__file__), '..', 'generated_images')
     
+    # Image encoding per output target
+    # Level is the PNG compression level (0-9) or WEBP/JPEG quality (0-100);
+    # leave empty for Pillow's default. When both targets match, the image is
+    # encoded only once.
+    RESPONSE_IMAGE_FORMAT = os.getenv('RESPONSE_IMAGE_FORMAT', 'PNG').upper()
+    RESPONSE_IMAGE_LEVEL = int(os.getenv('RESPONSE_IMAGE_LEVEL')) if os.getenv('RESPONSE_IMAGE_LEVEL') else None
+    OUTPUT_IMAGE_FORMAT = os.getenv('OUTPUT_IMAGE_FORMAT', 'PNG').upper()
+    OUTPUT_IMAGE_LEVEL = int(os.getenv('OUTPUT_IMAGE_LEVEL')) if os.getenv('OUTPUT_IMAGE_LEVEL') else None
+    OUTPUT_FSYNC = os.getenv('OUTPUT_FSYNC', 'False').lower() == 'true'
+    POSTPROCESS_WORKERS = int(os.getenv('POSTPROCESS_WORKERS', 2))
+    POSTPROCESS_MAX_PENDING = int(os.getenv('POSTPROCESS_MAX_PENDING', 8))
+    
+    # Output retention (0 = unlimited); eviction runs in a background thread
+    OUTPUT_MAX_AGE_DAYS = float(os.getenv('OUTPUT_MAX_AGE_DAYS', 0))
+    OUTPUT_MAX_COUNT = int(os.getenv('OUTPUT_MAX_COUNT', 0))
+    OUTPUT_MAX_MB = int(os.getenv('OUTPUT_MAX_MB', 0))
+    OUTPUT_RETENTION_INTERVAL = int(os.getenv('OUTPUT_RETENTION_INTERVAL', 300))
+    
+    # Optimized PyTorch execution on CPU: channels_last, torch.compile of the
+    # UNet and VAE decoder (kernels cached in TORCH_COMPILE_CACHE_DIR), bf16
+    # autocast (auto = only with native AVX512-BF16/AMX) and thread pools
+    # (0 = WORKER_CPU_THREADS or torch's default). The warmup absorbs the
+    # compile time at load.
+    CPU_PERF_MODE = os.getenv('CPU_PERF_MODE', 'False').lower() == 'true'
+    CPU_COMPILE = os.getenv('CPU_COMPILE', 'True').lower() == 'true'
+    CPU_COMPILE_MODE = os.getenv('CPU_COMPILE_MODE', 'default')
+    CPU_CHANNELS_LAST = os.getenv('CPU_CHANNELS_LAST', 'True').lower() == 'true'
+    CPU_BF16 = os.getenv('CPU_BF16', 'auto').lower()
+    CPU_INTRA_OP_THREADS = int(os.getenv('CPU_INTRA_OP_THREADS', 0))
+    CPU_INTER_OP_THREADS = int(os.getenv('CPU_INTER_OP_THREADS', 0))
+    CPU_WARMUP = os.getenv('CPU_WARMUP', 'True').lower() == 'true'
+    TORCH_COMPILE_CACHE_DIR = (os.getenv('TORCH_COMPILE_CACHE_DIR')
+                               or os.path.join(os.path.dirname(__file__), '..', 'torch_compile_cache'))
+    
+    # Split the CPU cores (by NUMA node and physical core) into disjoint
+    # groups, each running its own pinned inference stream: 1 = off, a number,
+    # or auto (one stream per CPU_CORES_PER_PARTITION cores, at least one per
+    # NUMA node). Applies whenever a model runs on the CPU device.
+    CPU_PARTITIONS = os.getenv('CPU_PARTITIONS', '1').lower()
+    CPU_CORES_PER_PARTITION = int(os.getenv('CPU_CORES_PER_PARTITION', 8))
+    
+    # Run text encode, UNet loop and VAE decode as separate pipeline stages so
+    # queued jobs overlap; STAGE_QUEUE_SIZE bounds each queue between stages
+    PIPELINED_STAGES = os.getenv('PIPELINED_STAGES', 'False').lower() == 'true'
+    STAGE_QUEUE_SIZE = int(os.getenv('STAGE_QUEUE_SIZE', 2))
+    
+    # Requests with a seed and identical parameters share one in-flight job
+    COALESCE_REQUESTS = os.getenv('COALESCE_REQUESTS', 'True').lower() == 'true'
+    # Finished jobs stay queryable by session for this long
+    JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', 60))
+    # How long a progress stream waits for its request to arrive
+    PROGRESS_WAIT_SECONDS = float(os.getenv('PROGRESS_WAIT_SECONDS', 30))
+    # Progress events kept per job for streams that reconnect (Last-Event-ID),
+    # the reconnect delay suggested to browsers and the heartbeat interval
+    PROGRESS_REPLAY_EVENTS = int(os.getenv('PROGRESS_REPLAY_EVENTS', 64))
+    SSE_RETRY_MS = int(os.getenv('SSE_RETRY_MS', 2000))
+    SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', 15))
+    
+    # Append one JSON line per /api/generate request to this file so real
+    # traffic can be replayed with benchmarks/loadgen.py (empty = off)
+    REQUEST_TRACE_FILE = os.getenv('REQUEST_TRACE_FILE', '')
+    
+    # Per-job timeline traces in Chrome trace-event format, served by
+    # GET /api/jobs/<id>/trace (fraction of jobs sampled; 0 = off)
+    TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.0))
+    TRACE_MAX_TRACES = int(os.getenv('TRACE_MAX_TRACES', 100))
+    TRACE_RETENTION_SECONDS = int(os.getenv('TRACE_RETENTION_SECONDS', 900))
+    # Also write each trace to <dir>/<job id>.json (empty = memory only)
+    TRACE_DIR = os.getenv('TRACE_DIR', '')
+    
+    # Distributed mode: API nodes push jobs to a shared queue and inference
+    # workers (python worker.py) pull them. Backend '' (off, jobs run
+    # in-process), 'sqlite' (QUEUE_URL is a file path, one host or shared
+    # volume) or 'redis' (QUEUE_URL is a redis:// URL)
+    QUEUE_BACKEND = os.getenv('QUEUE_BACKEND', '').lower()
+    QUEUE_URL = os.getenv('QUEUE_URL') or os.path.join(os.path.dirname(__file__), '..', 'queue', 'jobs.db')
+    # How long /api/generate waits for a queued job before answering 202
+    QUEUE_RESULT_TIMEOUT = float(os.getenv('QUEUE_RESULT_TIMEOUT', 600))
+    QUEUE_POLL_SECONDS = float(os.getenv('QUEUE_POLL_SECONDS', 0.25))
+    # Finished queue jobs stay queryable for this long
+    QUEUE_RETENTION_SECONDS = int(os.getenv('QUEUE_RETENTION_SECONDS', 3600))
+    # Workers heartbeat this often; jobs of a worker silent for
+    # QUEUE_WORKER_TIMEOUT are requeued
+    QUEUE_HEARTBEAT_SECONDS = float(os.getenv('QUEUE_HEARTBEAT_SECONDS', 5))
+    QUEUE_WORKER_TIMEOUT = float(os.getenv('QUEUE_WORKER_TIMEOUT', 60))
+    # Put the base64 image in queued results; off = results only reference
+    # image_url (the output store must then be shared between nodes)
+    QUEUE_INLINE_IMAGES = os.getenv('QUEUE_INLINE_IMAGES', 'True').lower() == 'true'
+    
+    # Load shedding for requests sent with "allow_degrade": the highest
+    # LOAD_SHED_LEVELS entry (JSON list) whose "at" the pressure reached
+    # applies; LOAD_SHED_SIGNAL is 'wait' (estimated seconds) or 'depth'
+    # (queued + running jobs). 429 from LOAD_SHED_REJECT_AT (0 = never)
+    LOAD_SHED = os.getenv('LOAD_SHED', 'False').lower() == 'true'
+    LOAD_SHED_SIGNAL = os.getenv('LOAD_SHED_SIGNAL', 'wait').lower()
+    LOAD_SHED_LEVELS = os.getenv('LOAD_SHED_LEVELS') or (
+        '[{"at": 30, "max_steps": 30}, '
+        '{"at": 60, "max_steps": 20, "max_size": 768, "guidance_truncation": 0.3}, '
+        '{"at": 120, "max_steps": 15, "max_size": 512, "guidance_truncation": 0.5, "deep_cache_interval": 3}]'
+    )
+    LOAD_SHED_REJECT_AT = float(os.getenv('LOAD_SHED_REJECT_AT', 300))
+    LOAD_SHED_CAPACITY = int(os.getenv('LOAD_SHED_CAPACITY', 1))
+    LOAD_SHED_JOB_SECONDS = float(os.getenv('LOAD_SHED_JOB_SECONDS', 10))
+    
+    # History gallery thumbnails (WebP, built on a background thread pool)
+    THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', 256))
+    THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', 70))
+    THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', 2))
+    HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 24))
+    HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', 100))
+    
     @classmethod
     def validate(cls):
         """Validate configuration settings"""
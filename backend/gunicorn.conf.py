@@ -0,0 +1,36 @@
+# Copyright 2025 by trongton@gmail.com
+
+"""Gunicorn settings for pre-fork multi-worker serving
+
+    cd backend
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is imported once in the master (``preload_app``) and wsgi.py reads the
+model weights there, uncompiled. Forked workers share those pages copy-on-write
+and each compiles its own pipeline in ``post_fork``.
+"""
+
+from config import Config
+
+bind = f"{Config.HOST}:{Config.PORT}"
+workers = Config.WEB_WORKERS
+# Threads keep SSE progress streams and polls responsive while a job runs
+worker_class = 'gthread'
+threads = Config.WEB_THREADS
+# Generations can take minutes on CPU
+timeout = Config.WEB_TIMEOUT
+graceful_timeout = 60
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # Lowest index no live worker holds, so a respawned worker takes over the
+    # cores of the one it replaces (CPU_PARTITIONS)
+    taken = {getattr(other, 'cpu_index', None) for other in server.WORKERS.values()}
+    worker.cpu_index = next(index for index in range(len(taken) + 1) if index not in taken)
+
+
+def post_fork(server, worker):
+    from app import init_worker
+    init_worker(server.cfg.workers, worker.cpu_index)
+    server.log.info(f"Worker {worker.pid} initialized ({server.cfg.workers} workers)")
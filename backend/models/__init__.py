@@ -2,5 +2,12 @@
 
 from .sd_model import StableDiffusionModel
 from .sd_model_openvino import StableDiffusionModelOpenVINO
+from .fake_model import FakeStableDiffusionModel
+from .cpu_partition import PartitionedCPUModel, partition_count, partition_cpus, cpu_topology, pin_current_thread
+from .device_health import classify_error, add_breaker_listener, breaker_status
 
-__all__ = ['StableDiffusionModel', 'StableDiffusionModelOpenVINO']
+__all__ = [
+    'StableDiffusionModel', 'StableDiffusionModelOpenVINO', 'FakeStableDiffusionModel',
+    'PartitionedCPUModel', 'partition_count', 'partition_cpus', 'cpu_topology', 'pin_current_thread',
+    'classify_error', 'add_breaker_listener', 'breaker_status'
+]
@@ -0,0 +1,302 @@
+# Copyright 2025 by trongton@gmail.com
+
+import glob
+import os
+import queue
+import re
+import threading
+from concurrent.futures import Future
+from config import Config
+from services.tracing import bind, span
+
+
+def parse_cpulist(text):
+    """CPU ids of a sysfs cpulist such as ``0-7,16-23``"""
+    cpus = []
+    for item in text.strip().split(','):
+        if not item:
+            continue
+        if '-' in item:
+            start, end = item.split('-', 1)
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(item))
+    return cpus
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def allowed_cpus():
+    """CPUs this process may run on (taskset / cgroup cpusets respected)"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def cpu_topology():
+    """Physical cores of the allowed CPUs grouped by NUMA node
+
+    Returns ``[[core, ...], ...]`` with one list per node and each core a tuple
+    of its logical CPUs (hyperthread siblings). Without sysfs every CPU is its
+    own core on a single node.
+    """
+    allowed = set(allowed_cpus())
+
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*'),
+                       key=lambda p: int(re.search(r'(\d+)$', p).group(1))):
+        cpus = [cpu for cpu in parse_cpulist(_read(os.path.join(path, 'cpulist')) or '') if cpu in allowed]
+        if cpus:
+            nodes.append(cpus)
+    if not nodes:
+        nodes = [sorted(allowed)]
+
+    topology = []
+    for cpus in nodes:
+        cores, seen = [], set()
+        for cpu in cpus:
+            if cpu in seen:
+                continue
+            siblings = _read(f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list')
+            core = tuple(c for c in parse_cpulist(siblings) if c in allowed) if siblings else (cpu,)
+            core = core or (cpu,)
+            seen.update(core)
+            cores.append(core)
+        topology.append(cores)
+    return topology
+
+
+class CPUPartition:
+    """A disjoint group of whole cores running one inference stream"""
+
+    def __init__(self, index, cores, nodes):
+        self.index = index
+        self.cores = cores
+        self.cpus = sorted(cpu for core in cores for cpu in core)
+        self.nodes = sorted(nodes)
+
+    @property
+    def threads(self):
+        # One compute thread per physical core; siblings share its FPUs
+        return len(self.cores)
+
+    def status(self):
+        return {'index': self.index, 'cpus': self.cpus, 'threads': self.threads, 'nodes': self.nodes}
+
+
+def partition_count(setting, topology):
+    """Resolve CPU_PARTITIONS ('auto' or a number) against the topology
+
+    Auto gives every NUMA node at least one stream and otherwise one stream
+    per CPU_CORES_PER_PARTITION physical cores; the UNet scales poorly past
+    that many threads, so more streams give more aggregate throughput.
+    """
+    cores = sum(len(node) for node in topology)
+    if str(setting).lower() == 'auto':
+        count = max(len(topology), cores // max(1, Config.CPU_CORES_PER_PARTITION))
+    else:
+        count = int(setting)
+    return max(1, min(count, cores))
+
+
+def partition_cpus(count, topology=None):
+    """Split the cores into ``count`` disjoint groups
+
+    Cores are taken in node order and cut into contiguous runs of near-equal
+    size, so a group stays within one NUMA node whenever the node sizes allow.
+    """
+    topology = topology or cpu_topology()
+    ordered = [(node, core) for node, cores in enumerate(topology) for core in cores]
+    count = max(1, min(count, len(ordered)))
+    base, extra = divmod(len(ordered), count)
+
+    partitions, start = [], 0
+    for index in range(count):
+        size = base + (1 if index < extra else 0)
+        chunk = ordered[start:start + size]
+        start += size
+        partitions.append(CPUPartition(index, [core for _, core in chunk], {node for node, _ in chunk}))
+    return partitions
+
+
+def pin_current_thread(cpus):
+    """Restrict the calling thread (and threads it creates later) to ``cpus``"""
+    try:
+        os.sched_setaffinity(0, cpus)
+        return True
+    except (AttributeError, OSError) as e:
+        print(f"[PARTITION] Could not pin thread to CPUs {cpus}: {e}")
+        return False
+
+
+class _Stream:
+    """One partition: a pinned thread that owns one wrapper and runs its calls"""
+
+    def __init__(self, partition, model):
+        self.partition = partition
+        self.model = model
+        self.completed = 0
+        self.pinned = False
+        self._inbox = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run,
+            name=f"cpu-stream-{partition.index}",
+            daemon=True
+        )
+        self._thread.start()
+
+    def call(self, fn):
+        """Run ``fn(model)`` on the stream thread and return its result"""
+        future = Future()
+        self._inbox.put((fn, future))
+        return future.result()
+
+    def submit(self, fn):
+        future = Future()
+        self._inbox.put((fn, future))
+        return future
+
+    def _run(self):
+        # Pin before anything runs here: torch's OpenMP team and OpenVINO's
+        # executor threads are created by this thread and inherit its mask
+        self.pinned = pin_current_thread(self.partition.cpus)
+        while True:
+            fn, future = self._inbox.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(self.model))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class PartitionedCPUModel:
+    """Several pinned CPU inference streams behind the wrapper interface
+
+    Each partition gets its own wrapper (from ``model_factory``) with
+    ``cpu_threads`` equal to its core count, and a thread pinned to its cores
+    on which that wrapper is loaded and run. A generation goes to whichever
+    stream is idle first, so up to ``len(partitions)`` generations run at
+    once without oversubscribing the cores. PyTorch wrappers share one copy
+    of the weights; OpenVINO IR is memory-mapped and shared by the kernel.
+    """
+
+    def __init__(self, model_factory, partitions, device='cpu', model_id=None):
+        self.device = device
+        self.preferred_device = device
+        self.model_id = model_id or Config.MODEL_ID
+        self.allow_cpu_fallback = False
+        self._factory = model_factory
+        self._start_streams(partitions, [])
+
+    def _start_streams(self, partitions, models):
+        """One stream per partition, reusing ``models`` in order before creating new wrappers"""
+        self.partitions = partitions
+        self._streams = []
+        self._idle = queue.Queue()
+        for index, partition in enumerate(partitions):
+            model = models[index] if index < len(models) else self._factory()
+            model.cpu_threads = partition.threads
+            model.allow_cpu_fallback = False
+            if hasattr(model, 'cpu_pinned'):
+                model.cpu_pinned = True
+            if index:
+                # Every stream samples the same process: one watchdog thread
+                model.memory_watchdog = self._streams[0].model.memory_watchdog
+            stream = _Stream(partition, model)
+            self._streams.append(stream)
+            self._idle.put(stream)
+        print(f"[PARTITION] {len(partitions)} CPU streams: "
+              + ', '.join(f"{len(p.cpus)} CPUs/{p.threads} threads" for p in partitions))
+
+    def repartition(self, partitions):
+        """Restart the streams on ``partitions``, e.g. a gunicorn worker's own cores
+
+        Threads do not survive fork(), so a wrapper built in the master needs
+        this in the worker before it loads; the first wrapper keeps the
+        weights read before the fork.
+        """
+        if self.model_loaded:
+            raise RuntimeError("Cannot repartition a loaded model")
+        self._start_streams(partitions, [stream.model for stream in self._streams])
+
+    @property
+    def model_loaded(self):
+        return all(stream.model.model_loaded for stream in self._streams)
+
+    @property
+    def memory_watchdog(self):
+        # Every stream samples the same host memory
+        return self._streams[0].model.memory_watchdog
+
+    @property
+    def breaker(self):
+        return None
+
+    def device_healthy(self):
+        return True
+
+    def load_weights(self):
+        """Read the weights once; other streams share them where the backend allows"""
+        first = self._streams[0].model
+        first.load_weights()
+        for stream in self._streams[1:]:
+            if stream.model.pipe is None and hasattr(first, 'shared_pipeline'):
+                stream.model.pipe = first.shared_pipeline()
+
+    def load_model(self):
+        """Load every stream on its own pinned thread (in parallel)
+
+        With CPU_PERF_MODE the streams share the UNet and VAE that
+        ``torch.compile`` wraps, and concurrent Dynamo compiles of one module
+        are not thread-safe: the first stream compiles and warms up alone,
+        the others then take its compiled modules and load one after another.
+        """
+        if self.model_loaded:
+            return
+        self.load_weights()
+        first = self._streams[0]
+        if getattr(first.model, 'cpu_perf', None) is not None:
+            first.call(lambda model: model.load_model())
+            for stream in self._streams[1:]:
+                stream.model.pipe = first.model.shared_pipeline()
+                stream.call(lambda model: model.load_model())
+            return
+        futures = [stream.submit(lambda model: model.load_model()) for stream in self._streams]
+        for future in futures:
+            future.result()
+
+    def generate_image(self, **kwargs):
+        with span('partition.wait', cat='queue'):
+            stream = self._idle.get()
+        try:
+            image = stream.call(bind(lambda model: model.generate_image(**kwargs)))
+            stream.completed += 1
+            return image
+        finally:
+            self._idle.put(stream)
+
+    def unload_model(self):
+        futures = [stream.submit(lambda model: model.unload_model()) for stream in self._streams]
+        for future in futures:
+            future.result()
+
+    def image_to_base64(self, image):
+        return self._streams[0].model.image_to_base64(image)
+
+    def status(self):
+        return {
+            'streams': [
+                dict(stream.partition.status(), pinned=stream.pinned, completed=stream.completed,
+                     loaded=stream.model.model_loaded)
+                for stream in self._streams
+            ],
+            'idle': self._idle.qsize()
+        }
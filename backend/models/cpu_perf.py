@@ -0,0 +1,133 @@
+# Copyright 2025 by trongton@gmail.com
+
+import contextlib
+import os
+import time
+import torch
+from config import Config
+
+
+def cpu_supports_bf16():
+    """Whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX)"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+        return 'avx512_bf16' in flags or 'amx_bf16' in flags
+    except OSError:
+        pass
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+
+def configure_torch_threads(intra_op=0, inter_op=0):
+    """Set torch's intra-op and inter-op pool sizes (0 leaves a pool as is)
+
+    Inter-op threads can only be set before the first parallel region runs in
+    the process; later attempts keep the current value.
+    """
+    if intra_op:
+        torch.set_num_threads(intra_op)
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError as e:
+            print(f"[CPU-PERF] Inter-op threads already fixed for this process: {e}")
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def enable_compile_cache(cache_dir):
+    """Keep Inductor's generated kernels and FX graphs across restarts"""
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+
+
+def is_compiled(module):
+    """Whether ``module`` is already a ``torch.compile`` wrapper"""
+    return hasattr(module, '_orig_mod')
+
+
+class CPUPerfMode:
+    """Optimized CPU execution of the PyTorch pipeline (CPU_PERF_MODE=True)
+
+    Puts the UNet and VAE in channels_last layout, compiles them with
+    ``torch.compile`` (kernels cached in TORCH_COMPILE_CACHE_DIR), runs
+    inference under bfloat16 autocast when the CPU has native bf16 and sizes
+    torch's thread pools. Compilation happens on the first call, so ``warmup``
+    runs a short generation at the default size while the model loads.
+    """
+
+    def __init__(self):
+        self.compile = Config.CPU_COMPILE
+        self.compile_mode = Config.CPU_COMPILE_MODE
+        self.channels_last = Config.CPU_CHANNELS_LAST
+        if Config.CPU_BF16 == 'auto':
+            self.bf16 = cpu_supports_bf16()
+        else:
+            self.bf16 = Config.CPU_BF16 == 'true'
+        self.intra_op_threads = Config.CPU_INTRA_OP_THREADS
+        self.inter_op_threads = Config.CPU_INTER_OP_THREADS
+        self.threads = None
+        self.warmup_seconds = None
+
+    def apply(self, pipe, cpu_threads=None):
+        """Prepare a pipeline that is already on the CPU"""
+        self.threads = configure_torch_threads(
+            self.intra_op_threads or cpu_threads or 0,
+            self.inter_op_threads
+        )
+
+        if self.channels_last:
+            pipe.unet.to(memory_format=torch.channels_last)
+            pipe.vae.to(memory_format=torch.channels_last)
+
+        if self.compile:
+            enable_compile_cache(Config.TORCH_COMPILE_CACHE_DIR)
+            mode = None if self.compile_mode == 'default' else self.compile_mode
+            # Pipelines sharing their modules (CPU partitions) reuse the
+            # first compile instead of wrapping it again
+            if not is_compiled(pipe.unet):
+                pipe.unet = torch.compile(pipe.unet, mode=mode)
+            if not is_compiled(pipe.vae.decoder):
+                pipe.vae.decoder = torch.compile(pipe.vae.decoder, mode=mode)
+
+        print(f"[CPU-PERF] threads={self.threads[0]}/{self.threads[1]} (intra/inter), "
+              f"channels_last={self.channels_last}, compile={self.compile}, bf16={self.bf16}")
+
+    def autocast(self):
+        """Context for inference calls: bf16 autocast when enabled"""
+        if self.bf16:
+            return torch.autocast('cpu', dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def warmup(self, pipe, steps=2):
+        """Run a short generation so compilation does not land on the first request"""
+        start = time.time()
+        with torch.inference_mode(), self.autocast():
+            pipe(
+                prompt="warmup",
+                width=Config.DEFAULT_WIDTH,
+                height=Config.DEFAULT_HEIGHT,
+                num_inference_steps=steps,
+                guidance_scale=Config.DEFAULT_GUIDANCE_SCALE
+            )
+        self.warmup_seconds = time.time() - start
+        print(f"[CPU-PERF] Warmup finished in {self.warmup_seconds:.1f} seconds")
+
+    def status(self):
+        return {
+            'compile': self.compile,
+            'compile_mode': self.compile_mode,
+            'channels_last': self.channels_last,
+            'bf16': self.bf16,
+            'threads': self.threads,
+            'warmup_seconds': round(self.warmup_seconds, 2) if self.warmup_seconds else None
+        }
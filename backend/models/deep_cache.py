@@ -0,0 +1,161 @@
+# Copyright 2025 by trongton@gmail.com
+
+import contextlib
+import threading
+import time
+
+# Cache of the generation running on the current thread; the UNet modules are
+# shared (stages, CPU partitions), so the hooks look it up per call
+_local = threading.local()
+_install_lock = threading.Lock()
+
+
+def _blocks(unet):
+    """Down blocks, mid block and up blocks of a diffusers UNet, or None if it cannot be split"""
+    unet = getattr(unet, '_orig_mod', unet)
+    down = getattr(unet, 'down_blocks', None)
+    up = getattr(unet, 'up_blocks', None)
+    mid = getattr(unet, 'mid_block', None)
+    if down is None or up is None or mid is None or len(down) != len(up):
+        return None
+    return down, mid, up
+
+
+def _install(unet):
+    """Route the UNet's block calls through the thread's active cache (once per UNet)"""
+    with _install_lock:
+        if not getattr(unet, '_deep_cache_hooks', False):
+            _install_hooks(unet)
+
+
+def _install_hooks(unet):
+    down, mid, up = _blocks(unet)
+    modules = [(f'down.{i}', block) for i, block in enumerate(down)]
+    modules += [('mid', mid)] + [(f'up.{i}', block) for i, block in enumerate(up)]
+    for name, module in modules:
+        original = module.forward
+
+        def forward(*args, _name=name, _original=original, **kwargs):
+            cache = getattr(_local, 'cache', None)
+            if cache is None:
+                return _original(*args, **kwargs)
+            return cache.call(_name, _original, args, kwargs)
+        module.forward = forward
+
+    original = unet.forward
+
+    def unet_forward(*args, **kwargs):
+        cache = getattr(_local, 'cache', None)
+        if cache is None:
+            return original(*args, **kwargs)
+        sample = args[0] if args else kwargs['sample']
+        cache.begin(sample)
+        try:
+            return original(*args, **kwargs)
+        finally:
+            cache.end()
+    unet.forward = unet_forward
+    unet._deep_cache_hooks = True
+
+
+class DeepCache:
+    """Reuse of the UNet's deep features between adjacent steps (DeepCache)
+
+    High-level features change slowly from one timestep to the next, so only
+    every ``interval``-th UNet call runs the whole network. The calls in
+    between run the shallow branch (conv in, the first ``branch`` down blocks,
+    the last ``branch`` up blocks, conv out) at full resolution and take the
+    outputs of the deeper blocks from the last full call. A change of the
+    input shape (guidance truncation halves the batch) forces a full call.
+
+    Needs a diffusers UNet made of blocks; an OpenVINO UNet is one compiled
+    graph and a ``torch.compile``'d UNet would recompile on every switch, so
+    both run every call in full and the stats say why.
+    """
+
+    def __init__(self, interval=3, branch=1):
+        self.interval = max(1, int(interval))
+        self.branch = max(1, int(branch))
+        self.supported = True
+        self.reason = None
+        self.full_calls = 0
+        self.cached_calls = 0
+        self._full_time = 0.0
+        self._cached_time = 0.0
+        self._deep = set()
+        self._outputs = {}
+        self._shape = None
+        self._reuse = False
+        self._started = None
+
+    @contextlib.contextmanager
+    def watch(self, pipe):
+        """Apply the cache to the UNet calls made on this thread during ``pipe(...)``"""
+        unet = pipe.unet
+        blocks = _blocks(unet)
+        if blocks is None:
+            self.supported = False
+            self.reason = 'UNet cannot be split into blocks (OpenVINO runs it as one compiled model)'
+        elif hasattr(unet, '_orig_mod'):
+            self.supported = False
+            self.reason = 'torch.compile\'d UNet (CPU_COMPILE) would recompile when the cache switches'
+        if not self.supported or self.interval == 1:
+            yield
+            return
+
+        down, mid, up = blocks
+        branch = min(self.branch, len(down) - 1)
+        self._deep = {f'down.{i}' for i in range(branch, len(down))}
+        self._deep |= {'mid'} | {f'up.{i}' for i in range(len(up) - branch)}
+        _install(unet)
+        _local.cache = self
+        try:
+            yield
+        finally:
+            _local.cache = None
+            self._outputs = {}
+
+    def begin(self, sample):
+        calls = self.full_calls + self.cached_calls
+        shape = tuple(sample.shape)
+        self._reuse = calls % self.interval != 0 and shape == self._shape and bool(self._outputs)
+        if not self._reuse:
+            self._shape = shape
+        self._started = time.perf_counter()
+
+    def end(self):
+        elapsed = time.perf_counter() - self._started
+        if self._reuse:
+            self.cached_calls += 1
+            self._cached_time += elapsed
+        else:
+            self.full_calls += 1
+            self._full_time += elapsed
+
+    def call(self, name, original, args, kwargs):
+        if name not in self._deep:
+            return original(*args, **kwargs)
+        if self._reuse:
+            return self._outputs[name]
+        output = original(*args, **kwargs)
+        self._outputs[name] = output
+        return output
+
+    def stats(self):
+        full_time = self._full_time / self.full_calls if self.full_calls else None
+        cached_time = self._cached_time / self.cached_calls if self.cached_calls else None
+        calls = self.full_calls + self.cached_calls
+        measured = None
+        if full_time and cached_time:
+            measured = round(full_time * calls / (self._full_time + self._cached_time), 3)
+        return {
+            'interval': self.interval,
+            'branch': self.branch,
+            'supported': self.supported,
+            'reason': self.reason,
+            'full_calls': self.full_calls,
+            'cached_calls': self.cached_calls,
+            'full_call_time': round(full_time, 4) if full_time else None,
+            'cached_call_time': round(cached_time, 4) if cached_time else None,
+            'measured_speedup': measured
+        }
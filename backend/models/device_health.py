@@ -0,0 +1,312 @@
+# Copyright 2025 by trongton@gmail.com
+
+import re
+import threading
+import time
+from config import Config
+from services.metrics import metrics
+
+
+class DeviceErrorInfo:
+    """Structured classification of an exception raised by a device"""
+
+    def __init__(self, category, code=None, device_fault=False, retryable=False):
+        self.category = category
+        self.code = code
+        self.device_fault = device_fault
+        self.retryable = retryable
+
+    def to_dict(self):
+        return {
+            'category': self.category,
+            'code': self.code,
+            'device_fault': self.device_fault,
+            'retryable': self.retryable
+        }
+
+    def __repr__(self):
+        return f"DeviceErrorInfo({self.category}, code={self.code})"
+
+
+# OpenCL status names and numeric codes reported by the OpenVINO GPU plugin
+_OPENCL_ERRORS = {
+    'CL_DEVICE_NOT_AVAILABLE': (-2, 'device_lost', False),
+    'CL_MEM_OBJECT_ALLOCATION_FAILURE': (-4, 'out_of_memory', True),
+    'CL_OUT_OF_RESOURCES': (-5, 'out_of_memory', True),
+    'CL_OUT_OF_HOST_MEMORY': (-6, 'out_of_memory', True),
+    'CL_EXEC_STATUS_ERROR_FOR_EVENTS_IN_WAIT_LIST': (-14, 'execution_failed', True),
+    'CL_INVALID_COMMAND_QUEUE': (-36, 'device_lost', False),
+}
+_OPENCL_CODES = {code: (name, category, retryable) for name, (code, category, retryable) in _OPENCL_ERRORS.items()}
+_OPENCL_CALL_RE = re.compile(r'\b(clFlush|clFinish|clWaitForEvents|clEnqueue\w+)\b', re.IGNORECASE)
+_OPENCL_CODE_RE = re.compile(r'\berror(?: code)?[:\s]+(-\d+)\b', re.IGNORECASE)
+
+
+def classify_error(error):
+    """Classify an exception so only real device faults count against a device"""
+    if isinstance(error, StopIteration):
+        return DeviceErrorInfo('cancelled')
+
+    if isinstance(error, MemoryError):
+        return DeviceErrorInfo('host_out_of_memory', device_fault=False, retryable=False)
+
+    try:
+        import torch
+        oom_type = getattr(torch.cuda, 'OutOfMemoryError', None)
+        if oom_type is not None and isinstance(error, oom_type):
+            return DeviceErrorInfo('out_of_memory', code='CUDA_OOM', device_fault=True, retryable=True)
+    except Exception:
+        pass
+
+    message = str(error)
+    upper = message.upper()
+
+    for name, (code, category, retryable) in _OPENCL_ERRORS.items():
+        if name in upper:
+            return DeviceErrorInfo(category, code=name, device_fault=True, retryable=retryable)
+
+    match = _OPENCL_CODE_RE.search(message)
+    if match and int(match.group(1)) in _OPENCL_CODES:
+        name, category, retryable = _OPENCL_CODES[int(match.group(1))]
+        return DeviceErrorInfo(category, code=name, device_fault=True, retryable=retryable)
+
+    call = _OPENCL_CALL_RE.search(message)
+    if call:
+        return DeviceErrorInfo('execution_failed', code=call.group(1), device_fault=True, retryable=True)
+
+    if 'CUDA ERROR' in upper or 'CUDNN_STATUS' in upper:
+        return DeviceErrorInfo('execution_failed', code='CUDA', device_fault=True, retryable=True)
+    if 'DEVICE LOST' in upper or 'DEVICE_LOST' in upper:
+        return DeviceErrorInfo('device_lost', device_fault=True, retryable=False)
+    if 'INTEL_GPU' in upper:
+        # Exceptions thrown from src/plugins/intel_gpu without an OpenCL status
+        return DeviceErrorInfo('execution_failed', code='intel_gpu', device_fault=True, retryable=True)
+
+    return DeviceErrorInfo('other')
+
+
+class CircuitBreaker:
+    """Closed / open / half-open health state of one device
+
+    Consecutive device faults open the breaker and traffic moves elsewhere.
+    After ``open_seconds`` it goes half-open and a background thread runs cheap
+    probe inferences; ``probe_successes`` passes in a row close it again, while
+    a failed probe re-opens it with exponential backoff up to
+    ``max_open_seconds``. Listeners are told about every transition.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    _STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, device, probe_fn=None, failure_threshold=None, open_seconds=None,
+                 max_open_seconds=None, probe_interval=None, probe_successes=None):
+        self.device = device
+        self.probe_fn = probe_fn
+        self.failure_threshold = failure_threshold or Config.BREAKER_FAILURE_THRESHOLD
+        self.base_open_seconds = open_seconds or Config.BREAKER_OPEN_SECONDS
+        self.max_open_seconds = max_open_seconds or Config.BREAKER_MAX_OPEN_SECONDS
+        self.probe_interval = probe_interval or Config.BREAKER_PROBE_INTERVAL
+        self.probe_successes = probe_successes or Config.BREAKER_PROBE_SUCCESSES
+
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._probe_passes = 0
+        self._open_seconds = self.base_open_seconds
+        self._opened_at = None
+        self._last_error = None
+        self._transitions = []
+        self._listeners = []
+        self._probe_thread = None
+        metrics.set_gauge(f'breaker.{device}.state', 0)
+
+    def add_listener(self, listener):
+        """Register ``listener(device, old_state, new_state)``"""
+        with self._lock:
+            if listener not in self._listeners:
+                self._listeners.append(listener)
+
+    def allow(self):
+        """Whether real traffic may use the device right now"""
+        with self._lock:
+            if self.state == self.OPEN and time.time() - self._opened_at >= self._open_seconds:
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                self._start_probing()
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+
+    def record_failure(self, error_info, message=None):
+        """Count a classified error; non-device errors are ignored. Returns the new state"""
+        if not error_info.device_fault:
+            return self.state
+        metrics.inc(f'breaker.{self.device}.failures')
+        with self._lock:
+            self._last_error = {
+                'time': time.time(),
+                'message': (message or '')[:300],
+                **error_info.to_dict()
+            }
+            self._consecutive_failures += 1
+            # Lost devices do not come back on a retry, open right away
+            if (self.state == self.CLOSED
+                    and (self._consecutive_failures >= self.failure_threshold
+                         or error_info.category == 'device_lost')):
+                self._open()
+            return self.state
+
+    def status(self):
+        with self._lock:
+            return {
+                'device': self.device,
+                'state': self.state,
+                'consecutive_failures': self._consecutive_failures,
+                'open_seconds': self._open_seconds,
+                'opened_at': self._opened_at,
+                'probe_passes': self._probe_passes,
+                'last_error': self._last_error,
+                'transitions': list(self._transitions[-20:])
+            }
+
+    def _open(self):
+        self._opened_at = time.time()
+        self._probe_passes = 0
+        self._transition(self.OPEN)
+        # Go half-open on schedule even if no request asks about this device
+        timer = threading.Timer(self._open_seconds, self.allow)
+        timer.daemon = True
+        timer.start()
+
+    def _transition(self, new_state):
+        old_state = self.state
+        if old_state == new_state:
+            return
+        self.state = new_state
+        self._transitions.append({'time': time.time(), 'from': old_state, 'to': new_state})
+        metrics.inc(f'breaker.{self.device}.transitions')
+        metrics.set_gauge(f'breaker.{self.device}.state', self._STATE_GAUGE[new_state])
+        print(f"[BREAKER] {self.device}: {old_state} -> {new_state}")
+        listeners = list(self._listeners)
+        # Listeners may take locks of their own; never call them under ours
+        threading.Thread(
+            target=self._notify,
+            args=(listeners, old_state, new_state),
+            daemon=True
+        ).start()
+
+    def _notify(self, listeners, old_state, new_state):
+        for listener in listeners:
+            try:
+                listener(self.device, old_state, new_state)
+            except Exception as e:
+                print(f"[BREAKER] Listener failed: {e}")
+
+    def _start_probing(self):
+        if self.probe_fn is None:
+            return
+        if self._probe_thread is not None and self._probe_thread.is_alive():
+            return
+        self._probe_thread = threading.Thread(
+            target=self._probe_loop,
+            name=f"breaker-probe-{self.device}",
+            daemon=True
+        )
+        self._probe_thread.start()
+
+    def _probe_loop(self):
+        while True:
+            with self._lock:
+                if self.state != self.HALF_OPEN:
+                    return
+            try:
+                with metrics.time(f'breaker.{self.device}.probe_time'):
+                    self.probe_fn(self.device)
+                ok = True
+            except Exception as e:
+                ok = False
+                probe_error = e
+
+            with self._lock:
+                if self.state != self.HALF_OPEN:
+                    return
+                if ok:
+                    metrics.inc(f'breaker.{self.device}.probe_successes')
+                    self._probe_passes += 1
+                    if self._probe_passes >= self.probe_successes:
+                        self._consecutive_failures = 0
+                        self._open_seconds = self.base_open_seconds
+                        self._transition(self.CLOSED)
+                        return
+                else:
+                    metrics.inc(f'breaker.{self.device}.probe_failures')
+                    print(f"[BREAKER] Probe on {self.device} failed: {probe_error}")
+                    self._open_seconds = min(self._open_seconds * 2, self.max_open_seconds)
+                    self._open()
+                    return
+            time.sleep(self.probe_interval)
+
+
+def openvino_probe(device):
+    """Compile and run a tiny model on an OpenVINO device"""
+    import numpy as np
+    import openvino as ov
+    try:
+        from openvino import opset13 as ops
+    except ImportError:
+        from openvino.runtime import opset13 as ops
+
+    data = ops.parameter([1, 64], np.float32, name='x')
+    weights = ops.constant(np.ones((64, 64), dtype=np.float32))
+    model = ov.Model([ops.relu(ops.matmul(data, weights, False, False))], [data], 'probe')
+    compiled = ov.Core().compile_model(model, device)
+    result = compiled(np.ones((1, 64), dtype=np.float32))[0]
+    if not np.allclose(result, 64.0):
+        raise RuntimeError(f"Probe returned unexpected values on {device}")
+
+
+def torch_probe(device):
+    """Run a small matmul on a PyTorch device"""
+    import torch
+    x = torch.ones((64, 64), device=device)
+    result = (x @ x).sum().item()
+    if result != 64 * 64 * 64:
+        raise RuntimeError(f"Probe returned unexpected values on {device}")
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+_global_listeners = []
+
+
+def add_breaker_listener(listener):
+    """Register ``listener(device, old_state, new_state)`` on every current and future breaker"""
+    with _breakers_lock:
+        _global_listeners.append(listener)
+        breakers = list(_breakers.values())
+    for breaker in breakers:
+        breaker.add_listener(listener)
+
+
+def get_breaker(device, probe_fn=None):
+    """Process-wide breaker for ``device`` (created on first use)"""
+    with _breakers_lock:
+        breaker = _breakers.get(device)
+        if breaker is None:
+            breaker = CircuitBreaker(device, probe_fn=probe_fn)
+            for listener in _global_listeners:
+                breaker.add_listener(listener)
+            _breakers[device] = breaker
+        elif probe_fn is not None and breaker.probe_fn is None:
+            breaker.probe_fn = probe_fn
+        return breaker
+
+
+def breaker_status():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.device: breaker.status() for breaker in breakers}
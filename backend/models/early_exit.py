@@ -0,0 +1,153 @@
+# Copyright 2025 by trongton@gmail.com
+
+import contextlib
+from types import SimpleNamespace
+from .stages import decode_latents
+
+
+class ConvergedEarly(Exception):
+    """Raised from the step callback to leave the denoising loop; carries what to decode"""
+
+    def __init__(self, latents):
+        super().__init__("Denoising converged")
+        self.latents = latents
+
+
+def _norm(tensor):
+    if isinstance(tensor, (int, float)):
+        return abs(tensor)
+    if hasattr(tensor, 'float'):
+        # Sum of squares in fp32: fp16 overflows on a full latent
+        tensor = tensor.float()
+    return float((tensor * tensor).sum()) ** 0.5
+
+
+def _x0_from_model_output(scheduler, model_output, timestep, sample):
+    """Predicted clean latents of a DDPM-family step (PNDM, DDIM, DPM-Solver)
+
+    Returns None for schedulers working on sigma-scaled samples (the Euler
+    family reports ``pred_original_sample`` itself) or unknown prediction types.
+    """
+    alphas_cumprod = getattr(scheduler, 'alphas_cumprod', None)
+    if alphas_cumprod is None or float(getattr(scheduler, 'init_noise_sigma', 1.0)) != 1.0:
+        return None
+    alpha = float(alphas_cumprod[int(timestep)])
+    prediction_type = getattr(scheduler.config, 'prediction_type', 'epsilon')
+    if prediction_type == 'epsilon':
+        return (sample - (1 - alpha) ** 0.5 * model_output) / alpha ** 0.5
+    if prediction_type == 'v_prediction':
+        return alpha ** 0.5 * sample - (1 - alpha) ** 0.5 * model_output
+    if prediction_type == 'sample':
+        return model_output
+    return None
+
+
+class EarlyExitPolicy:
+    """Stops the denoising loop once the image stops changing
+
+    After every step the relative change of the predicted clean latents (x0,
+    taken from the scheduler) is compared with the previous step, or of the
+    latents themselves when the scheduler gives no x0. Once it stays below
+    ``threshold`` for ``patience`` consecutive steps, and at least
+    ``min_steps`` have run, the loop ends and the last x0 estimate is decoded
+    instead of running the remaining steps.
+    """
+
+    def __init__(self, num_inference_steps, threshold=0.01, patience=3, min_steps=20):
+        self.num_steps = num_inference_steps
+        self.threshold = float(threshold)
+        self.patience = max(1, int(patience))
+        self.min_steps = min(max(1, int(min_steps)), num_inference_steps)
+        self.steps_used = 0
+        self.exited = False
+        self.signal = None
+        self.changes = []
+        self._x0 = None
+        self._previous = None
+        self._calm = 0
+
+    @contextlib.contextmanager
+    def watch(self, pipe):
+        """Capture the scheduler's x0 prediction of each step during ``pipe(...)``"""
+        scheduler = pipe.scheduler
+        original = scheduler.step
+
+        def step(model_output, timestep, sample, *args, **kwargs):
+            output = original(model_output, timestep, sample, *args, **kwargs)
+            if isinstance(output, tuple):
+                x0 = output[1] if len(output) > 1 else None
+            else:
+                x0 = getattr(output, 'pred_original_sample', None)
+            if x0 is None:
+                x0 = _x0_from_model_output(scheduler, model_output, timestep, sample)
+            self._x0 = x0
+            return output
+
+        patched = 'step' in vars(scheduler)
+        scheduler.step = step
+        try:
+            yield
+        finally:
+            if patched:
+                scheduler.step = original
+            else:
+                del scheduler.step
+
+    def on_step(self, step, latents, x0=None):
+        """Record one finished step; raises ConvergedEarly when the loop should stop"""
+        x0 = x0 if x0 is not None else self._x0
+        self._x0 = None
+        current = x0 if x0 is not None else latents
+        self.steps_used = step + 1
+        if current is None:
+            return
+        if self.signal is None:
+            self.signal = 'x0' if x0 is not None else 'latents'
+
+        if self._previous is not None:
+            change = _norm(current - self._previous) / max(_norm(self._previous), 1e-8)
+            self.changes.append(change)
+            self._calm = self._calm + 1 if change < self.threshold else 0
+        self._previous = current
+
+        if (self._calm >= self.patience and self.steps_used >= self.min_steps
+                and self.steps_used < self.num_steps):
+            self.exited = True
+            print(f"[EARLY_EXIT] Converged after {self.steps_used}/{self.num_steps} steps "
+                  f"({self.signal} change {self.changes[-1]:.4f})")
+            raise ConvergedEarly(current)
+
+    def stats(self):
+        return {
+            'signal': self.signal,
+            'threshold': self.threshold,
+            'patience': self.patience,
+            'min_steps': self.min_steps,
+            'steps_requested': self.num_steps,
+            'steps_used': self.steps_used,
+            'exited': self.exited,
+            'saved_steps': self.num_steps - self.steps_used if self.exited else 0,
+            'last_change': round(self.changes[-1], 5) if self.changes else None
+        }
+
+
+def run_pipeline(pipe, guidance, **kwargs):
+    """``pipe(**kwargs)`` with the plan's UNet feature cache, ending the loop where ``guidance.early_exit`` saw convergence
+
+    On an early exit the converged estimate is decoded like the pipeline
+    would (or returned as is for ``output_type='latent'``), so callers get the
+    same ``.images`` either way.
+    """
+    policy = guidance.early_exit
+    with contextlib.ExitStack() as stack:
+        if guidance.deep_cache is not None:
+            stack.enter_context(guidance.deep_cache.watch(pipe))
+        if policy is None:
+            return pipe(**kwargs)
+        try:
+            with policy.watch(pipe):
+                return pipe(**kwargs)
+        except ConvergedEarly as converged:
+            if kwargs.get('output_type') == 'latent':
+                return SimpleNamespace(images=converged.latents)
+            return SimpleNamespace(images=[decode_latents(pipe, converged.latents)])
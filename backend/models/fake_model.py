@@ -0,0 +1,176 @@
+# Copyright 2025 by trongton@gmail.com
+
+import hashlib
+import io
+import base64
+import threading
+import time
+from PIL import Image
+from config import Config
+from services.tracing import span, traced_lock
+from .memory_watchdog import MemoryWatchdog, get_host_memory_info
+from .stages import StagedExecutor, StageRequest
+from .guidance import GuidancePlan
+from .early_exit import ConvergedEarly
+from .hires import HiresPlan
+
+
+class FakeStableDiffusionModel:
+    """Fixed-latency stand-in for the real wrappers (FAKE_MODEL=True)
+
+    Needs no weights: each step sleeps ``FAKE_STEP_SECONDS`` and reports
+    progress like a real pipeline (half as long for steps without the
+    unconditional pass; hires requests add their refinement steps; with
+    early exit the stand-in latents converge geometrically), the decode sleeps
+    ``FAKE_DECODE_SECONDS``,
+    and the result is a flat image whose colour depends on the prompt and
+    seed. Generations are serialized like jobs on a single device, run
+    ``OV_INFER_SLOTS`` at a time like infer slots, or flow through the stage
+    pipeline with PIPELINED_STAGES, so load tests see realistic queueing.
+    """
+
+    def __init__(self, device=None, model_id=None):
+        self.pipe = None
+        self.device = device or Config.DEVICE
+        self.preferred_device = self.device
+        self.model_id = model_id or Config.MODEL_ID
+        self.model_loaded = False
+        self.allow_cpu_fallback = True
+        self.cpu_threads = None
+        self.step_seconds = Config.FAKE_STEP_SECONDS
+        self.load_seconds = Config.FAKE_LOAD_SECONDS
+        self.decode_seconds = Config.FAKE_DECODE_SECONDS
+        self.infer_slots = max(1, Config.OV_INFER_SLOTS)
+        self._lock = threading.BoundedSemaphore(self.infer_slots)
+        self.stages = StagedExecutor(
+            f"fake-{self.model_id}",
+            [('encode', self.encode_prompt), ('denoise', self.denoise), ('decode', self.decode)],
+            queue_size=Config.STAGE_QUEUE_SIZE
+        )
+        self.memory_watchdog = MemoryWatchdog(
+            f"fake-{self.model_id}",
+            sample_fn=get_host_memory_info
+        )
+
+    @property
+    def breaker(self):
+        return None
+
+    def device_healthy(self):
+        return True
+
+    def load_weights(self):
+        pass
+
+    def load_model(self):
+        if self.model_loaded:
+            return
+        time.sleep(self.load_seconds)
+        self.model_loaded = True
+        print(f"[FAKE] Model {self.model_id} loaded on {self.device}")
+
+    def generate_image(
+        self,
+        prompt,
+        negative_prompt="",
+        width=512,
+        height=512,
+        num_inference_steps=20,
+        guidance_scale=7.5,
+        seed=None,
+        callback=None,
+        guidance_truncation=0.0,
+        stats=None,
+        hires=None,
+        early_exit=None,
+        deep_cache=None
+    ):
+        num_inference_steps = min(num_inference_steps, Config.MAX_STEPS)
+        width = (min(width, Config.MAX_WIDTH) // 8) * 8
+        height = (min(height, Config.MAX_HEIGHT) // 8) * 8
+        plan = None
+        if hires:
+            plan = HiresPlan(width, height, num_inference_steps, guidance_scale, guidance_truncation, **hires)
+        request = StageRequest(
+            prompt=prompt,
+            seed=seed,
+            width=width,
+            height=height,
+            num_inference_steps=num_inference_steps,
+            guidance=plan.base_guidance if plan else GuidancePlan(
+                num_inference_steps, guidance_scale, guidance_truncation, early_exit
+            ),
+            hires=plan,
+            callback=callback
+        )
+        if not self.model_loaded:
+            self.load_model()
+
+        if Config.PIPELINED_STAGES:
+            image = self.stages.run(request)
+        else:
+            with traced_lock(self._lock, '_lock'):
+                self.encode_prompt(request)
+                with span('denoise'):
+                    self.denoise(request)
+                with span('vae.decode'):
+                    image = self.decode(request)
+        if stats is not None:
+            stats['guidance'] = request.guidance.stats()
+            if plan is not None:
+                stats['hires'] = plan.stats()
+        return image
+
+    def encode_prompt(self, request):
+        pass
+
+    def denoise(self, request):
+        plan = request.hires
+        if plan is None:
+            self._steps(request.guidance, 0, request.num_inference_steps, request.callback)
+            return
+        with plan.phase('base'):
+            self._steps(plan.base_guidance, 0, plan.total_steps, request.callback)
+        with plan.phase('upscale'):
+            pass
+        with plan.phase('refine'):
+            self._steps(plan.refine_guidance, plan.num_steps, plan.total_steps, request.callback)
+
+    def _steps(self, guidance, offset, total_steps, callback):
+        for step in range(guidance.num_steps):
+            # A step without the unconditional pass costs half the UNet work
+            time.sleep(self.step_seconds if step < guidance.guided_steps else self.step_seconds / 2)
+            converged = False
+            try:
+                # Stand-in latents that converge geometrically, for early exit
+                guidance.on_step(step, None, 1.0 - 0.7 ** (step + 1))
+            except ConvergedEarly:
+                converged = True
+            if callback:
+                callback(offset + step, total_steps)
+            if converged:
+                return
+
+    def decode(self, request):
+        time.sleep(self.decode_seconds)
+        digest = hashlib.sha1(f"{request.prompt}|{request.seed}".encode('utf-8')).digest()
+        return Image.new('RGB', (request.width, request.height), tuple(digest[:3]))
+
+    def image_to_base64(self, image):
+        buffered = io.BytesIO()
+        image.save(buffered, format="PNG")
+        return base64.b64encode(buffered.getvalue()).decode()
+
+    def unload_model(self):
+        self.stages.stop()
+        self.model_loaded = False
+
+    def get_model_info(self):
+        return {
+            "model_id": self.model_id,
+            "device": self.device,
+            "loaded": self.model_loaded,
+            "backend": "fake",
+            "step_seconds": self.step_seconds,
+            "infer_slots": self.infer_slots
+        }
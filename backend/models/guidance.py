@@ -0,0 +1,197 @@
+# Copyright 2025 by trongton@gmail.com
+
+import inspect
+import threading
+import time
+from services.tracing import step_span
+from .early_exit import EarlyExitPolicy
+from .deep_cache import DeepCache
+
+# Plan of the generation running on the current thread; the UNet is shared
+# (stages, CPU partitions), so the truncation hooks look it up per call
+_local = threading.local()
+_install_lock = threading.Lock()
+
+
+def supports_step_end_callback(pipe):
+    """Whether the pipeline can modify its tensors between steps (diffusers >= 0.22)"""
+    try:
+        return 'callback_on_step_end' in inspect.signature(pipe.__call__).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _install_truncation_hooks(unet):
+    """Let the thread's active plan run the UNet conditional-only (once per UNet)"""
+    with _install_lock:
+        if not getattr(unet, '_cfg_truncation_hooks', False):
+            unet.register_forward_pre_hook(_conditional_inputs, with_kwargs=True)
+            unet.register_forward_hook(_doubled_output, with_kwargs=True)
+            unet._cfg_truncation_hooks = True
+
+
+def _conditional_inputs(unet, args, kwargs):
+    """Keep the conditional half of the doubled batch once the plan stopped guiding"""
+    plan = getattr(_local, 'plan', None)
+    if plan is None or not plan._conditional_only:
+        return None
+    sample = args[0] if args else kwargs['sample']
+    batch = sample.shape[0]
+    if batch % 2:
+        return None
+
+    def half(value):
+        if getattr(value, 'ndim', 0) and value.shape[0] == batch:
+            return value.chunk(2)[-1]
+        return value
+    _local.halved = True
+    return tuple(half(arg) for arg in args), {name: half(value) for name, value in kwargs.items()}
+
+
+def _doubled_output(unet, args, kwargs, output):
+    """Hand the pipeline the conditional prediction for both halves: guidance then leaves it as is"""
+    if not getattr(_local, 'halved', False):
+        return None
+    _local.halved = False
+    import torch
+    if isinstance(output, tuple):
+        return (torch.cat([output[0]] * 2),) + output[1:]
+    output.sample = torch.cat([output.sample] * 2)
+    return output
+
+
+class GuidancePlan:
+    """Classifier-free guidance schedule of one generation and what it saved
+
+    With ``guidance_scale <= 1`` the unconditional branch contributes nothing
+    and the pipeline runs the UNet on a single batch. With a ``truncation`` of
+    X the last X of the steps run conditional-only: at the end of the last
+    guided step the pipeline's guidance scale is dropped and the unconditional
+    half of the prompt embeddings removed, so later UNet calls have half the
+    batch. Pipelines without ``callback_on_step_end`` (diffusers < 0.22) get
+    the same through hooks on their torch UNet: after the last guided step it
+    runs on the conditional half only and its prediction is duplicated, which
+    the pipeline's guidance formula turns back into the conditional one. Step
+    times are recorded to report the measured speedup next to the estimate
+    from UNet evaluation counts.
+
+    ``early_exit`` (EarlyExitPolicy options) also ends the loop once the
+    image has converged, and ``deep_cache`` (DeepCache options) reuses deep
+    UNet features between steps; run the pipeline through ``run_pipeline``
+    for either.
+    """
+
+    def __init__(self, num_inference_steps, guidance_scale, truncation=0.0, early_exit=None, deep_cache=None):
+        self.num_steps = num_inference_steps
+        self.requested_scale = guidance_scale
+        self.truncation = min(max(float(truncation or 0.0), 0.0), 1.0)
+        self.cfg = guidance_scale > 1.0
+        self.cfg_steps = num_inference_steps - int(round(num_inference_steps * self.truncation)) if self.cfg else 0
+        # Truncating every step is the same as not guiding at all
+        self.guidance_scale = guidance_scale if self.cfg_steps > 0 else 1.0
+        self.truncation_supported = True
+        self.early_exit = EarlyExitPolicy(num_inference_steps, **early_exit) if early_exit else None
+        self.deep_cache = DeepCache(**deep_cache) if deep_cache else None
+        self._callback = None
+        self._step_ends = []
+        self._conditional_only = False
+
+    @property
+    def guided_steps(self):
+        """Steps that run the doubled (unconditional + conditional) batch"""
+        return self.cfg_steps if self.cfg else 0
+
+    @property
+    def truncating(self):
+        return self.cfg and 0 < self.cfg_steps < self.num_steps
+
+    def pipe_kwargs(self, pipe, callback=None):
+        """Keyword arguments for ``pipe(...)`` implementing the plan
+
+        ``callback(step, timestep, latents)`` keeps receiving progress either way.
+        """
+        self._callback = callback
+        _local.plan = None
+        if self.truncating and not supports_step_end_callback(pipe):
+            if hasattr(pipe.unet, 'register_forward_pre_hook'):
+                _install_truncation_hooks(pipe.unet)
+                _local.plan = self
+            else:
+                print("[CFG] Guidance truncation needs callback_on_step_end or a torch UNet, running full guidance")
+                self.truncation_supported = False
+                self.cfg_steps = self.num_steps
+
+        if self.truncating and _local.plan is None:
+            return {
+                'guidance_scale': self.guidance_scale,
+                'callback_on_step_end': self._on_step_end,
+                'callback_on_step_end_tensor_inputs': ['latents', 'prompt_embeds']
+            }
+        return {
+            'guidance_scale': self.guidance_scale,
+            'callback': self.on_step,
+            'callback_steps': 1
+        }
+
+    def on_step(self, step, timestep, latents):
+        """Record the end of a step and forward it to the progress callback"""
+        self._step_ends.append(time.perf_counter())
+        step_span('unet.step', step=step, guided=step < self.guided_steps)
+        if self._callback:
+            self._callback(step, timestep, latents)
+        if self.early_exit is not None:
+            self.early_exit.on_step(step, latents)
+        if getattr(_local, 'plan', None) is self:
+            if step + 1 == self.num_steps:
+                _local.plan = None
+            elif step + 1 == self.cfg_steps:
+                # Conditional-only from the next UNet call on
+                self._conditional_only = True
+
+    def _on_step_end(self, pipe, step, timestep, callback_kwargs):
+        self.on_step(step, timestep, callback_kwargs.get('latents'))
+        if step + 1 == self.cfg_steps and pipe.do_classifier_free_guidance:
+            # Conditional-only from the next step on
+            pipe._guidance_scale = 0.0
+            return {'prompt_embeds': callback_kwargs['prompt_embeds'].chunk(2)[-1]}
+        return {}
+
+    def stats(self):
+        """Per-request report of the guidance work done and saved"""
+        # Steps skipped by an early exit did no guidance work either way
+        steps = self.num_steps
+        if self.early_exit is not None and self.early_exit.exited:
+            steps = self.early_exit.steps_used
+        guided_steps = min(self.guided_steps, steps)
+        evaluations = 2 * guided_steps + (steps - guided_steps)
+        full = 2 * steps
+
+        # Step i lasted from the end of step i-1; the first step also contains
+        # prompt encoding and is left out
+        durations = [b - a for a, b in zip(self._step_ends, self._step_ends[1:])]
+        guided = [d for i, d in enumerate(durations, start=1) if i < guided_steps]
+        conditional = [d for i, d in enumerate(durations, start=1) if i >= guided_steps]
+        guided_time = sum(guided) / len(guided) if guided else None
+        conditional_time = sum(conditional) / len(conditional) if conditional else None
+
+        return {
+            'guidance_scale': self.requested_scale,
+            'cfg': self.cfg,
+            # What ran: an unsupported truncation ran full guidance
+            'guidance_truncation': self.truncation if self.truncation_supported else 0.0,
+            'requested_guidance_truncation': self.truncation,
+            'truncation_supported': self.truncation_supported,
+            'guided_steps': guided_steps,
+            'conditional_only_steps': steps - guided_steps,
+            'unet_evaluations': evaluations,
+            'full_cfg_unet_evaluations': full,
+            'estimated_speedup': round(full / evaluations, 3) if evaluations else None,
+            'guided_step_time': round(guided_time, 4) if guided_time else None,
+            'conditional_step_time': round(conditional_time, 4) if conditional_time else None,
+            'measured_step_speedup': (
+                round(guided_time / conditional_time, 3)
+                if guided_time and conditional_time else None
+            ),
+            'early_exit': self.early_exit.stats() if self.early_exit is not None else None,
+            'deep_cache': self.deep_cache.stats() if self.deep_cache is not None else None
+        }
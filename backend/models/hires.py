@@ -0,0 +1,153 @@
+# Copyright 2025 by trongton@gmail.com
+
+import contextlib
+import time
+from PIL import Image
+from services.tracing import span
+from .guidance import GuidancePlan
+
+UPSCALE_MODES = ('image', 'latent')
+
+# UNet cost is roughly proportional to the latent area; costs are reported in
+# UNet evaluations at 512x512
+_REFERENCE_PIXELS = 512 * 512
+
+
+def _round8(value):
+    return max(64, int(value) // 8 * 8)
+
+
+class HiresPlan:
+    """Two-pass high-resolution schedule of one generation
+
+    The first pass runs every step at ``scale`` times the target size. Its
+    result (decoded image, or the latents with ``upscale='latent'``) is
+    upscaled to the target size and refined by an img2img pass that re-noises
+    it to ``strength`` and runs that fraction of the steps. Each pass keeps
+    its own guidance plan, and the wall time of every phase is recorded to
+    report the cost breakdown next to the estimate for a direct run.
+    """
+
+    def __init__(self, width, height, num_inference_steps, guidance_scale=7.5,
+                 guidance_truncation=0.0, scale=0.5, strength=0.35, upscale='image'):
+        self.width = width
+        self.height = height
+        self.num_steps = num_inference_steps
+        self.scale = min(max(float(scale), 0.25), 1.0)
+        self.base_width = min(_round8(width * self.scale), width)
+        self.base_height = min(_round8(height * self.scale), height)
+        self.strength = min(max(float(strength), 0.0), 1.0)
+        # img2img runs int(steps * strength) steps; aim between two integers so
+        # float rounding cannot drop one
+        self.refine_steps = min(max(1, int(round(num_inference_steps * self.strength))), num_inference_steps)
+        self.pipe_strength = min((self.refine_steps + 0.5) / num_inference_steps, 1.0)
+        self.upscale = upscale if upscale in UPSCALE_MODES else 'image'
+        self.base_guidance = GuidancePlan(num_inference_steps, guidance_scale, guidance_truncation)
+        self.refine_guidance = GuidancePlan(self.refine_steps, guidance_scale, guidance_truncation)
+        self.timings = {}
+
+    @property
+    def enabled(self):
+        """False when the base size is the target size (nothing to refine)"""
+        return (self.base_width, self.base_height) != (self.width, self.height)
+
+    @property
+    def total_steps(self):
+        return self.num_steps + self.refine_steps
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time one phase (base / upscale / refine) and trace it"""
+        start = time.perf_counter()
+        try:
+            with span(f'hires.{name}', cat='hires'):
+                yield
+        finally:
+            self.timings[name] = round(time.perf_counter() - start, 4)
+
+    def stats(self):
+        """Per-pass cost report and the estimated saving over a direct run"""
+        base_area = self.base_width * self.base_height / _REFERENCE_PIXELS
+        target_area = self.width * self.height / _REFERENCE_PIXELS
+        base = self.base_guidance.stats()
+        refine = self.refine_guidance.stats()
+        base_cost = base['unet_evaluations'] * base_area
+        refine_cost = refine['unet_evaluations'] * target_area
+        # A direct run does the base pass's UNet work at the target size
+        direct_cost = base['unet_evaluations'] * target_area
+        return {
+            'upscale': self.upscale,
+            'strength': self.strength,
+            'base': {
+                'width': self.base_width,
+                'height': self.base_height,
+                'steps': self.num_steps,
+                'unet_evaluations': base['unet_evaluations'],
+                'cost': round(base_cost, 2),
+                'seconds': self.timings.get('base')
+            },
+            'upscale_seconds': self.timings.get('upscale'),
+            'refine': {
+                'width': self.width,
+                'height': self.height,
+                'steps': self.refine_steps,
+                'unet_evaluations': refine['unet_evaluations'],
+                'cost': round(refine_cost, 2),
+                'seconds': self.timings.get('refine')
+            },
+            'cost': round(base_cost + refine_cost, 2),
+            'direct_cost': round(direct_cost, 2),
+            'estimated_speedup': round(direct_cost / (base_cost + refine_cost), 3)
+        }
+
+
+def upscale_latents(latents, width, height):
+    """Bicubic resize of ``latents`` to the latent grid of ``width`` x ``height``"""
+    import torch.nn.functional as F
+    return F.interpolate(latents, size=(height // 8, width // 8), mode='bicubic', align_corners=False)
+
+
+def run_hires(plan, txt2img, img2img, prompt, negative_prompt=None, generator=None, callback=None):
+    """Run both passes of ``plan`` on a text-to-image and an image-to-image pipeline
+
+    ``callback(step, total_steps)`` sees the refinement steps after the base
+    steps. Returns the PIL image.
+    """
+    if callback:
+        def base_callback(step, timestep, latents):
+            callback(step, plan.total_steps)
+
+        def refine_callback(step, timestep, latents):
+            callback(plan.num_steps + step, plan.total_steps)
+    else:
+        base_callback = refine_callback = None
+
+    with plan.phase('base'):
+        result = txt2img(
+            prompt=prompt,
+            negative_prompt=negative_prompt or None,
+            width=plan.base_width,
+            height=plan.base_height,
+            num_inference_steps=plan.num_steps,
+            generator=generator,
+            output_type='latent' if plan.upscale == 'latent' else 'pil',
+            **plan.base_guidance.pipe_kwargs(txt2img, base_callback)
+        )
+
+    with plan.phase('upscale'):
+        if plan.upscale == 'latent':
+            init = upscale_latents(result.images, plan.width, plan.height)
+        else:
+            init = result.images[0].resize((plan.width, plan.height), Image.LANCZOS)
+
+    with plan.phase('refine'):
+        result = img2img(
+            prompt=prompt,
+            negative_prompt=negative_prompt or None,
+            image=init,
+            strength=plan.pipe_strength,
+            num_inference_steps=plan.num_steps,
+            generator=generator,
+            **plan.refine_guidance.pipe_kwargs(img2img, refine_callback)
+        )
+    return result.images[0]
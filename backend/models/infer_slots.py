@@ -0,0 +1,74 @@
+# Copyright 2025 by trongton@gmail.com
+
+import copy
+import queue
+from services.tracing import instrument_pipeline
+
+
+class InferRequestSlot:
+    """Stands in for a compiled submodel but runs on its own infer request
+
+    ``CompiledModel.__call__`` reuses one internal infer request, so two
+    threads calling the same compiled model would overwrite each other's
+    tensors. Each slot gets a request of its own from the shared compiled
+    model; OpenVINO runs requests on different streams concurrently.
+    """
+
+    def __init__(self, compiled):
+        if not hasattr(compiled, 'create_infer_request') and hasattr(compiled, 'get_compiled_model'):
+            compiled = compiled.get_compiled_model()
+        self._compiled = compiled
+        self._request = compiled.create_infer_request()
+
+    def __call__(self, inputs=None, share_inputs=True, share_outputs=False, **kwargs):
+        # Outputs are copied by default: the request's buffers are reused by
+        # the next call on this slot
+        return self._request.infer(inputs, share_inputs=share_inputs, share_outputs=share_outputs, **kwargs)
+
+    def infer(self, inputs=None, **kwargs):
+        return self._request.infer(inputs, **kwargs)
+
+    def create_infer_request(self):
+        return self._compiled.create_infer_request()
+
+    def __getattr__(self, attr):
+        return getattr(self._compiled, attr)
+
+
+def build_infer_slots(pipe, submodels, count):
+    """Queue of ``count`` pipeline views sharing ``pipe``'s compiled submodels
+
+    Each view is a shallow copy of the pipeline with its own scheduler (the
+    scheduler keeps per-generation state), its own copies of the submodel
+    wrappers pointing at per-slot infer requests, and a VAE wrapper bound to
+    those copies. Attributes a generation sets on the pipeline (such as the
+    guidance scale) land on the view, not on the shared pipeline.
+    """
+    slots = queue.Queue()
+    for _ in range(count):
+        view = copy.copy(pipe)
+        parts = {}
+        for name in submodels:
+            part = getattr(pipe, name, None)
+            if part is None or getattr(part, 'request', None) is None:
+                continue
+            part = copy.copy(part)
+            part.request = InferRequestSlot(part.request)
+            parts[name] = part
+            # Bypass DiffusionPipeline.__setattr__, which would rewrite the
+            # config dict shared with the original pipeline
+            view.__dict__[name] = part
+
+        vae = getattr(pipe, 'vae', None)
+        if vae is not None and hasattr(vae, 'decoder'):
+            vae = copy.copy(vae)
+            vae.decoder = parts.get('vae_decoder', vae.decoder)
+            if hasattr(vae, 'encoder'):
+                vae.encoder = parts.get('vae_encoder', vae.encoder)
+            view.__dict__['vae'] = vae
+
+        view.__dict__['scheduler'] = copy.deepcopy(pipe.scheduler)
+        # The copied trace hooks are bound to the shared pipeline; rebind them
+        instrument_pipeline(view)
+        slots.put(view)
+    return slots
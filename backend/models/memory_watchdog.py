@@ -0,0 +1,195 @@
+# Copyright 2025 by trongton@gmail.com
+
+import ctypes
+import gc
+import threading
+import time
+from collections import deque
+from config import Config
+from services.metrics import metrics
+
+
+def get_host_memory_info():
+    """Process RSS/VMS and host memory totals in MB (None where unavailable)"""
+    try:
+        import psutil
+        process = psutil.Process()
+        memory_info = process.memory_info()
+        return {
+            "rss_mb": round(memory_info.rss / 1024 / 1024, 2),
+            "vms_mb": round(memory_info.vms / 1024 / 1024, 2),
+            "percent": round(process.memory_percent(), 2),
+            "total_mb": round(psutil.virtual_memory().total / 1024 / 1024, 2)
+        }
+    except Exception:
+        return {
+            "rss_mb": None,
+            "vms_mb": None,
+            "percent": None,
+            "total_mb": None
+        }
+
+
+def trim_host_memory():
+    """Return freed heap pages to the OS (glibc only); returns True if anything was trimmed"""
+    try:
+        libc = ctypes.CDLL("libc.so.6")
+        return bool(libc.malloc_trim(0))
+    except Exception:
+        return False
+
+
+class MemoryWatchdog:
+    """Samples process and device memory and acts only under pressure
+
+    Instead of collecting garbage around every generation, the wrapper calls
+    ``check()`` at generation boundaries and a background thread samples every
+    ``interval`` seconds. Usage is compared against three escalating thresholds
+    (percent of ``MEMORY_LIMIT_MB`` or of host RAM, and of device memory where
+    the backend reports it):
+
+    - ``collect``: run ``gc.collect()``
+    - ``trim``: collect, then trim allocator and device caches
+    - ``reload``: ask the wrapper to reload its model at the next safe point
+
+    Every decision is recorded in metrics and in ``status()``.
+    """
+
+    ACTIONS = ('collect', 'trim', 'reload')
+
+    def __init__(self, name, sample_fn, trim_fn=None, interval=None,
+                 collect_percent=None, trim_percent=None, reload_percent=None,
+                 limit_mb=None, cooldown=None):
+        self.name = name
+        self._sample_fn = sample_fn
+        self._trim_fn = trim_fn
+        self.interval = interval if interval is not None else Config.MEMORY_WATCHDOG_INTERVAL
+        self.thresholds = {
+            'collect': collect_percent if collect_percent is not None else Config.MEMORY_COLLECT_PERCENT,
+            'trim': trim_percent if trim_percent is not None else Config.MEMORY_TRIM_PERCENT,
+            'reload': reload_percent if reload_percent is not None else Config.MEMORY_RELOAD_PERCENT
+        }
+        self.limit_mb = limit_mb if limit_mb is not None else Config.MEMORY_LIMIT_MB
+        self.cooldown = cooldown if cooldown is not None else Config.MEMORY_ACTION_COOLDOWN
+
+        self.reload_requested = False
+        self._lock = threading.Lock()
+        self._last_action_at = {action: 0.0 for action in self.ACTIONS}
+        self._decisions = deque(maxlen=50)
+        self._last_sample = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not Config.MEMORY_WATCHDOG_ENABLED or self.interval <= 0:
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name=f"memory-watchdog-{self.name}",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def usage_percent(self, sample):
+        """Highest of host and device usage in percent of their limits"""
+        usages = []
+        rss_mb = sample.get('rss_mb')
+        limit_mb = self.limit_mb or sample.get('total_mb')
+        if rss_mb is not None and limit_mb:
+            usages.append(rss_mb / limit_mb * 100)
+        device = sample.get('device') or {}
+        if device.get('used_mb') is not None and device.get('total_mb'):
+            usages.append(device['used_mb'] / device['total_mb'] * 100)
+        return max(usages) if usages else None
+
+    def check(self, reason='sample'):
+        """Sample memory and escalate only if a threshold is crossed; returns the action taken"""
+        if not Config.MEMORY_WATCHDOG_ENABLED:
+            return None
+
+        with self._lock:
+            with metrics.time('watchdog.sample'):
+                sample = self._sample_fn()
+            self._last_sample = sample
+            metrics.inc('watchdog.samples')
+            usage = self.usage_percent(sample)
+            if sample.get('rss_mb') is not None:
+                metrics.set_gauge(f'watchdog.{self.name}.rss_mb', sample['rss_mb'])
+            if usage is None:
+                return None
+            metrics.set_gauge(f'watchdog.{self.name}.usage_percent', round(usage, 2))
+
+            # The highest crossed action that is not cooling down; a reload
+            # on cooldown still trims or collects
+            action = None
+            crossed = False
+            now = time.time()
+            for candidate in reversed(self.ACTIONS):
+                threshold = self.thresholds[candidate]
+                if not threshold or usage < threshold:
+                    continue
+                crossed = True
+                if now - self._last_action_at[candidate] >= self.cooldown:
+                    action = candidate
+                    break
+            if action is None:
+                if crossed:
+                    metrics.inc('watchdog.suppressed')
+                return None
+            self._last_action_at[action] = now
+
+        self._act(action, usage, reason)
+        return action
+
+    def status(self):
+        with self._lock:
+            return {
+                'enabled': Config.MEMORY_WATCHDOG_ENABLED,
+                'interval': self.interval,
+                'thresholds': dict(self.thresholds),
+                'limit_mb': self.limit_mb,
+                'reload_requested': self.reload_requested,
+                'last_sample': self._last_sample,
+                'decisions': list(self._decisions)
+            }
+
+    def _act(self, action, usage, reason):
+        start = time.perf_counter()
+        if action in ('collect', 'trim', 'reload'):
+            gc.collect()
+        if action in ('trim', 'reload'):
+            trim_host_memory()
+            if self._trim_fn is not None:
+                try:
+                    self._trim_fn()
+                except Exception as e:
+                    print(f"[MEMORY] Cache trim failed: {e}")
+        if action == 'reload':
+            self.reload_requested = True
+        elapsed = time.perf_counter() - start
+
+        metrics.inc(f'watchdog.{action}')
+        metrics.observe(f'watchdog.{action}_time', elapsed)
+        decision = {
+            'time': time.time(),
+            'action': action,
+            'usage_percent': round(usage, 2),
+            'reason': reason,
+            'duration': round(elapsed, 4)
+        }
+        with self._lock:
+            self._decisions.append(decision)
+        print(f"[MEMORY] {self.name}: {action} at {usage:.1f}% usage ({reason}, {elapsed * 1000:.0f} ms)")
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.check('periodic')
+            except Exception as e:
+                print(f"[MEMORY] Watchdog sample failed: {e}")
@@ -1,53 +1,81 @@
 # Copyright 2025 by trongton@gmail.com
 
+import contextlib
 import torch
-from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline, DPMSolverMultistepScheduler
 from PIL import Image
 import io
 import base64
 import time
+import threading
 from config import Config
+from services.tracing import instrument_pipeline, span, traced_lock
+from .memory_watchdog import MemoryWatchdog, get_host_memory_info
+from .device_health import classify_error, get_breaker, torch_probe
+from .stages import StagedExecutor, StageRequest, encode_stage, denoise_stage, decode_stage
+from .guidance import GuidancePlan
+from .early_exit import run_pipeline
+from .hires import HiresPlan, run_hires
+from .cpu_perf import CPUPerfMode
 
 class StableDiffusionModel:
     """Wrapper for Stable Diffusion model with NSFW support"""
     
-    def __init__(self):
+    def __init__(self, device=None, model_id=None):
         self.pipe = None
-        self.device = Config.DEVICE
+        self.device = device or Config.DEVICE
+        self.preferred_device = self.device
+        self.model_id = model_id or Config.MODEL_ID
         self.model_loaded = False
+        self.cpu_threads = None
         
+        # compile / channels_last / bf16 execution on CPU (CPU_PERF_MODE)
+        self.cpu_perf = CPUPerfMode() if Config.CPU_PERF_MODE else None
+        
+        # Collect/trim/reload only when memory thresholds are crossed
+        self.memory_watchdog = MemoryWatchdog(
+            f"pytorch-{self.model_id}",
+            sample_fn=self._get_memory_info,
+            trim_fn=self._trim_device_memory
+        )
+        
+        # Text encode / UNet loop / VAE decode as separate stages so queued
+        # jobs overlap (PIPELINED_STAGES)
+        self.stages = StagedExecutor(
+            f"pytorch-{self.model_id}",
+            [('encode', self.encode_prompt), ('denoise', self.denoise), ('decode', self.decode)],
+            queue_size=Config.STAGE_QUEUE_SIZE
+        )
+        self._stage_lock = threading.Lock()
+        # Generations running on the pipeline outside the stages
+        self._inflight = 0
+        
+    @property
+    def breaker(self):
+        """Circuit breaker of the accelerator (None on CPU)"""
+        if self.device == "cpu":
+            return None
+        return get_breaker(self.device, torch_probe)
+    
+    def device_healthy(self):
+        """Whether the device may take traffic according to its breaker"""
+        return self.breaker is None or self.breaker.allow()
+    
     def load_model(self):
         """Load the Stable Diffusion model"""
         if self.model_loaded:
             print("Model already loaded")
             return
         
-        print(f"Loading Stable Diffusion model: {Config.MODEL_ID}")
+        print(f"Loading Stable Diffusion model: {self.model_id}")
         print(f"Using device: {self.device}")
         
         load_start = time.time()
         
         try:
-            # Prepare loading arguments
-            load_args = {
-                "torch_dtype": torch.float16 if self.device == "cuda" else torch.float32,
-                "safety_checker": None if not Config.SAFETY_CHECKER_ENABLED else "default"
-            }
-            
-            # Only add token if it's set and not a placeholder
-            if Config.HUGGINGFACE_TOKEN and Config.HUGGINGFACE_TOKEN != "your_huggingface_token_here":
-                load_args["token"] = Config.HUGGINGFACE_TOKEN
-            
-            # Load the pipeline
-            self.pipe = StableDiffusionPipeline.from_pretrained(
-                Config.MODEL_ID,
-                **load_args
-            )
-            
-            # Optimize with DPM Solver for faster inference
-            self.pipe.scheduler = DPMSolverMultistepScheduler.from_config(
-                self.pipe.scheduler.config
-            )
+            # Weights may already be in memory (read before a gunicorn fork)
+            if self.pipe is None:
+                self.pipe = self._read_pipeline()
             
             # Move to device
             self.pipe = self.pipe.to(self.device)
@@ -64,14 +92,73 @@ class StableDiffusionModel:
                 self.pipe.enable_attention_slicing()
                 print("Attention slicing enabled")
             
+            if self.device == "cpu" and self.cpu_threads and self.cpu_perf is None:
+                torch.set_num_threads(self.cpu_threads)
+            
+            if self.device == "cpu" and self.cpu_perf is not None:
+                self.cpu_perf.apply(self.pipe, self.cpu_threads)
+                if Config.CPU_WARMUP:
+                    self.cpu_perf.warmup(self.pipe)
+            
+            # Text encoder and VAE decode calls show up in request traces
+            instrument_pipeline(self.pipe)
+            
             load_time = time.time() - load_start
             self.model_loaded = True
+            self.memory_watchdog.start()
             print(f"Model loaded successfully in {load_time:.2f} seconds!")
             
         except Exception as e:
             print(f"Error loading model: {e}")
             raise
     
+    def load_weights(self):
+        """Read the pipeline into host memory without moving it to the device
+        
+        Called in the gunicorn master before forking so workers share the
+        weight pages copy-on-write; ``load_model`` finishes the job per worker.
+        """
+        if self.pipe is None:
+            print(f"Reading model weights: {self.model_id}")
+            self.pipe = self._read_pipeline()
+    
+    def _read_pipeline(self):
+        # Prepare loading arguments
+        load_args = {
+            "torch_dtype": torch.float16 if self.device == "cuda" else torch.float32,
+            "safety_checker": None if not Config.SAFETY_CHECKER_ENABLED else "default"
+        }
+        
+        # Only add token if it's set and not a placeholder
+        if Config.HUGGINGFACE_TOKEN and Config.HUGGINGFACE_TOKEN != "your_huggingface_token_here":
+            load_args["token"] = Config.HUGGINGFACE_TOKEN
+        
+        # Load the pipeline
+        pipe = StableDiffusionPipeline.from_pretrained(
+            self.model_id,
+            **load_args
+        )
+        
+        # Optimize with DPM Solver for faster inference
+        pipe.scheduler = DPMSolverMultistepScheduler.from_config(
+            pipe.scheduler.config
+        )
+        return pipe
+    
+    def shared_pipeline(self):
+        """A pipeline sharing this wrapper's weights, with its own scheduler
+        
+        Used by the CPU partitions and the hires passes: the UNet, VAE and
+        text encoder are only read during inference, but schedulers keep
+        per-generation state.
+        """
+        components = dict(self.pipe.components)
+        components['scheduler'] = DPMSolverMultistepScheduler.from_config(self.pipe.scheduler.config)
+        return StableDiffusionPipeline(
+            **components,
+            requires_safety_checker=components.get('safety_checker') is not None
+        )
+    
     def generate_image(
         self,
         prompt,
@@ -81,7 +168,12 @@ class StableDiffusionModel:
         num_inference_steps=20,
         guidance_scale=7.5,
         seed=None,
-        callback=None
+        callback=None,
+        guidance_truncation=0.0,
+        stats=None,
+        hires=None,
+        early_exit=None,
+        deep_cache=None
     ):
         """
         Generate an image from a text prompt
@@ -94,12 +186,32 @@ class StableDiffusionModel:
             num_inference_steps: Number of denoising steps
             guidance_scale: How closely to follow the prompt
             seed: Random seed for reproducibility
+            guidance_truncation: Fraction of final steps run without the unconditional pass
+            stats: Optional dict that receives the per-request guidance report
+            hires: Optional dict of HiresPlan options (scale, strength, upscale)
+                for a two-pass generation
+            early_exit: Optional dict of EarlyExitPolicy options (threshold,
+                patience, min_steps) to stop once the image has converged
+            deep_cache: Optional dict of DeepCache options (interval, branch)
+                to run the full UNet only every ``interval`` steps; two-pass
+                generations use neither
         
         Returns:
             PIL Image object
         """
-        if not self.model_loaded:
-            self.load_model()
+        if hires:
+            return self._generate_hires(
+                prompt, negative_prompt, width, height,
+                num_inference_steps, guidance_scale, seed, callback,
+                guidance_truncation, stats, hires
+            )
+        
+        if Config.PIPELINED_STAGES:
+            return self._generate_staged(
+                prompt, negative_prompt, width, height,
+                num_inference_steps, guidance_scale, seed, callback,
+                guidance_truncation, stats, early_exit, deep_cache
+            )
         
         # Validate dimensions
         width = min(width, Config.MAX_WIDTH)
@@ -118,11 +230,18 @@ class StableDiffusionModel:
         print(f"Generating image with prompt: {prompt[:50]}...")
         print(f"Settings - Size: {width}x{height}, Steps: {num_inference_steps}, Guidance: {guidance_scale}")
         
+        with traced_lock(self._stage_lock, '_stage_lock'):
+            self._reload_if_requested()
+            if not self.model_loaded:
+                with span('model.load', cat='load'):
+                    self.load_model()
+            self._inflight += 1
+        
         gen_start = time.time()
         
         try:
             # Generate image
-            with torch.inference_mode():
+            with torch.inference_mode(), self._autocast():
                 # Prepare callback if provided
                 pipe_callback = None
                 if callback:
@@ -130,33 +249,197 @@ class StableDiffusionModel:
                     def progress_callback(step, timestep, latents):
                         try:
                             callback(step, num_inference_steps)
+                        except StopIteration:
+                            # Every subscriber detached or the queued job was cancelled
+                            raise
                         except Exception as e:
                             print(f"Error in callback: {e}")
                     pipe_callback = progress_callback
                 else:
                     print("No callback provided")
                 
-                result = self.pipe(
-                    prompt=prompt,
-                    negative_prompt=negative_prompt if negative_prompt else None,
-                    width=width,
-                    height=height,
-                    num_inference_steps=num_inference_steps,
-                    guidance_scale=guidance_scale,
-                    generator=generator,
-                    callback=pipe_callback if pipe_callback else None,
-                    callback_steps=1 if pipe_callback else None
-                )
+                # Skips the unconditional UNet pass when guidance is off
+                # and for the truncated final steps
+                guidance = GuidancePlan(num_inference_steps, guidance_scale, guidance_truncation, early_exit, deep_cache)
+                with span('pipeline', width=width, height=height, steps=num_inference_steps):
+                    result = run_pipeline(
+                        self.pipe,
+                        guidance,
+                        prompt=prompt,
+                        negative_prompt=negative_prompt if negative_prompt else None,
+                        width=width,
+                        height=height,
+                        num_inference_steps=num_inference_steps,
+                        generator=generator,
+                        **guidance.pipe_kwargs(self.pipe, pipe_callback)
+                    )
             
             gen_time = time.time() - gen_start
             image = result.images[0]
+            if stats is not None:
+                stats['guidance'] = guidance.stats()
+            if self.breaker is not None:
+                self.breaker.record_success()
             print(f"Image generated successfully in {gen_time:.2f} seconds!")
             print(f"Performance: {num_inference_steps/gen_time:.2f} steps/sec")
+            
+            # Release memory only if usage crossed a threshold
+            self.memory_watchdog.check('post-generation')
             return image
             
+        except StopIteration:
+            print("[STOP] Generation stopped by user")
+            raise
         except Exception as e:
             print(f"Error generating image: {e}")
+            if self.breaker is not None:
+                self.breaker.record_failure(classify_error(e), str(e))
             raise
+        finally:
+            with self._stage_lock:
+                self._inflight -= 1
+    
+    def _reload_if_requested(self):
+        """Reload the model if the watchdog asked for it and nothing runs on it (hold ``_stage_lock``)"""
+        if not (self.model_loaded and self.memory_watchdog.reload_requested):
+            return
+        if self._inflight or not self.stages.idle():
+            return
+        print("[MEMORY] Reloading model to recover from memory pressure")
+        # Cleared first so a concurrent request cannot start a second reload
+        self.memory_watchdog.reload_requested = False
+        self.unload_model()
+    
+    def encode_prompt(self, request):
+        """Stage 1: text encoder"""
+        with torch.inference_mode(), self._autocast():
+            encode_stage(self.pipe, request)
+    
+    def denoise(self, request):
+        """Stage 2: UNet loop, producing latents"""
+        with torch.inference_mode(), self._autocast():
+            denoise_stage(self.pipe, request)
+    
+    def decode(self, request):
+        """Stage 3: VAE decode to a PIL image"""
+        with torch.inference_mode(), self._autocast():
+            return decode_stage(self.pipe, request)
+    
+    def _generate_staged(self, prompt, negative_prompt, width, height,
+                         num_inference_steps, guidance_scale, seed, callback,
+                         guidance_truncation=0.0, stats=None, early_exit=None,
+                         deep_cache=None):
+        """Run one generation through the encode / denoise / decode stages
+        
+        The watchdog reload only happens while no job is in the stages.
+        """
+        num_inference_steps = min(num_inference_steps, Config.MAX_STEPS)
+        if callback:
+            def stage_callback(step, timestep, latents):
+                callback(step, num_inference_steps)
+        else:
+            stage_callback = None
+        
+        request = StageRequest(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            width=(min(width, Config.MAX_WIDTH) // 8) * 8,
+            height=(min(height, Config.MAX_HEIGHT) // 8) * 8,
+            num_inference_steps=num_inference_steps,
+            guidance=GuidancePlan(num_inference_steps, guidance_scale, guidance_truncation, early_exit, deep_cache),
+            generator=torch.Generator(device=self.device).manual_seed(seed) if seed is not None else None,
+            callback=stage_callback
+        )
+        
+        with traced_lock(self._stage_lock, '_stage_lock'):
+            self._reload_if_requested()
+            if not self.model_loaded:
+                with span('model.load', cat='load'):
+                    self.load_model()
+            gen_start = time.time()
+            self.stages.submit(request)
+        
+        try:
+            image = self.stages.wait(request)
+        except StopIteration:
+            raise
+        except Exception as e:
+            print(f"Error generating image: {e}")
+            if self.breaker is not None:
+                self.breaker.record_failure(classify_error(e), str(e))
+            raise
+        
+        if self.breaker is not None:
+            self.breaker.record_success()
+        print(f"Image generated through pipelined stages in {time.time() - gen_start:.2f} seconds")
+        self.memory_watchdog.check('post-generation')
+        if stats is not None:
+            stats['guidance'] = request.guidance.stats()
+        return image
+    
+    def _generate_hires(self, prompt, negative_prompt, width, height,
+                        num_inference_steps, guidance_scale, seed, callback,
+                        guidance_truncation=0.0, stats=None, hires=None):
+        """Generate at a base size, upscale, and refine at the target size
+        
+        Both passes run on pipelines of their own that share this wrapper's
+        modules, so the pipelined stages keep their scheduler.
+        """
+        plan = HiresPlan(
+            (min(width, Config.MAX_WIDTH) // 8) * 8,
+            (min(height, Config.MAX_HEIGHT) // 8) * 8,
+            min(num_inference_steps, Config.MAX_STEPS),
+            guidance_scale, guidance_truncation, **hires
+        )
+        with traced_lock(self._stage_lock, '_stage_lock'):
+            self._reload_if_requested()
+            if not self.model_loaded:
+                with span('model.load', cat='load'):
+                    self.load_model()
+            txt2img = self.shared_pipeline()
+            self._inflight += 1
+        
+        print(f"[HIRES] {plan.base_width}x{plan.base_height} -> {plan.width}x{plan.height}, "
+              f"{plan.num_steps} + {plan.refine_steps} steps, {plan.upscale} upscale")
+        gen_start = time.time()
+        try:
+            img2img = StableDiffusionImg2ImgPipeline(
+                **txt2img.components,
+                requires_safety_checker=txt2img.safety_checker is not None
+            )
+            instrument_pipeline(txt2img)
+            instrument_pipeline(img2img)
+            with torch.inference_mode(), self._autocast():
+                image = run_hires(
+                    plan, txt2img, img2img, prompt, negative_prompt,
+                    generator=torch.Generator(device=self.device).manual_seed(seed) if seed is not None else None,
+                    callback=callback
+                )
+        except StopIteration:
+            raise
+        except Exception as e:
+            print(f"Error generating image: {e}")
+            if self.breaker is not None:
+                self.breaker.record_failure(classify_error(e), str(e))
+            raise
+        finally:
+            with self._stage_lock:
+                self._inflight -= 1
+        
+        if self.breaker is not None:
+            self.breaker.record_success()
+        print(f"Two-pass image generated in {time.time() - gen_start:.2f} seconds ({plan.timings})")
+        self.memory_watchdog.check('post-generation')
+        if stats is not None:
+            stats['guidance'] = plan.base_guidance.stats()
+            stats['hires'] = plan.stats()
+        return image
+    
+    def _autocast(self):
+        """bf16 autocast of the CPU performance mode, if active"""
+        if self.device == "cpu" and self.cpu_perf is not None:
+            return self.cpu_perf.autocast()
+        return contextlib.nullcontext()
     
     def image_to_base64(self, image):
         """Convert PIL Image to base64 string"""
@@ -175,4 +458,25 @@ class StableDiffusionModel:
             if self.device == "cuda":
                 torch.cuda.empty_cache()
             
-            print("Model unloaded from memory")
\ No newline at end of file
+            self.stages.stop()
+            self.memory_watchdog.stop()
+            self.memory_watchdog.reload_requested = False
+            print("Model unloaded from memory")
+    
+    def _get_memory_info(self):
+        """Get current host and device memory usage information"""
+        memory_info = get_host_memory_info()
+        memory_info["device"] = None
+        if self.device == "cuda" and torch.cuda.is_available():
+            total = torch.cuda.get_device_properties(0).total_memory
+            memory_info["device"] = {
+                "used_mb": round(torch.cuda.memory_reserved() / 1024 / 1024, 2),
+                "total_mb": round(total / 1024 / 1024, 2),
+                "allocated_mb": round(torch.cuda.memory_allocated() / 1024 / 1024, 2)
+            }
+        return memory_info
+    
+    def _trim_device_memory(self):
+        """Return cached CUDA blocks to the driver when the watchdog asks for a trim"""
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
\ No newline at end of file
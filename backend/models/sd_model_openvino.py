@@ -1,22 +1,39 @@
 # Copyright 2025 by trongton@gmail.com
 
 import torch
-from optimum.intel.openvino import OVStableDiffusionPipeline
+from optimum.intel.openvino import OVStableDiffusionPipeline, OVStableDiffusionImg2ImgPipeline
 from PIL import Image
 import io
 import base64
 import time
 import gc
 import threading
+import contextlib
+import copy
+from concurrent.futures import ThreadPoolExecutor
 from config import Config
+from services.tracing import instrument_pipeline, span, traced_lock
+from .memory_watchdog import MemoryWatchdog, get_host_memory_info
+from .device_health import CircuitBreaker, DeviceErrorInfo, classify_error, get_breaker, openvino_probe
+from .stages import StagedExecutor, StageRequest, encode_stage, denoise_stage, decode_stage
+from .guidance import GuidancePlan
+from .early_exit import run_pipeline
+from .hires import HiresPlan, run_hires
+from .infer_slots import build_infer_slots
 import os
 
 class StableDiffusionModelOpenVINO:
     """Wrapper for Stable Diffusion model using OpenVINO for Intel GPU acceleration"""
     
-    def __init__(self):
+    # Pipeline parts that can be placed on their own device (OV_SUBMODEL_DEVICES)
+    SUBMODELS = ('text_encoder', 'unet', 'vae_decoder', 'vae_encoder')
+    
+    def __init__(self, device=None, model_id=None):
         self.pipe = None
-        self.device = Config.DEVICE
+        self.device = device or Config.DEVICE
+        # Device this wrapper was asked for; it returns here once healthy
+        self.preferred_device = self.device.upper()
+        self.model_id = model_id or Config.MODEL_ID
         self.model_loaded = False
         self.ov_cache_dir = os.path.join(os.path.dirname(__file__), '..', 'ov_models')
         os.makedirs(self.ov_cache_dir, exist_ok=True)
@@ -25,25 +42,77 @@ class StableDiffusionModelOpenVINO:
         self._gpu_memory_lock = threading.Lock()
         self._generation_count = 0
         self._gpu_failed = False
-        self._max_generations_before_cleanup = 5  # Force cleanup every N generations
+        self._ov_core = None
+        
+        # Collect/trim/reload only when memory thresholds are crossed
+        self.memory_watchdog = MemoryWatchdog(
+            f"openvino-{self.model_id}",
+            sample_fn=self._get_memory_info
+        )
+        
+        # When a warm standby pipeline exists the ModelManager handles failover,
+        # so the in-place CPU reload below can be turned off
+        self.allow_cpu_fallback = True
+        
+        # Inference threads on CPU (None lets OpenVINO use every core)
+        self.cpu_threads = None
+        # Set on a pinned CPU partition: OpenVINO's threads then keep the
+        # caller's affinity instead of pinning themselves
+        self.cpu_pinned = False
+        # Device each submodel was compiled for
+        self.placement = {}
+        
+        # Concurrent generations on the compiled model, each through its own
+        # infer requests (OV_INFER_SLOTS > 1)
+        self.infer_slots = Config.OV_INFER_SLOTS
+        self._slots = None
+        self._slot_inflight = 0
+        # Image-to-image pipelines for hires, by id of the pipeline or slot view
+        self._img2img = {}
+        
+        # Seconds spent in each phase of the last load (read/export, compile, warmup)
+        self.load_timings = {}
+        
+        # Text encode / UNet loop / VAE decode as separate stages so queued
+        # jobs overlap (PIPELINED_STAGES)
+        self.stages = StagedExecutor(
+            f"openvino-{self.model_id}",
+            [('encode', self.encode_prompt), ('denoise', self.denoise), ('decode', self.decode)],
+            queue_size=Config.STAGE_QUEUE_SIZE
+        )
         
         # Validate GPU on initialization if using GPU
         if self.device.upper() != 'CPU':
             self._validate_gpu_device()
         
+    @property
+    def breaker(self):
+        """Circuit breaker of the preferred accelerator (None when targeting CPU)"""
+        if self.preferred_device == 'CPU':
+            return None
+        return get_breaker(self.preferred_device, openvino_probe)
+    
+    def device_healthy(self):
+        """Whether the current device may take traffic according to its breaker"""
+        if self.device.upper() == 'CPU':
+            return True
+        return get_breaker(self.device.upper(), openvino_probe).allow()
+    
     def load_model(self):
         """Load the Stable Diffusion model with OpenVINO optimization"""
         if self.model_loaded:
             print("Model already loaded")
             return
         
-        # Re-validate GPU if we previously had failures
-        if self._gpu_failed and self.device.upper() != 'CPU':
-            print("[GPU] Previous GPU failure detected, re-validating...")
-            if not self._validate_gpu_device():
-                print("[GPU] GPU re-validation failed, using CPU")
+        # Do not load onto a device whose breaker is open or probing
+        if self.device.upper() != 'CPU' and not self.device_healthy():
+            if not self.allow_cpu_fallback:
+                raise RuntimeError(f"{self.device} is unhealthy (circuit breaker open)")
+            print(f"[BREAKER] {self.device} is unhealthy, loading on CPU until it recovers")
+            self.device = 'CPU'
+            self._gpu_failed = True
         
-        print(f"Loading Stable Diffusion model with OpenVINO: {Config.MODEL_ID}")
+        print(f"Loading Stable Diffusion model with OpenVINO: {self.model_id}")
         print(f"Using device: {self.device}")
         
         load_start = time.time()
@@ -52,58 +121,39 @@ class StableDiffusionModelOpenVINO:
             # Clean up any existing memory
             self._force_cleanup_gpu_memory()
             
-            # Check if OpenVINO converted model exists locally
-            ov_model_path = os.path.join(self.ov_cache_dir, Config.MODEL_ID.replace('/', '_'))
+            # Weights may already be in memory (read before a gunicorn fork),
+            # in which case the read timings of load_weights() are kept
+            if self.pipe is None:
+                self.load_timings = {}
+                self.pipe = self._read_pipeline()
+            with self._phase('configure'):
+                self.pipe.to(self.device)
+                self._apply_ov_config()
             
-            # Configure GPU properties for better memory management
-            # Use minimal config to avoid unsupported options
-            gpu_config = None
-            if self.device.upper() != 'CPU':
-                # Only use widely supported options
-                try:
-                    gpu_config = {}
-                    print(f"[GPU] Using default GPU configuration")
-                except Exception as cfg_error:
-                    print(f"[GPU] GPU config error: {cfg_error}")
-                    gpu_config = None
-            
-            if os.path.exists(ov_model_path):
-                print(f"Loading pre-converted OpenVINO model from: {ov_model_path}")
-                self.pipe = OVStableDiffusionPipeline.from_pretrained(
-                    ov_model_path,
-                    device=self.device,
-                    ov_config=gpu_config if self.device.upper() != 'CPU' else None
-                )
-            else:
-                print("Converting model to OpenVINO format (this may take a few minutes on first run)...")
-                # Load and convert from PyTorch to OpenVINO format
-                # Try to load from local HuggingFace cache first
-                token = Config.HUGGINGFACE_TOKEN if Config.HUGGINGFACE_TOKEN and Config.HUGGINGFACE_TOKEN != 'your_huggingface_token_here' else None
-                
-                self.pipe = OVStableDiffusionPipeline.from_pretrained(
-                    Config.MODEL_ID,
-                    export=True,  # Export to OpenVINO format
-                    device=self.device,
-                    token=token,
-                    local_files_only=False,  # Allow downloading if needed
-                    ov_config=gpu_config if self.device.upper() != 'CPU' else None
-                )
-                
-                # Save the converted model for future use
-                print(f"Saving converted OpenVINO model to: {ov_model_path}")
-                self.pipe.save_pretrained(ov_model_path)
-            
-            # Compile the model for the target device
+            # Compile every part for the target device (or its own placement),
+            # in parallel and through the compiled-blob cache
             print(f"Compiling model for {self.device}...")
-            self.pipe.compile()
+            with self._phase('compile'):
+                self._compile_submodels(self.submodel_placement())
+            # Text encoder and VAE decode calls show up in request traces
+            instrument_pipeline(self.pipe)
+            
+            if self.infer_slots > 1:
+                with self._phase('infer_slots'):
+                    self._slots = build_infer_slots(self.pipe, self.SUBMODELS, self.infer_slots)
+                print(f"[SLOTS] {self.infer_slots} infer request slots on {self.device}")
             
             # Test the model with a simple generation to ensure it works
             if self.device.upper() != 'CPU':
-                self._warmup_gpu_model()
+                with self._phase('warmup'):
+                    self._warmup_gpu_model()
             
             load_time = time.time() - load_start
+            self.load_timings['load_model'] = round(load_time, 3)
             self.model_loaded = True
+            self.memory_watchdog.start()
             print(f"OpenVINO model loaded and compiled successfully in {load_time:.2f} seconds!")
+            print(f"[LOAD] Phase timings: {self.load_timings}")
             print(f"Available devices: {self.get_available_devices()}")
             
         except Exception as e:
@@ -112,8 +162,12 @@ class StableDiffusionModelOpenVINO:
             print("[ERROR] Full traceback:")
             traceback.print_exc()
             
-            # If GPU failed, try fallback to CPU
-            if self.device.upper() != 'CPU' and not self._gpu_failed:
+            # A device fault opens the GPU's breaker; a bad model id, hub or
+            # export error says nothing about the device
+            if self.device.upper() != 'CPU':
+                error_info = classify_error(e)
+                self._record_device_failure(e, error_info, force_open=error_info.device_fault)
+            if self.allow_cpu_fallback and self.device.upper() != 'CPU':
                 print(f"[GPU] Model loading failed on {self.device}, attempting CPU fallback...")
                 print(f"[GPU] Error was: {str(e)[:200]}")
                 self.device = 'CPU'
@@ -126,6 +180,165 @@ class StableDiffusionModelOpenVINO:
             
             raise
     
+    def load_weights(self):
+        """Read the OpenVINO IR into memory without compiling it
+        
+        Called in the gunicorn master before forking: the IR weights are
+        memory-mapped, so every worker shares the same read-only pages and only
+        compiles (``load_model``) after the fork.
+        """
+        if self.pipe is None:
+            print(f"Reading OpenVINO model weights: {self.model_id}")
+            self.load_timings = {}
+            self.pipe = self._read_pipeline()
+    
+    @contextlib.contextmanager
+    def _phase(self, name):
+        """Record the duration of one load phase in ``load_timings`` (and the request trace)"""
+        start = time.time()
+        try:
+            with span(f'load.{name}', cat='load'):
+                yield
+        finally:
+            self.load_timings[name] = round(time.time() - start, 3)
+    
+    def _read_pipeline(self):
+        """Load the pipeline from the ov_models cache (exporting it on first run), uncompiled"""
+        ov_model_path = os.path.join(self.ov_cache_dir, self.model_id.replace('/', '_'))
+        
+        if os.path.exists(ov_model_path):
+            print(f"Loading pre-converted OpenVINO model from: {ov_model_path}")
+            with self._phase('read'):
+                return OVStableDiffusionPipeline.from_pretrained(
+                    ov_model_path,
+                    device=self.device,
+                    compile=False
+                )
+        
+        print("Converting model to OpenVINO format (this may take a few minutes on first run)...")
+        print("Run `python prepare.py` before deployment to keep the export out of requests")
+        # Load and convert from PyTorch to OpenVINO format
+        # Try to load from local HuggingFace cache first
+        token = Config.HUGGINGFACE_TOKEN if Config.HUGGINGFACE_TOKEN and Config.HUGGINGFACE_TOKEN != 'your_huggingface_token_here' else None
+        
+        with self._phase('export'):
+            pipe = OVStableDiffusionPipeline.from_pretrained(
+                self.model_id,
+                export=True,  # Export to OpenVINO format
+                device=self.device,
+                token=token,
+                local_files_only=False,  # Allow downloading if needed
+                compile=False
+            )
+        
+        # Save the converted model for future use
+        print(f"Saving converted OpenVINO model to: {ov_model_path}")
+        with self._phase('save'):
+            pipe.save_pretrained(ov_model_path)
+        return pipe
+    
+    def _apply_ov_config(self):
+        """Set compile options for the current device on the pipeline and its parts"""
+        ov_config = {}
+        if self.device.upper() == 'CPU' and self.cpu_threads:
+            # Several workers share the host; keep each one to its share of the cores
+            ov_config['INFERENCE_NUM_THREADS'] = str(self.cpu_threads)
+        if self.infer_slots > 1:
+            ov_config.update(self._slots_ov_config())
+        if self.device.upper() == 'CPU' and self.cpu_pinned:
+            ov_config.update(self._pinned_ov_config())
+        if Config.OV_COMPILE_CACHE:
+            ov_config['CACHE_DIR'] = Config.OV_COMPILE_CACHE_DIR
+        
+        self.pipe.ov_config = dict(self.pipe.ov_config or {}, **ov_config)
+        for name in ('text_encoder', 'unet', 'vae_decoder', 'vae_encoder'):
+            part = getattr(self.pipe, name, None)
+            if part is not None and hasattr(part, 'ov_config'):
+                part.ov_config = dict(part.ov_config or {}, **ov_config)
+    
+    def _pinned_ov_config(self):
+        # One stream per partition (per slot with OV_INFER_SLOTS); threads are
+        # created by the pinned stream thread during compile and inherit its
+        # CPU mask
+        return {'NUM_STREAMS': str(max(1, self.infer_slots)), 'ENABLE_CPU_PINNING': 'NO'}
+    
+    def _slots_ov_config(self):
+        # Let the plugin create enough streams to run every slot at once
+        return {
+            'PERFORMANCE_HINT': 'THROUGHPUT',
+            'PERFORMANCE_HINT_NUM_REQUESTS': str(self.infer_slots)
+        }
+    
+    def submodel_placement(self):
+        """Device for each submodel from OV_SUBMODEL_DEVICES (others follow the wrapper)
+        
+        Placements apply only while the wrapper runs on its preferred device;
+        after a CPU fallback every part runs on CPU. Parts assigned to an
+        accelerator whose breaker is open also run on CPU until it recovers.
+        """
+        placement = {name: self.device.upper() for name in self.SUBMODELS}
+        if self.device.upper() == self.preferred_device:
+            for name, device in Config.OV_SUBMODEL_DEVICES.items():
+                if name not in placement:
+                    print(f"[PLACEMENT] Ignoring unknown submodel '{name}' (expected one of {', '.join(self.SUBMODELS)})")
+                    continue
+                placement[name] = device.upper()
+        for name, device in placement.items():
+            if device != 'CPU' and not get_breaker(device, openvino_probe).allow():
+                print(f"[PLACEMENT] {device} is unhealthy, running {name} on CPU")
+                placement[name] = 'CPU'
+        return placement
+    
+    def _submodel_ov_config(self, name, device):
+        ov_config = {'PERFORMANCE_HINT': 'LATENCY'}
+        if self.infer_slots > 1:
+            ov_config.update(self._slots_ov_config())
+        if device == 'CPU' and self.cpu_threads:
+            ov_config['INFERENCE_NUM_THREADS'] = str(self.cpu_threads)
+        if device == 'CPU' and self.cpu_pinned:
+            ov_config.update(self._pinned_ov_config())
+        if Config.OV_COMPILE_CACHE:
+            # Compiled blobs are keyed by model, device and config, so later
+            # starts and device switches import them instead of compiling
+            ov_config['CACHE_DIR'] = Config.OV_COMPILE_CACHE_DIR
+        ov_config.update({key: str(value) for key, value in Config.OV_SUBMODEL_CONFIG.get(name, {}).items()})
+        return ov_config
+    
+    def _compile_submodels(self, placement):
+        """Compile every part for its own device and config before pipe.compile()
+        
+        Parts compile on parallel threads (OV_PARALLEL_COMPILE) since
+        compile_model is thread-safe and most of the work is per model. The
+        pipeline moves numpy tensors between parts, so parts on different
+        devices exchange data through host memory; pipe.compile() then finds
+        every request already compiled.
+        """
+        from openvino import Core
+        if self._ov_core is None:
+            self._ov_core = Core()
+        parts = [
+            (name, device, getattr(self.pipe, name))
+            for name, device in placement.items()
+            if getattr(getattr(self.pipe, name, None), 'model', None) is not None
+        ]
+        
+        def compile_part(name, device, part):
+            compile_start = time.time()
+            part.request = self._ov_core.compile_model(part.model, device, self._submodel_ov_config(name, device))
+            seconds = time.time() - compile_start
+            print(f"[COMPILE] {name} compiled for {device} in {seconds:.2f} seconds")
+            return name, round(seconds, 3)
+        
+        if Config.OV_PARALLEL_COMPILE and len(parts) > 1:
+            with ThreadPoolExecutor(max_workers=len(parts), thread_name_prefix='ov-compile') as pool:
+                futures = [pool.submit(compile_part, *part) for part in parts]
+                part_timings = dict(future.result() for future in futures)
+        else:
+            part_timings = dict(compile_part(*part) for part in parts)
+        self.load_timings['compile_parts'] = part_timings
+        self.pipe.compile()
+        self.placement = placement
+    
     def _validate_gpu_device(self):
         """Validate GPU device availability and functionality"""
         try:
@@ -146,6 +359,7 @@ class StableDiffusionModelOpenVINO:
                 print(f"[GPU] Available devices: {available_devices}")
                 print(f"[GPU] Make sure Intel GPU drivers and OpenVINO GPU plugin are installed")
                 print(f"[GPU] Falling back to CPU")
+                self._record_device_failure(RuntimeError("No GPU devices found"), force_open=True)
                 self.device = 'CPU'
                 self._gpu_failed = True
                 return False
@@ -232,7 +446,12 @@ class StableDiffusionModelOpenVINO:
         num_inference_steps=20,
         guidance_scale=7.5,
         seed=None,
-        callback=None
+        callback=None,
+        guidance_truncation=0.0,
+        stats=None,
+        hires=None,
+        early_exit=None,
+        deep_cache=None
     ):
         """
         Generate an image from a text prompt using OpenVINO
@@ -245,21 +464,57 @@ class StableDiffusionModelOpenVINO:
             num_inference_steps: Number of denoising steps
             guidance_scale: How closely to follow the prompt
             seed: Random seed for reproducibility
+            guidance_truncation: Fraction of final steps run without the unconditional pass
+            stats: Optional dict that receives the per-request guidance report
+            hires: Optional dict of HiresPlan options (scale, strength, upscale)
+                for a two-pass generation
+            early_exit: Optional dict of EarlyExitPolicy options (threshold,
+                patience, min_steps) to stop once the image has converged
+            deep_cache: Optional dict of DeepCache options (interval, branch)
+                to run the full UNet only every ``interval`` steps; two-pass
+                generations use neither
         
         Returns:
             PIL Image object
         """
         
-        with self._gpu_memory_lock:
+        if hires:
+            return self._generate_hires(
+                prompt, negative_prompt, width, height,
+                num_inference_steps, guidance_scale, seed, callback,
+                guidance_truncation, stats, hires
+            )
+        
+        if Config.PIPELINED_STAGES:
+            return self._generate_staged(
+                prompt, negative_prompt, width, height,
+                num_inference_steps, guidance_scale, seed, callback,
+                guidance_truncation, stats, early_exit, deep_cache
+            )
+        
+        if self.infer_slots > 1:
+            return self._generate_concurrent(
+                prompt, negative_prompt, width, height,
+                num_inference_steps, guidance_scale, seed, callback,
+                guidance_truncation, stats, early_exit, deep_cache
+            )
+        
+        with traced_lock(self._gpu_memory_lock, '_gpu_memory_lock'):
+            # A reload requested by the watchdog happens here, where no
+            # generation is using the pipeline
+            if self.model_loaded and self.memory_watchdog.reload_requested:
+                print("[MEMORY] Reloading model to recover from memory pressure")
+                self.unload_model()
+            
+            # Leave an accelerator whose breaker opened since the last generation
+            if self.model_loaded and not self.device_healthy() and self.allow_cpu_fallback:
+                self._fall_back_to_cpu()
+            
             if not self.model_loaded:
-                self.load_model()
+                with span('model.load', cat='load'):
+                    self.load_model()
             
-            # Check if we've hit generation limit and need cleanup
             self._generation_count += 1
-            if self._generation_count >= self._max_generations_before_cleanup:
-                print(f"[GPU] Performing periodic cleanup after {self._generation_count} generations")
-                self._force_cleanup_gpu_memory()
-                self._generation_count = 0
             
             # Validate dimensions
             width = min(width, Config.MAX_WIDTH)
@@ -282,11 +537,10 @@ class StableDiffusionModelOpenVINO:
             retry_count = 0
             max_retries = 2 if self.device.upper() != 'CPU' else 0
             
-            while retry_count <= max_retries:
+            while True:
                 try:
-                    # Pre-generation cleanup for GPU
-                    if self.device.upper() != 'CPU':
-                        self._cleanup_gpu_memory()
+                    # Pre-generation memory check (acts only above thresholds)
+                    self.memory_watchdog.check('pre-generation')
                     
                     # Generate image using OpenVINO
                     # Prepare callback if provided
@@ -308,101 +562,379 @@ class StableDiffusionModelOpenVINO:
                     else:
                         print("No callback provided (OpenVINO)")
                     
-                    result = self.pipe(
-                        prompt=prompt,
-                        negative_prompt=negative_prompt if negative_prompt else None,
-                        width=width,
-                        height=height,
-                        num_inference_steps=num_inference_steps,
-                        guidance_scale=guidance_scale,
-                        generator=generator,
-                        callback=pipe_callback if pipe_callback else None,
-                        callback_steps=1 if pipe_callback else None
-                    )
+                    # Skips the unconditional UNet pass when guidance is off
+                    # and for the truncated final steps
+                    guidance = GuidancePlan(num_inference_steps, guidance_scale, guidance_truncation, early_exit, deep_cache)
+                    with span('pipeline', width=width, height=height, steps=num_inference_steps,
+                              attempt=retry_count + 1):
+                        result = run_pipeline(
+                            self.pipe,
+                            guidance,
+                            prompt=prompt,
+                            negative_prompt=negative_prompt if negative_prompt else None,
+                            width=width,
+                            height=height,
+                            num_inference_steps=num_inference_steps,
+                            generator=generator,
+                            **guidance.pipe_kwargs(self.pipe, pipe_callback)
+                        )
                     
                     gen_time = time.time() - gen_start
                     image = result.images[0]
+                    if stats is not None:
+                        stats['guidance'] = guidance.stats()
+                    if self.device.upper() != 'CPU':
+                        get_breaker(self.device.upper(), openvino_probe).record_success()
                     print(f"Image generated successfully with OpenVINO in {gen_time:.2f} seconds!")
                     print(f"Performance: {num_inference_steps/gen_time:.2f} steps/sec")
                     
-                    # Clean up GPU memory to prevent CL_OUT_OF_RESOURCES
-                    self._cleanup_gpu_memory()
+                    # Release memory only if usage crossed a threshold
+                    self.memory_watchdog.check('post-generation')
                     
                     return image
                     
                 except StopIteration as e:
                     # Stop requested by user, clean up and re-raise
                     print(f"[STOP] Generation stopped by user")
-                    self._cleanup_gpu_memory()
+                    self.memory_watchdog.check('stopped')
                     raise
                     
                 except Exception as e:
-                    error_str = str(e).lower()
-                    is_gpu_memory_error = any(error_type in error_str for error_type in [
-                        'cl_out_of_resources',
-                        'cl_exec_status_error_for_events_in_wait_list',
-                        'clflush',
-                        'clwaitforevents',
-                        'memory',
-                        'gpu'
-                    ])
-                    
-                    print(f"Error generating image (attempt {retry_count + 1}): {e}")
+                    error_info = classify_error(e)
+                    print(f"Error generating image (attempt {retry_count + 1}, {error_info}): {e}")
                     
                     # Force cleanup on any error
                     self._force_cleanup_gpu_memory()
                     
-                    # If it's a GPU memory error and we have retries left, try again
-                    if is_gpu_memory_error and retry_count < max_retries and self.device.upper() != 'CPU':
+                    # Errors that are not device faults (bad input, bugs) are raised as-is
+                    if self.device.upper() == 'CPU' or not error_info.device_fault:
+                        raise
+                    
+                    state = self._record_device_failure(e, error_info)
+                    
+                    # Transient device error: retry while the breaker is still closed
+                    if (state == CircuitBreaker.CLOSED and error_info.retryable
+                            and retry_count < max_retries):
                         retry_count += 1
-                        print(f"[GPU] GPU memory error detected, retrying ({retry_count}/{max_retries})...")
+                        print(f"[GPU] {error_info.category} on {self.device}, retrying ({retry_count}/{max_retries})...")
                         time.sleep(2)  # Wait before retry
                         continue
                     
-                    # If it's a persistent GPU error, fall back to CPU
-                    if is_gpu_memory_error and self.device.upper() != 'CPU' and not self._gpu_failed:
-                        print(f"[GPU] Persistent GPU memory errors, falling back to CPU")
-                        self.device = 'CPU'
-                        self._gpu_failed = True
-                        
-                        # Unload and reload model on CPU
-                        self.unload_model()
-                        self.load_model()
-                        
-                        # Retry generation on CPU
-                        return self.generate_image(
-                            prompt=prompt,
-                            negative_prompt=negative_prompt,
-                            width=width,
-                            height=height,
-                            num_inference_steps=num_inference_steps,
-                            guidance_scale=guidance_scale,
-                            seed=seed,
-                            callback=callback
-                        )
+                    # Breaker opened: move to CPU until probes bring the device back
+                    if state != CircuitBreaker.CLOSED and self.allow_cpu_fallback:
+                        print(f"[GPU] {self.device} circuit breaker is {state}, falling back to CPU")
+                        self._fall_back_to_cpu()
+                        retry_count = 0
+                        max_retries = 0
+                        continue
                     
-                    # If we've exhausted retries or it's not a GPU error, raise the exception
+                    # Retries exhausted, or a standby pipeline handles failover
                     raise
     
-    def _cleanup_gpu_memory(self):
-        """Clean up GPU memory after generation to prevent CL_OUT_OF_RESOURCES errors"""
+    def encode_prompt(self, request):
+        """Stage 1: text encoder"""
+        encode_stage(self.pipe, request)
+    
+    def denoise(self, request):
+        """Stage 2: UNet loop, producing latents"""
+        denoise_stage(self.pipe, request)
+    
+    def decode(self, request):
+        """Stage 3: VAE decode to a PIL image"""
+        return decode_stage(self.pipe, request)
+    
+    def _generate_staged(self, prompt, negative_prompt, width, height,
+                         num_inference_steps, guidance_scale, seed, callback,
+                         guidance_truncation=0.0, stats=None, early_exit=None,
+                         deep_cache=None):
+        """Run one generation through the encode / denoise / decode stages
+        
+        Several jobs are in flight at once, so the watchdog reload and the CPU
+        fallback only happen while no job is in the stages, and device errors
+        are not retried in place (the breaker and ModelManager failover still
+        apply).
+        """
+        num_inference_steps = min(num_inference_steps, Config.MAX_STEPS)
+        if callback:
+            def stage_callback(step, timestep, latents):
+                callback(step, num_inference_steps)
+        else:
+            stage_callback = None
+        
+        request = StageRequest(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            width=(min(width, Config.MAX_WIDTH) // 8) * 8,
+            height=(min(height, Config.MAX_HEIGHT) // 8) * 8,
+            num_inference_steps=num_inference_steps,
+            guidance=GuidancePlan(num_inference_steps, guidance_scale, guidance_truncation, early_exit, deep_cache),
+            generator=torch.Generator().manual_seed(seed) if seed is not None else None,
+            callback=stage_callback
+        )
+        
+        # Checks and submission happen under the lock so nothing unloads the
+        # pipeline between the idle check and the job entering the stages
+        with traced_lock(self._gpu_memory_lock, '_gpu_memory_lock'):
+            if self.stages.idle():
+                if self.model_loaded and self.memory_watchdog.reload_requested:
+                    print("[MEMORY] Reloading model to recover from memory pressure")
+                    self.unload_model()
+                if self.model_loaded and not self.device_healthy() and self.allow_cpu_fallback:
+                    self._fall_back_to_cpu()
+            if not self.model_loaded:
+                with span('model.load', cat='load'):
+                    self.load_model()
+            self._generation_count += 1
+            self.memory_watchdog.check('pre-generation')
+            gen_start = time.time()
+            self.stages.submit(request)
+        
         try:
-            # Force garbage collection
-            gc.collect()
-            
-            # Additional cleanup for GPU
-            if self.device.upper() != 'CPU':
+            image = self.stages.wait(request)
+        except StopIteration:
+            print("[STOP] Generation stopped by user")
+            raise
+        except Exception as e:
+            error_info = classify_error(e)
+            print(f"Error generating image ({error_info}): {e}")
+            if self.device.upper() != 'CPU' and error_info.device_fault:
+                self._record_device_failure(e, error_info)
+            raise
+        
+        if self.device.upper() != 'CPU':
+            get_breaker(self.device.upper(), openvino_probe).record_success()
+        print(f"Image generated through pipelined stages in {time.time() - gen_start:.2f} seconds")
+        self.memory_watchdog.check('post-generation')
+        if stats is not None:
+            stats['guidance'] = request.guidance.stats()
+        return image
+    
+    def _generate_concurrent(self, prompt, negative_prompt, width, height,
+                             num_inference_steps, guidance_scale, seed, callback,
+                             guidance_truncation=0.0, stats=None, early_exit=None,
+                             deep_cache=None):
+        """Run one generation on a free infer slot, alongside other slots
+        
+        The lock only covers the reload / fallback checks and the slot count;
+        the generation itself runs outside it. Reloads and the CPU fallback
+        wait until no slot is busy, and device errors are not retried in
+        place (the breaker and ModelManager failover still apply).
+        """
+        num_inference_steps = min(num_inference_steps, Config.MAX_STEPS)
+        width = (min(width, Config.MAX_WIDTH) // 8) * 8
+        height = (min(height, Config.MAX_HEIGHT) // 8) * 8
+        
+        with traced_lock(self._gpu_memory_lock, '_gpu_memory_lock'):
+            if self._slot_inflight == 0:
+                if self.model_loaded and self.memory_watchdog.reload_requested:
+                    print("[MEMORY] Reloading model to recover from memory pressure")
+                    self.unload_model()
+                if self.model_loaded and not self.device_healthy() and self.allow_cpu_fallback:
+                    self._fall_back_to_cpu()
+            if not self.model_loaded:
+                with span('model.load', cat='load'):
+                    self.load_model()
+            self._generation_count += 1
+            self._slot_inflight += 1
+            slots = self._slots
+            self.memory_watchdog.check('pre-generation')
+        
+        try:
+            wait_start = time.time()
+            with span('infer_slot.wait', cat='queue'):
+                pipe = slots.get()
+            gen_start = time.time()
+            try:
+                guidance = GuidancePlan(num_inference_steps, guidance_scale, guidance_truncation, early_exit, deep_cache)
+                if callback:
+                    def pipe_callback(step, timestep, latents):
+                        callback(step, num_inference_steps)
+                else:
+                    pipe_callback = None
+                with span('pipeline', width=width, height=height, steps=num_inference_steps):
+                    result = run_pipeline(
+                        pipe,
+                        guidance,
+                        prompt=prompt,
+                        negative_prompt=negative_prompt if negative_prompt else None,
+                        width=width,
+                        height=height,
+                        num_inference_steps=num_inference_steps,
+                        generator=torch.Generator().manual_seed(seed) if seed is not None else None,
+                        **guidance.pipe_kwargs(pipe, pipe_callback)
+                    )
+            finally:
+                slots.put(pipe)
+        except StopIteration:
+            print("[STOP] Generation stopped by user")
+            raise
+        except Exception as e:
+            error_info = classify_error(e)
+            print(f"Error generating image ({error_info}): {e}")
+            if self.device.upper() != 'CPU' and error_info.device_fault:
+                self._record_device_failure(e, error_info)
+            raise
+        finally:
+            with self._gpu_memory_lock:
+                self._slot_inflight -= 1
+        
+        if self.device.upper() != 'CPU':
+            get_breaker(self.device.upper(), openvino_probe).record_success()
+        print(f"Image generated on an infer slot in {time.time() - gen_start:.2f} seconds "
+              f"(waited {gen_start - wait_start:.2f}s for the slot)")
+        self.memory_watchdog.check('post-generation')
+        if stats is not None:
+            stats['guidance'] = guidance.stats()
+        return result.images[0]
+    
+    def _generate_hires(self, prompt, negative_prompt, width, height,
+                        num_inference_steps, guidance_scale, seed, callback,
+                        guidance_truncation=0.0, stats=None, hires=None):
+        """Generate at a base size, upscale, and refine at the target size
+        
+        Goes through the same checks as a single generation: the watchdog
+        reload and the move off an unhealthy device happen while nothing else
+        uses the pipeline. It runs under the generation lock once the
+        pipelined stages have drained, and a device fault that opens the
+        breaker falls back to CPU and runs again. With OV_INFER_SLOTS it runs
+        on a free infer slot, where device errors are not retried in place
+        (the breaker and ModelManager failover still apply).
+        """
+        def new_plan():
+            return HiresPlan(
+                (min(width, Config.MAX_WIDTH) // 8) * 8,
+                (min(height, Config.MAX_HEIGHT) // 8) * 8,
+                min(num_inference_steps, Config.MAX_STEPS),
+                guidance_scale, guidance_truncation, **hires
+            )
+        plan = new_plan()
+        print(f"[HIRES] {plan.base_width}x{plan.base_height} -> {plan.width}x{plan.height}, "
+              f"{plan.num_steps} + {plan.refine_steps} steps, {plan.upscale} upscale")
+        gen_start = time.time()
+        
+        with traced_lock(self._gpu_memory_lock, '_gpu_memory_lock'):
+            if Config.PIPELINED_STAGES and self.infer_slots <= 1:
+                # Submissions need this lock, so the stages stay empty meanwhile
+                self.stages.wait_idle()
+            if self._slot_inflight == 0:
+                if self.model_loaded and self.memory_watchdog.reload_requested:
+                    print("[MEMORY] Reloading model to recover from memory pressure")
+                    self.unload_model()
+                if self.model_loaded and not self.device_healthy() and self.allow_cpu_fallback:
+                    self._fall_back_to_cpu()
+            if not self.model_loaded:
+                with span('model.load', cat='load'):
+                    self.load_model()
+            self._generation_count += 1
+            self.memory_watchdog.check('pre-generation')
+            slots = self._slots if self.infer_slots > 1 else None
+            if slots is None:
                 try:
-                    # Try to reduce memory pressure
-                    import torch
-                    if hasattr(torch, 'cuda') and torch.cuda.is_available():
-                        torch.cuda.empty_cache()
+                    image = self._run_hires(self.pipe, plan, prompt, negative_prompt, seed, callback)
+                except StopIteration:
+                    raise
                 except Exception:
-                    pass  # Ignore torch CUDA errors on Intel GPU
-            
-            print("[GPU] Memory cleanup completed")
+                    self._force_cleanup_gpu_memory()
+                    if self.device.upper() == 'CPU' or self.device_healthy() or not self.allow_cpu_fallback:
+                        raise
+                    print(f"[GPU] {self.device} circuit breaker opened, falling back to CPU")
+                    self._fall_back_to_cpu()
+                    plan = new_plan()
+                    image = self._run_hires(self.pipe, plan, prompt, negative_prompt, seed, callback)
+            else:
+                self._slot_inflight += 1
+        
+        if slots is not None:
+            try:
+                with span('infer_slot.wait', cat='queue'):
+                    pipe = slots.get()
+                try:
+                    image = self._run_hires(pipe, plan, prompt, negative_prompt, seed, callback)
+                finally:
+                    slots.put(pipe)
+            finally:
+                with self._gpu_memory_lock:
+                    self._slot_inflight -= 1
+        
+        print(f"Two-pass image generated with OpenVINO in {time.time() - gen_start:.2f} seconds ({plan.timings})")
+        self.memory_watchdog.check('post-generation')
+        if stats is not None:
+            stats['guidance'] = plan.base_guidance.stats()
+            stats['hires'] = plan.stats()
+        return image
+    
+    def _img2img_for(self, pipe):
+        """Image-to-image pipeline on the compiled submodels of ``pipe`` (a pipeline or slot view)
+        
+        Built once per pipeline from the same OpenVINO models without
+        compiling them again: its parts run on ``pipe``'s compiled models, or
+        on a slot view's own infer requests. Every call gets a fresh copy of
+        the scheduler.
+        """
+        img2img = self._img2img.get(id(pipe))
+        if img2img is None:
+            parts = {name: getattr(pipe, name, None) for name in self.SUBMODELS}
+            parts = {name: part for name, part in parts.items() if part is not None}
+            img2img = OVStableDiffusionImg2ImgPipeline(
+                scheduler=copy.deepcopy(pipe.scheduler),
+                tokenizer=pipe.tokenizer,
+                feature_extractor=pipe.feature_extractor,
+                safety_checker=pipe.safety_checker,
+                device=pipe._device,
+                compile=False,
+                # The models are shared with ``pipe``; leave their shapes alone
+                dynamic_shapes=False,
+                ov_config=pipe.ov_config,
+                model_save_dir=pipe.model_save_dir,
+                **{name: part.model for name, part in parts.items()}
+            )
+            for name, part in parts.items():
+                getattr(img2img, name).request = part.request
+            instrument_pipeline(img2img)
+            self._img2img[id(pipe)] = img2img
+        img2img.scheduler = copy.deepcopy(pipe.scheduler)
+        return img2img
+    
+    def _run_hires(self, pipe, plan, prompt, negative_prompt, seed, callback):
+        """Both hires passes on ``pipe`` and its image-to-image counterpart"""
+        try:
+            image = run_hires(
+                plan, pipe, self._img2img_for(pipe), prompt, negative_prompt,
+                generator=torch.Generator().manual_seed(seed) if seed is not None else None,
+                callback=callback
+            )
+        except StopIteration:
+            print("[STOP] Generation stopped by user")
+            self.memory_watchdog.check('stopped')
+            raise
         except Exception as e:
-            print(f"[GPU] Error during memory cleanup: {e}")
+            error_info = classify_error(e)
+            print(f"Error generating image ({error_info}): {e}")
+            if self.device.upper() != 'CPU' and error_info.device_fault:
+                self._record_device_failure(e, error_info)
+            raise
+        if self.device.upper() != 'CPU':
+            get_breaker(self.device.upper(), openvino_probe).record_success()
+        return image
+    
+    def _record_device_failure(self, error, error_info=None, force_open=False):
+        """Feed a device error into the breaker of the current device; returns its state"""
+        device = self.device.upper()
+        if device == 'CPU':
+            return CircuitBreaker.CLOSED
+        error_info = error_info or classify_error(error)
+        if force_open and not error_info.device_fault:
+            error_info = DeviceErrorInfo('device_lost', code=error_info.code, device_fault=True)
+        elif force_open:
+            error_info.category = 'device_lost'
+        return get_breaker(device, openvino_probe).record_failure(error_info, str(error))
+    
+    def _fall_back_to_cpu(self):
+        """Reload the pipeline on CPU (caller holds the generation lock)"""
+        self.unload_model()
+        self.device = 'CPU'
+        self._gpu_failed = True
+        self.load_model()
     
     def image_to_base64(self, image):
         """Convert PIL Image to base64 string"""
@@ -420,6 +952,8 @@ class StableDiffusionModelOpenVINO:
                 print(f"Error during model deletion: {e}")
             finally:
                 self.pipe = None
+                self._slots = None
+                self._img2img = {}
                 self.model_loaded = False
             
             # Force cleanup after unloading
@@ -427,38 +961,56 @@ class StableDiffusionModelOpenVINO:
             
             # Reset generation count
             self._generation_count = 0
+            self.stages.stop()
+            self.memory_watchdog.stop()
+            self.memory_watchdog.reload_requested = False
             
             print("OpenVINO model unloaded from memory")
     
     def _get_memory_info(self):
-        """Get current memory usage information"""
+        """Get current host and device memory usage information"""
+        memory_info = get_host_memory_info()
+        memory_info["device"] = self._get_device_memory_info()
+        return memory_info
+    
+    def _get_device_memory_info(self):
+        """OpenVINO device memory statistics in MB, where the plugin reports them"""
+        if self.device.upper() == 'CPU':
+            return None
         try:
-            import psutil
-            process = psutil.Process()
-            memory_info = process.memory_info()
-            
+            if self._ov_core is None:
+                from openvino import Core
+                self._ov_core = Core()
+            statistics = self._ov_core.get_property(self.device, 'GPU_MEMORY_STATISTICS')
+            total = self._ov_core.get_property(self.device, 'GPU_DEVICE_TOTAL_MEM_SIZE')
             return {
-                "rss_mb": round(memory_info.rss / 1024 / 1024, 2),
-                "vms_mb": round(memory_info.vms / 1024 / 1024, 2),
-                "percent": round(process.memory_percent(), 2)
+                "used_mb": round(sum(statistics.values()) / 1024 / 1024, 2),
+                "total_mb": round(total / 1024 / 1024, 2) if total else None,
+                "statistics": {k: round(v / 1024 / 1024, 2) for k, v in statistics.items()}
             }
         except Exception:
-            return {
-                "rss_mb": "unknown",
-                "vms_mb": "unknown", 
-                "percent": "unknown"
-            }
+            return None
     
     def get_model_info(self):
         """Get information about the loaded model"""
         return {
             "backend": "OpenVINO",
-            "model_id": Config.MODEL_ID,
+            "model_id": self.model_id,
             "device": self.device,
             "loaded": self.model_loaded,
             "cache_dir": self.ov_cache_dir,
             "available_devices": self.get_available_devices(),
             "generation_count": self._generation_count,
             "gpu_failed": self._gpu_failed,
-            "memory_info": self._get_memory_info()
+            "preferred_device": self.preferred_device,
+            "placement": self.placement,
+            "load_timings": self.load_timings,
+            "infer_slots": {
+                "slots": self.infer_slots,
+                "busy": self._slot_inflight
+            } if self.infer_slots > 1 else None,
+            "stages": self.stages.status() if Config.PIPELINED_STAGES else None,
+            "breaker": self.breaker.status() if self.breaker else None,
+            "memory_info": self._get_memory_info(),
+            "memory_watchdog": self.memory_watchdog.status()
         }
@@ -0,0 +1,203 @@
+# Copyright 2025 by trongton@gmail.com
+
+import queue
+import threading
+import time
+from services.metrics import metrics
+from services.tracing import activate, add_span, current_trace, span
+
+
+class StageRequest:
+    """One generation moving through the stages; each stage reads and fills fields"""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+        self.error = None
+        self.result = None
+        self.enqueued_at = time.perf_counter()
+        # Stage threads record into the trace of the thread that built the request
+        self.trace = current_trace()
+        self._done = threading.Event()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class StagedExecutor:
+    """Runs generations as a pipeline of stages with bounded queues between them
+
+    Every stage has one worker thread and an input queue of ``queue_size``
+    requests, so while job k is in the UNet loop, job k+1 can encode its prompt
+    and job k-1 can decode its latents. A request that fails in one stage
+    skips the rest and its error is re-raised in the caller. A full queue
+    blocks the stage (or the submitter) in front of it, which keeps the number
+    of latents and embeddings held in memory bounded.
+    """
+
+    def __init__(self, name, stages, queue_size=2):
+        self.name = name
+        self.stages = stages  # [(stage_name, fn(request)), ...]
+        self.queue_size = queue_size
+        self._queues = []
+        self._threads = []
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._idle = threading.Condition(self._lock)
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+            self._threads = []
+            for index, (stage_name, _) in enumerate(self.stages):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(index, self._queues),
+                    name=f"stage-{self.name}-{stage_name}",
+                    daemon=True
+                )
+                self._threads.append(thread)
+                thread.start()
+            self._started = True
+
+    def stop(self):
+        """Stop the workers once the queued requests have drained"""
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+            queues = self._queues
+        queues[0].put(None)
+
+    def submit(self, request):
+        """Queue ``request`` at the first stage (blocks while that queue is full)"""
+        self.start()
+        with self._lock:
+            self._inflight += 1
+            metrics.set_gauge(f'stages.{self.name}.inflight', self._inflight)
+            queues = self._queues
+        request.enqueued_at = time.perf_counter()
+        queues[0].put(request)
+
+    def wait(self, request):
+        """Wait for a submitted request and return the last stage's result"""
+        try:
+            return request.wait()
+        finally:
+            with self._lock:
+                self._inflight -= 1
+                metrics.set_gauge(f'stages.{self.name}.inflight', self._inflight)
+                if self._inflight == 0:
+                    self._idle.notify_all()
+
+    def run(self, request):
+        """Push ``request`` through every stage and return the last stage's result"""
+        self.submit(request)
+        return self.wait(request)
+
+    def idle(self):
+        with self._lock:
+            return self._inflight == 0
+
+    def wait_idle(self):
+        with self._lock:
+            while self._inflight:
+                self._idle.wait()
+
+    def status(self):
+        with self._lock:
+            return {
+                'inflight': self._inflight,
+                'queue_size': self.queue_size,
+                'queues': {
+                    stage_name: self._queues[index].qsize() if self._queues else 0
+                    for index, (stage_name, _) in enumerate(self.stages)
+                }
+            }
+
+    def _worker(self, index, queues):
+        stage_name, fn = self.stages[index]
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(queues) else None
+        while True:
+            request = inbox.get()
+            if request is None:
+                # Shutdown marker travels down the pipeline behind the last request
+                if outbox is not None:
+                    outbox.put(None)
+                return
+
+            metrics.observe(f'stages.{self.name}.{stage_name}.queue_wait',
+                            time.perf_counter() - request.enqueued_at)
+            with activate(request.trace):
+                add_span(f'stage.{stage_name}.queue_wait', request.enqueued_at, cat='queue')
+                if request.error is None:
+                    try:
+                        with metrics.time(f'stages.{self.name}.{stage_name}'), span(f'stage.{stage_name}'):
+                            request.result = fn(request)
+                    except BaseException as e:
+                        request.error = e
+
+            if outbox is None or request.error is not None:
+                request._done.set()
+            else:
+                request.enqueued_at = time.perf_counter()
+                outbox.put(request)
+
+
+def encode_stage(pipe, request):
+    """Text encoder: prompt and negative prompt embeddings"""
+    device = getattr(pipe, '_execution_device', 'cpu')
+    request.prompt_embeds, request.negative_prompt_embeds = pipe.encode_prompt(
+        request.prompt,
+        device,
+        1,
+        request.guidance.guidance_scale > 1.0,
+        request.negative_prompt or None
+    )
+
+
+def denoise_stage(pipe, request):
+    """UNet loop up to the final latents (no VAE decode)"""
+    from .early_exit import run_pipeline
+    result = run_pipeline(
+        pipe,
+        request.guidance,
+        prompt_embeds=request.prompt_embeds,
+        negative_prompt_embeds=request.negative_prompt_embeds,
+        width=request.width,
+        height=request.height,
+        num_inference_steps=request.num_inference_steps,
+        generator=request.generator,
+        output_type='latent',
+        **request.guidance.pipe_kwargs(pipe, request.callback)
+    )
+    request.latents = result.images
+    # Embeddings are no longer needed; free them before the decode queue
+    request.prompt_embeds = request.negative_prompt_embeds = None
+
+
+def decode_stage(pipe, request):
+    """VAE decode, optional safety check and conversion to a PIL image"""
+    latents = request.latents
+    request.latents = None
+    return decode_latents(pipe, latents)
+
+
+def decode_latents(pipe, latents):
+    """Decode one image's latents the way the pipeline's own output step does"""
+    image = pipe.vae.decode(latents / pipe.vae.config.scaling_factor, return_dict=False)[0]
+
+    do_denormalize = [True] * image.shape[0]
+    if getattr(pipe, 'safety_checker', None) is not None:
+        device = getattr(pipe, '_execution_device', 'cpu')
+        image, has_nsfw = pipe.run_safety_checker(image, device, image.dtype)
+        if has_nsfw is not None:
+            do_denormalize = [not nsfw for nsfw in has_nsfw]
+
+    return pipe.image_processor.postprocess(image, output_type='pil', do_denormalize=do_denormalize)[0]
@@ -0,0 +1,86 @@
+# Copyright 2025 by trongton@gmail.com
+
+"""
+Prepare models ahead of deployment: export, compile and warm up
+
+    python prepare.py                                 # MODEL_ID and MODEL_IDS on DEVICE
+    python prepare.py --model-id runwayml/stable-diffusion-v1-5 --device GPU --device CPU
+    python prepare.py --no-warmup
+
+On the OpenVINO backend this exports each model to ov_models/ if it is not
+there yet and compiles it for every device with the compiled-blob cache
+(OV_COMPILE_CACHE_DIR) enabled. Server starts and device switches then only
+read the IR and import the cached blobs. On the PyTorch backend it downloads
+the weights (and, with CPU_PERF_MODE, fills the torch.compile cache).
+
+Prints the per-phase load timings of every model and device and exits with
+status 1 if any of them failed.
+"""
+
+import argparse
+import sys
+import time
+from config import Config
+from models import StableDiffusionModel, StableDiffusionModelOpenVINO
+
+
+def prepare(model_id, device, warmup):
+    factory = StableDiffusionModelOpenVINO if Config.USE_OPENVINO else StableDiffusionModel
+    model = factory(device, model_id=model_id)
+    model.allow_cpu_fallback = False
+
+    start = time.time()
+    model.load_model()
+    timings = dict(getattr(model, 'load_timings', None) or {})
+    timings['load_model'] = round(time.time() - start, 3)
+
+    if warmup:
+        # Generation at the default size, so shape-specific kernels are built too
+        warmup_start = time.time()
+        model.generate_image(
+            "warmup",
+            width=Config.DEFAULT_WIDTH,
+            height=Config.DEFAULT_HEIGHT,
+            num_inference_steps=2,
+            seed=0
+        )
+        timings['warmup_generation'] = round(time.time() - warmup_start, 3)
+
+    model.unload_model()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-id', action='append', help='Model to prepare (repeatable)')
+    parser.add_argument('--device', action='append', help='Device to compile for (repeatable)')
+    parser.add_argument('--no-warmup', action='store_true', help='Skip the warmup generation')
+    args = parser.parse_args()
+
+    model_ids = args.model_id or list(dict.fromkeys([Config.MODEL_ID] + Config.MODEL_IDS))
+    devices = [
+        device.upper() if Config.USE_OPENVINO else device.lower()
+        for device in args.device or [Config.DEVICE]
+    ]
+    if Config.USE_OPENVINO and Config.OV_COMPILE_CACHE:
+        print(f"Compiled blobs are cached in {Config.OV_COMPILE_CACHE_DIR}")
+
+    failed = False
+    for model_id in model_ids:
+        for device in devices:
+            print(f"\n=== Preparing {model_id} on {device} ===")
+            try:
+                timings = prepare(model_id, device, not args.no_warmup)
+            except Exception as e:
+                print(f"[PREPARE] {model_id} on {device} failed: {e}")
+                failed = True
+                continue
+            print(f"[PREPARE] {model_id} on {device} ready")
+            for phase, value in timings.items():
+                print(f"    {phase:<20} {value}")
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
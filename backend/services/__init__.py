@@ -0,0 +1,22 @@
+# Copyright 2025 by trongton@gmail.com
+
+from .model_manager import ModelManager
+from .model_registry import ModelRegistry
+from .output_store import OutputStore
+from .thumbnails import ThumbnailGenerator
+from .postprocess import ImagePostProcessor, OutputTarget, encode_image
+from .metrics import metrics, MetricsRegistry
+from .device_slots import DeviceSlots
+from .trace import RequestTraceRecorder
+from .tracing import Trace, Tracer
+from .jobs import Job, JobTracker, request_key
+from .job_queue import JobQueue, SQLiteJobQueue, RedisJobQueue, create_job_queue
+from .load_shedding import LoadShedder
+
+__all__ = [
+    'ModelManager', 'ModelRegistry', 'OutputStore', 'ThumbnailGenerator',
+    'ImagePostProcessor', 'OutputTarget', 'encode_image',
+    'metrics', 'MetricsRegistry', 'DeviceSlots',
+    'RequestTraceRecorder', 'Trace', 'Tracer', 'Job', 'JobTracker', 'request_key',
+    'JobQueue', 'SQLiteJobQueue', 'RedisJobQueue', 'create_job_queue', 'LoadShedder'
+]
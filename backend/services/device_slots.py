@@ -0,0 +1,152 @@
+# Copyright 2025 by trongton@gmail.com
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from .metrics import metrics
+from .tracing import add_span
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process limit
+    fcntl = None
+
+
+class DeviceSlots:
+    """Cross-process limit on how many workers run on one device at a time
+
+    Every gunicorn worker has its own compiled pipeline, so nothing in-process
+    stops N workers from launching N jobs on the same GPU. Each limited device
+    gets ``slots`` lock files under ``lock_dir`` and a worker process holds an
+    exclusive ``flock`` on one of them while it has jobs on the device. The
+    jobs of one process share its slot (flocks on separate descriptors of one
+    process would exclude each other), so in-process concurrency such as
+    OV_INFER_SLOTS, PIPELINED_STAGES or ``worker.py --concurrency`` still
+    overlaps. A process that waits for a slot leaves a locked marker file
+    under ``lock_dir``; while one exists, the holders stop letting new jobs
+    join their slot, so it is released between jobs and the waiters, oldest
+    marker first, get their turn. The kernel releases the lock when a worker
+    dies, so a crashed worker never leaks its slot. CPU is not limited: workers there split the
+    cores between them instead.
+    """
+
+    def __init__(self, lock_dir, gpu_slots=1, poll_interval=0.05):
+        self.lock_dir = lock_dir
+        self.gpu_slots = gpu_slots
+        self.poll_interval = poll_interval
+        # Per device: [fd, slot, jobs of this process using it]
+        self._held = {}
+        self._lock = threading.Lock()
+        # Serializes taking a device's flock so a process never holds two
+        self._claiming = {}
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def slots_for(self, device):
+        if fcntl is None or not device or str(device).lower() == 'cpu':
+            return 0
+        return self.gpu_slots
+
+    @contextmanager
+    def acquire(self, device):
+        """Hold this process's slot of ``device`` for the duration of a job"""
+        slots = self.slots_for(device)
+        if slots <= 0:
+            yield None
+            return
+
+        name = str(device).lower().replace('.', '_')
+        held = self._join(name) if not self._waiters(name) else None
+        if held is None:
+            with self._lock:
+                claiming = self._claiming.setdefault(name, threading.Lock())
+            with claiming:
+                # Another job of this process may have taken the slot meanwhile
+                held = self._join(name) if not self._waiters(name) else None
+                if held is None:
+                    held = self._claim(name, slots, device)
+
+        try:
+            yield held[1]
+        finally:
+            with self._lock:
+                held[2] -= 1
+                if held[2] == 0:
+                    del self._held[name]
+                    fcntl.flock(held[0], fcntl.LOCK_UN)
+                    os.close(held[0])
+
+    def _join(self, name):
+        with self._lock:
+            held = self._held.get(name)
+            if held is not None:
+                held[2] += 1
+            return held
+
+    def _claim(self, name, slots, device):
+        """Wait for a free lock file of ``name``; returns the held entry"""
+        wait_start = time.perf_counter()
+        fd = None
+        marker = since = None
+        try:
+            while fd is None:
+                # Leave the slot to processes that started waiting earlier
+                if marker is None or not self._waiters(name, before=since):
+                    for slot in range(slots):
+                        fd = self._try_lock(os.path.join(self.lock_dir, f"{name}.{slot}.lock"))
+                        if fd is not None:
+                            break
+                if fd is None:
+                    if marker is None:
+                        metrics.inc('device_slots.waits')
+                        path = os.path.join(self.lock_dir, f"{name}.wait.{os.getpid()}")
+                        marker = (path, self._try_lock(path))
+                        since = os.stat(path).st_mtime_ns
+                    time.sleep(self.poll_interval)
+        finally:
+            if marker is not None:
+                self._remove_marker(*marker)
+        metrics.observe('device_slots.wait', time.perf_counter() - wait_start)
+        add_span('device_slot.wait', wait_start, cat='queue', device=str(device), slot=slot)
+        with self._lock:
+            held = self._held[name] = [fd, slot, 1]
+        return held
+
+    def _waiters(self, name, before=None):
+        """Whether other processes wait for a slot of ``name`` (those that started before ``before``)"""
+        prefix = f"{name}.wait."
+        own = f"{prefix}{os.getpid()}"
+        for entry in os.listdir(self.lock_dir):
+            if not entry.startswith(prefix) or entry == own:
+                continue
+            path = os.path.join(self.lock_dir, entry)
+            try:
+                if before is not None and os.stat(path).st_mtime_ns >= before:
+                    continue
+            except FileNotFoundError:
+                continue
+            fd = self._try_lock(path)
+            if fd is None:
+                return True
+            # Its process died (or just stopped waiting): clear the marker
+            self._remove_marker(path, fd)
+        return False
+
+    @staticmethod
+    def _remove_marker(path, fd):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        if fd is not None:
+            os.close(fd)
+
+    @staticmethod
+    def _try_lock(path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except OSError:
+            os.close(fd)
+            return None
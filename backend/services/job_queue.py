@@ -0,0 +1,521 @@
+# Copyright 2025 by trongton@gmail.com
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from .metrics import metrics
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class JobQueue:
+    """Generation jobs shared by API nodes and inference workers
+
+    API nodes ``enqueue`` requests and read job state back by job id or by
+    the session that submitted it, so any node can answer progress and result
+    queries for any job. Workers ``claim`` the oldest queued job, report
+    ``progress`` (which tells them when the job was cancelled), ``complete``
+    it with the response body or an error, and ``heartbeat`` their counters
+    so queue depth and per-worker throughput can be reported. Jobs claimed
+    by a worker that stopped heartbeating are requeued.
+
+    Job records are dicts with ``job_id``, ``session_id``, ``status``,
+    ``parameters``, ``current_step``, ``total_steps``, ``worker_id``,
+    ``result``, ``error`` and the ``created_at`` / ``started_at`` /
+    ``finished_at`` timestamps.
+    """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STOPPED = 'stopped'
+    FINISHED = (DONE, FAILED, STOPPED)
+
+    def __init__(self, retention_seconds=3600, worker_timeout=60, poll_interval=0.25):
+        self.retention_seconds = retention_seconds
+        self.worker_timeout = worker_timeout
+        self.poll_interval = poll_interval
+
+    def enqueue(self, parameters, session_id=None, total_steps=None):
+        """Queue a generation; returns its job id"""
+        raise NotImplementedError
+
+    def claim(self, worker_id, timeout=1.0):
+        """Take the oldest queued job for ``worker_id``; returns its record or None after ``timeout``"""
+        raise NotImplementedError
+
+    def progress(self, job_id, step, total_steps):
+        """Record progress; returns True if the job has been cancelled"""
+        raise NotImplementedError
+
+    def complete(self, job_id, status, result=None, error=None):
+        raise NotImplementedError
+
+    def cancel(self, job_id):
+        """Cancel a job; a queued job stops at once, a running one at its next step
+
+        Returns False if the job is unknown or already finished.
+        """
+        raise NotImplementedError
+
+    def get(self, job_id):
+        raise NotImplementedError
+
+    def job_for_session(self, session_id):
+        """Latest job id submitted by ``session_id``, or None"""
+        raise NotImplementedError
+
+    def heartbeat(self, worker_id, info):
+        """Publish a worker's status (``info`` is a JSON-serializable dict)"""
+        raise NotImplementedError
+
+    def workers(self):
+        """Status of the workers seen within ``worker_timeout``"""
+        raise NotImplementedError
+
+    def depth(self):
+        """Queued and running job counts"""
+        raise NotImplementedError
+
+    def requeue_stale(self):
+        """Put jobs of workers that stopped heartbeating back in the queue; returns how many
+
+        Their jobs that were cancelled while running are marked stopped instead.
+        """
+        raise NotImplementedError
+
+    def wait(self, job_id, timeout):
+        """Poll until the job finishes; returns its record (unfinished on timeout)"""
+        deadline = time.time() + timeout
+        while True:
+            record = self.get(job_id)
+            if record is None or record['status'] in self.FINISHED or time.time() >= deadline:
+                return record
+            time.sleep(self.poll_interval)
+
+    def stats(self):
+        depth = self.depth()
+        metrics.set_gauge('queue.depth', depth['queued'])
+        metrics.set_gauge('queue.running', depth['running'])
+        workers = self.workers()
+        return dict(
+            depth,
+            backend=self.backend,
+            workers=workers,
+            images_per_sec=round(sum(w.get('images_per_sec') or 0 for w in workers), 4)
+        )
+
+    @staticmethod
+    def _new_record(parameters, session_id, total_steps):
+        return {
+            'job_id': str(uuid.uuid4()),
+            'session_id': session_id,
+            'status': JobQueue.QUEUED,
+            'parameters': parameters,
+            'current_step': 0,
+            'total_steps': total_steps or parameters.get('num_inference_steps') or 0,
+            'worker_id': None,
+            'result': None,
+            'error': None,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None
+        }
+
+
+class SQLiteJobQueue(JobQueue):
+    """Queue in one SQLite file, for a single host or a shared volume in tests
+
+    Several processes can use the same file: claims run in an immediate
+    transaction so exactly one worker gets each job.
+    """
+
+    backend = 'sqlite'
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            session_id TEXT,
+            status TEXT NOT NULL,
+            parameters TEXT NOT NULL,
+            current_step INTEGER NOT NULL DEFAULT 0,
+            total_steps INTEGER NOT NULL DEFAULT 0,
+            worker_id TEXT,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at);
+        CREATE INDEX IF NOT EXISTS idx_jobs_session ON jobs (session_id, created_at);
+        CREATE TABLE IF NOT EXISTS workers (
+            worker_id TEXT PRIMARY KEY,
+            info TEXT NOT NULL,
+            last_seen REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+
+    def _conn(self):
+        # One connection per thread (and per process: the pid check covers fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, parameters, session_id=None, total_steps=None):
+        record = self._new_record(parameters, session_id, total_steps)
+        self._conn().execute(
+            'INSERT INTO jobs (job_id, session_id, status, parameters, total_steps, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (record['job_id'], session_id, self.QUEUED, json.dumps(parameters),
+             record['total_steps'], record['created_at'])
+        )
+        metrics.inc('queue.enqueued')
+        return record['job_id']
+
+    def claim(self, worker_id, timeout=1.0):
+        deadline = time.time() + timeout
+        conn = self._conn()
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    'SELECT job_id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1',
+                    (self.QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        'UPDATE jobs SET status = ?, worker_id = ?, started_at = ? WHERE job_id = ?',
+                        (self.RUNNING, worker_id, time.time(), row['job_id'])
+                    )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            if row is not None:
+                return self.get(row['job_id'])
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def progress(self, job_id, step, total_steps):
+        conn = self._conn()
+        conn.execute(
+            'UPDATE jobs SET current_step = ?, total_steps = ? WHERE job_id = ?',
+            (step, total_steps, job_id)
+        )
+        row = conn.execute('SELECT cancelled FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return bool(row and row['cancelled'])
+
+    def complete(self, job_id, status, result=None, error=None):
+        self._conn().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE job_id = ?',
+            (status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
+        )
+        self._prune()
+
+    def cancel(self, job_id):
+        conn = self._conn()
+        queued = conn.execute(
+            'UPDATE jobs SET status = ?, cancelled = 1, finished_at = ? WHERE job_id = ? AND status = ?',
+            (self.STOPPED, time.time(), job_id, self.QUEUED)
+        ).rowcount
+        running = conn.execute(
+            'UPDATE jobs SET cancelled = 1 WHERE job_id = ? AND status = ?',
+            (job_id, self.RUNNING)
+        ).rowcount
+        return queued + running > 0
+
+    def get(self, job_id):
+        row = self._conn().execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        record.pop('cancelled')
+        record['parameters'] = json.loads(record['parameters'])
+        record['result'] = json.loads(record['result']) if record['result'] else None
+        return record
+
+    def job_for_session(self, session_id):
+        row = self._conn().execute(
+            'SELECT job_id FROM jobs WHERE session_id = ? ORDER BY created_at DESC LIMIT 1',
+            (session_id,)
+        ).fetchone()
+        return row['job_id'] if row else None
+
+    def heartbeat(self, worker_id, info):
+        self._conn().execute(
+            'INSERT OR REPLACE INTO workers (worker_id, info, last_seen) VALUES (?, ?, ?)',
+            (worker_id, json.dumps(info), time.time())
+        )
+
+    def workers(self):
+        cutoff = time.time() - self.worker_timeout
+        rows = self._conn().execute(
+            'SELECT worker_id, info, last_seen FROM workers WHERE last_seen >= ? ORDER BY worker_id',
+            (cutoff,)
+        ).fetchall()
+        return [
+            dict(json.loads(row['info']), worker_id=row['worker_id'], last_seen=row['last_seen'])
+            for row in rows
+        ]
+
+    def depth(self):
+        counts = dict(self._conn().execute(
+            'SELECT status, COUNT(*) FROM jobs WHERE status IN (?, ?) GROUP BY status',
+            (self.QUEUED, self.RUNNING)
+        ).fetchall())
+        return {'queued': counts.get(self.QUEUED, 0), 'running': counts.get(self.RUNNING, 0)}
+
+    def requeue_stale(self):
+        cutoff = time.time() - self.worker_timeout
+        stale = ('status = ? AND (worker_id IS NULL OR worker_id NOT IN '
+                 '(SELECT worker_id FROM workers WHERE last_seen >= ?))')
+        conn = self._conn()
+        # Jobs cancelled while running were never going to finish; end them
+        stopped = conn.execute(
+            f'UPDATE jobs SET status = ?, finished_at = ? WHERE cancelled = 1 AND {stale}',
+            (self.STOPPED, time.time(), self.RUNNING, cutoff)
+        ).rowcount
+        if stopped:
+            metrics.inc('queue.stale_stopped', stopped)
+        cursor = conn.execute(
+            'UPDATE jobs SET status = ?, worker_id = NULL, started_at = NULL, current_step = 0 '
+            f'WHERE cancelled = 0 AND {stale}',
+            (self.QUEUED, self.RUNNING, cutoff)
+        )
+        if cursor.rowcount:
+            metrics.inc('queue.requeued', cursor.rowcount)
+        return cursor.rowcount
+
+    def _prune(self):
+        cutoff = time.time() - self.retention_seconds
+        conn = self._conn()
+        conn.execute(
+            'DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?',
+            (cutoff,)
+        )
+        conn.execute('DELETE FROM workers WHERE last_seen < ?', (cutoff,))
+
+
+class RedisJobQueue(JobQueue):
+    """Queue on a Redis-protocol server (Redis, Valkey, KeyDB, ...) for multi-node setups
+
+    Queued job ids sit in a list. A claim moves the id atomically (BLMOVE)
+    into the worker's processing list, then marks the job running, adds it
+    to the running set and drops it from that list in one transaction, so a
+    worker dying between the two leaves the job recoverable. Each job is a
+    hash with a TTL once finished, and worker status is a hash. Needs the
+    ``redis`` package (and Redis 6.2+ for BLMOVE).
+    """
+
+    backend = 'redis'
+
+    def __init__(self, url, prefix='sd', **kwargs):
+        super().__init__(**kwargs)
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("QUEUE_BACKEND=redis needs the redis package (pip install redis)")
+        self.url = url
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def enqueue(self, parameters, session_id=None, total_steps=None):
+        record = self._new_record(parameters, session_id, total_steps)
+        job_id = record['job_id']
+        pipe = self._redis.pipeline()
+        pipe.hset(self._key('job', job_id), mapping=self._encode(record))
+        if session_id:
+            pipe.set(self._key('session', session_id), job_id, ex=self.retention_seconds)
+        pipe.rpush(self._key('queue'), job_id)
+        pipe.execute()
+        metrics.inc('queue.enqueued')
+        return job_id
+
+    def claim(self, worker_id, timeout=1.0):
+        deadline = time.time() + timeout
+        processing = self._key('processing', worker_id)
+        self._redis.sadd(self._key('processing'), worker_id)
+        while True:
+            remaining = max(1, int(round(deadline - time.time())))
+            job_id = self._redis.blmove(self._key('queue'), processing, remaining, 'LEFT', 'RIGHT')
+            if job_id is None:
+                return None
+            key = self._key('job', job_id)
+            # A job cancelled while a worker was taking it; skip it
+            if self._redis.hget(key, 'status') != self.QUEUED:
+                self._redis.lrem(processing, 0, job_id)
+                if time.time() >= deadline:
+                    return None
+                continue
+            pipe = self._redis.pipeline(transaction=True)
+            pipe.hset(key, mapping={'status': self.RUNNING, 'worker_id': worker_id, 'started_at': time.time()})
+            pipe.sadd(self._key('running'), job_id)
+            pipe.lrem(processing, 0, job_id)
+            pipe.execute()
+            return self.get(job_id)
+
+    def progress(self, job_id, step, total_steps):
+        key = self._key('job', job_id)
+        pipe = self._redis.pipeline()
+        pipe.hset(key, mapping={'current_step': step, 'total_steps': total_steps})
+        pipe.hget(key, 'cancelled')
+        return pipe.execute()[1] == '1'
+
+    def complete(self, job_id, status, result=None, error=None):
+        key = self._key('job', job_id)
+        pipe = self._redis.pipeline()
+        pipe.hset(key, mapping={
+            'status': status,
+            'result': json.dumps(result) if result is not None else '',
+            'error': error or '',
+            'finished_at': time.time()
+        })
+        pipe.expire(key, self.retention_seconds)
+        pipe.srem(self._key('running'), job_id)
+        pipe.execute()
+
+    def cancel(self, job_id):
+        key = self._key('job', job_id)
+        status = self._redis.hget(key, 'status')
+        if status == self.QUEUED:
+            # Out of the list too, so the queue depth load shedding reads stays true
+            pipe = self._redis.pipeline(transaction=True)
+            pipe.hset(key, mapping={'status': self.STOPPED, 'cancelled': 1, 'finished_at': time.time()})
+            pipe.expire(key, self.retention_seconds)
+            pipe.lrem(self._key('queue'), 0, job_id)
+            pipe.execute()
+            return True
+        if status == self.RUNNING:
+            self._redis.hset(key, 'cancelled', 1)
+            return True
+        return False
+
+    def get(self, job_id):
+        data = self._redis.hgetall(self._key('job', job_id))
+        return self._decode(data) if data else None
+
+    def job_for_session(self, session_id):
+        return self._redis.get(self._key('session', session_id))
+
+    def heartbeat(self, worker_id, info):
+        self._redis.hset(self._key('workers'), worker_id, json.dumps(dict(info, last_seen=time.time())))
+
+    def workers(self):
+        cutoff = time.time() - self.worker_timeout
+        workers = []
+        for worker_id, info in sorted(self._redis.hgetall(self._key('workers')).items()):
+            info = json.loads(info)
+            if info.get('last_seen', 0) >= cutoff:
+                workers.append(dict(info, worker_id=worker_id))
+            elif info.get('last_seen', 0) < time.time() - self.retention_seconds:
+                self._redis.hdel(self._key('workers'), worker_id)
+        return workers
+
+    def depth(self):
+        pipe = self._redis.pipeline()
+        pipe.llen(self._key('queue'))
+        pipe.scard(self._key('running'))
+        queued, running = pipe.execute()
+        return {'queued': queued, 'running': running}
+
+    def requeue_stale(self):
+        alive = {worker['worker_id'] for worker in self.workers()}
+        requeued = 0
+        stopped = 0
+        # Jobs a dead worker moved off the queue but never marked running
+        for worker_id in self._redis.smembers(self._key('processing')):
+            if worker_id in alive:
+                continue
+            processing = self._key('processing', worker_id)
+            for job_id in self._redis.lrange(processing, 0, -1):
+                if self._redis.hget(self._key('job', job_id), 'status') == self.QUEUED:
+                    self._redis.lpush(self._key('queue'), job_id)
+                    requeued += 1
+            self._redis.delete(processing)
+            self._redis.srem(self._key('processing'), worker_id)
+
+        for job_id in self._redis.smembers(self._key('running')):
+            key = self._key('job', job_id)
+            status, worker_id, cancelled = self._redis.hmget(key, 'status', 'worker_id', 'cancelled')
+            if status == self.RUNNING and worker_id in alive:
+                continue
+            self._redis.srem(self._key('running'), job_id)
+            if status != self.RUNNING:
+                continue
+            if cancelled == '1':
+                # Cancelled while running: nobody will report it, so end it here
+                self._redis.hset(key, mapping={'status': self.STOPPED, 'finished_at': time.time()})
+                self._redis.expire(key, self.retention_seconds)
+                stopped += 1
+                continue
+            self._redis.hset(key, mapping={'status': self.QUEUED, 'worker_id': '', 'current_step': 0})
+            self._redis.lpush(self._key('queue'), job_id)
+            requeued += 1
+        if stopped:
+            metrics.inc('queue.stale_stopped', stopped)
+        if requeued:
+            metrics.inc('queue.requeued', requeued)
+        return requeued
+
+    @staticmethod
+    def _encode(record):
+        return {
+            key: json.dumps(value) if key in ('parameters', 'result') else ('' if value is None else value)
+            for key, value in record.items()
+        }
+
+    @staticmethod
+    def _decode(data):
+        record = {
+            'job_id': data.get('job_id'),
+            'session_id': data.get('session_id') or None,
+            'status': data.get('status'),
+            'parameters': json.loads(data['parameters']) if data.get('parameters') else None,
+            'current_step': int(data.get('current_step') or 0),
+            'total_steps': int(data.get('total_steps') or 0),
+            'worker_id': data.get('worker_id') or None,
+            'result': json.loads(data['result']) if data.get('result') else None,
+            'error': data.get('error') or None
+        }
+        for field in ('created_at', 'started_at', 'finished_at'):
+            record[field] = float(data[field]) if data.get(field) else None
+        return record
+
+
+def create_job_queue(backend, url, **kwargs):
+    """Queue for QUEUE_BACKEND ('sqlite' or 'redis'), or None when the setting is empty"""
+    backend = (backend or '').lower()
+    if not backend:
+        return None
+    if backend == 'sqlite':
+        return SQLiteJobQueue(url, **kwargs)
+    if backend == 'redis':
+        return RedisJobQueue(url, **kwargs)
+    raise ValueError(f"Unknown QUEUE_BACKEND '{backend}' (expected sqlite or redis)")
@@ -0,0 +1,276 @@
+# Copyright 2025 by trongton@gmail.com
+
+import hashlib
+import json
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from .metrics import metrics
+
+
+def request_key(parameters):
+    """Hash of the normalized generation parameters
+
+    Returns None when the result is not reproducible (no seed) or the values
+    cannot be normalized; such requests always get their own job.
+    """
+    if parameters.get('seed') is None:
+        return None
+    try:
+        normalized = {
+            'prompt': str(parameters.get('prompt') or '').strip(),
+            'negative_prompt': str(parameters.get('negative_prompt') or '').strip(),
+            'width': int(parameters['width']),
+            'height': int(parameters['height']),
+            'num_inference_steps': int(parameters['num_inference_steps']),
+            'guidance_scale': float(parameters['guidance_scale']),
+            'guidance_truncation': float(parameters.get('guidance_truncation') or 0.0),
+            'hires': parameters.get('hires'),
+            'early_exit': parameters.get('early_exit'),
+            'deep_cache': parameters.get('deep_cache'),
+            'seed': int(parameters['seed']),
+            'model_id': parameters.get('model_id')
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+    encoded = json.dumps(normalized, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class Job:
+    """One generation run, shared by every request with the same parameters"""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STOPPED = 'stopped'
+
+    def __init__(self, key, total_steps, event_buffer=64):
+        self.job_id = str(uuid.uuid4())
+        self.key = key
+        self.total_steps = total_steps
+        self.current_step = 0
+        self.status = self.QUEUED
+        self.subscribers = set()
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.first_step_at = None
+        self.finished_at = None
+        # Replay log for progress streams: (event_id, data) with monotonic ids
+        self.events = deque(maxlen=event_buffer)
+        self.last_event_id = 0
+        # Timeline of the run if it was sampled for tracing
+        self.trace = None
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED, self.STOPPED)
+
+    def progress(self):
+        percentage = int(self.current_step / self.total_steps * 100) if self.total_steps else 0
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'current_step': self.current_step,
+            'total_steps': self.total_steps,
+            'is_generating': not self.finished,
+            'percentage': percentage,
+            'subscribers': len(self.subscribers)
+        }
+
+
+class JobTracker:
+    """Single-flight generation jobs keyed by normalized request parameters
+
+    A request whose key matches a queued or running job subscribes to it
+    instead of starting another diffusion run; every subscriber shares the
+    job's progress and result. Each job runs on its own thread so no request
+    thread owns it: stopping a session only detaches that subscriber, and the
+    job is cancelled (at its next step) once nobody is subscribed. Finished
+    jobs stay visible to progress queries for ``retention_seconds``.
+
+    Progress and completion are also recorded as numbered events in a
+    per-job ring buffer of ``event_buffer`` entries, so a progress stream
+    that reconnects with the last id it saw resumes where it left off.
+    """
+
+    def __init__(self, retention_seconds=60, event_buffer=64):
+        self.retention_seconds = retention_seconds
+        self.event_buffer = event_buffer
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._jobs = {}
+        self._by_key = {}
+        self._by_session = {}
+        metrics.set_gauge('jobs.active', 0)
+
+    def submit(self, key, session_id, total_steps, run, trace=None):
+        """Subscribe ``session_id`` to the job for ``key``, starting ``run(job)`` if none is in flight
+
+        A new job takes ``trace`` as its timeline. Returns ``(job, created)``.
+        """
+        with self._lock:
+            self._prune_locked()
+            job = self._by_key.get(key) if key else None
+            created = job is None
+            if created:
+                job = Job(key, total_steps, self.event_buffer)
+                job.trace = trace
+                self._jobs[job.job_id] = job
+                if key:
+                    self._by_key[key] = job
+                metrics.add_gauge('jobs.active', 1)
+            else:
+                metrics.inc('jobs.coalesced')
+                print(f"[JOBS] Session {session_id} attached to in-flight job {job.job_id}")
+            job.subscribers.add(session_id)
+            self._by_session[session_id] = job
+
+        if created:
+            threading.Thread(
+                target=self._run,
+                args=(job, run),
+                name=f"job-{job.job_id[:8]}",
+                daemon=True
+            ).start()
+        return job, created
+
+    def wait(self, job, session_id):
+        """Block until the job finishes or ``session_id`` is detached
+
+        Returns the job's final status, or ``'detached'``.
+        """
+        with self._lock:
+            while not job.finished:
+                if session_id not in job.subscribers:
+                    return 'detached'
+                self._changed.wait()
+            return job.status
+
+    def step(self, job, step, total_steps):
+        """Record progress from the pipeline callback; raises StopIteration once nobody is subscribed"""
+        with self._lock:
+            if job.first_step_at is None:
+                job.first_step_at = time.time()
+            job.status = Job.RUNNING
+            if step != job.current_step:
+                job.current_step = step
+                job.total_steps = total_steps
+                progress = job.progress()
+                self._emit_locked(job, {
+                    'type': 'progress',
+                    'current_step': step,
+                    'total_steps': total_steps,
+                    'percentage': progress['percentage'],
+                    'subscribers': progress['subscribers']
+                })
+            if not job.subscribers:
+                raise StopIteration("Generation stopped by user")
+
+    def events_after(self, job, last_event_id, timeout):
+        """Events of ``job`` with an id above ``last_event_id``
+
+        Waits up to ``timeout`` seconds for one to arrive; returns an empty
+        list on timeout, once the job is finished and fully delivered, or if
+        the caller should re-check its subscription. Events older than the
+        buffer are gone, but progress events carry the absolute step, so a
+        resumed stream only misses intermediate steps.
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            while job.last_event_id <= last_event_id and not job.finished:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                subscribers = len(job.subscribers)
+                self._changed.wait(remaining)
+                if len(job.subscribers) < subscribers:
+                    # Someone detached; let the stream check whether it was this session
+                    break
+            return [(event_id, data) for event_id, data in job.events if event_id > last_event_id]
+
+    def detach(self, session_id):
+        """Unsubscribe one session; returns False if it had no unfinished job"""
+        with self._lock:
+            job = self._by_session.get(session_id)
+            if job is None or job.finished or session_id not in job.subscribers:
+                return False
+            job.subscribers.discard(session_id)
+            if not job.subscribers and self._by_key.get(job.key) is job:
+                # Nobody wants this result any more; a new identical request starts fresh
+                del self._by_key[job.key]
+            metrics.inc('jobs.detached')
+            self._changed.notify_all()
+            return True
+
+    def get(self, session_id):
+        """Job a session is (or was recently) subscribed to, or None"""
+        with self._lock:
+            return self._by_session.get(session_id)
+
+    def get_job(self, job_id):
+        """Job by id while it is in flight or retained, or None"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def progress(self, session_id):
+        with self._lock:
+            job = self._by_session.get(session_id)
+            return job.progress() if job else None
+
+    def status(self):
+        with self._lock:
+            active = [job for job in self._jobs.values() if not job.finished]
+            return {
+                'active': len(active),
+                'subscribers': sum(len(job.subscribers) for job in active),
+                'jobs': [job.progress() for job in active]
+            }
+
+    def _run(self, job, run):
+        result, error = None, None
+        try:
+            result = run(job)
+            status = Job.DONE
+        except StopIteration:
+            status = Job.STOPPED
+        except Exception as e:
+            print(f"[JOBS] Job {job.job_id} failed: {e}")
+            traceback.print_exc()
+            status = Job.FAILED
+            error = str(e)
+
+        with self._lock:
+            job.status = status
+            job.result = result
+            job.error = error
+            job.finished_at = time.time()
+            self._emit_locked(job, {'type': 'complete', 'status': status})
+            if self._by_key.get(job.key) is job:
+                del self._by_key[job.key]
+            metrics.add_gauge('jobs.active', -1)
+            metrics.inc(f'jobs.{status}')
+            self._changed.notify_all()
+
+    def _emit_locked(self, job, data):
+        job.last_event_id += 1
+        job.events.append((job.last_event_id, data))
+        self._changed.notify_all()
+
+    def _prune_locked(self):
+        cutoff = time.time() - self.retention_seconds
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+        if expired:
+            self._by_session = {
+                session_id: job for session_id, job in self._by_session.items()
+                if job.job_id in self._jobs
+            }
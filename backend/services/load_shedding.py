@@ -0,0 +1,149 @@
+# Copyright 2025 by trongton@gmail.com
+
+import json
+import math
+import threading
+from .metrics import metrics
+
+# What a ladder level may change on a request
+LEVEL_FIELDS = ('at', 'max_steps', 'max_size', 'guidance_truncation', 'deep_cache_interval', 'model_id')
+
+
+def parse_levels(levels):
+    """Ladder levels from a JSON string or a list of dicts, sorted by ``at``
+
+    Raises ValueError on unknown fields or a level without a threshold.
+    """
+    if isinstance(levels, str):
+        try:
+            levels = json.loads(levels or '[]')
+        except json.JSONDecodeError as e:
+            raise ValueError(f"LOAD_SHED_LEVELS is not valid JSON: {e}")
+    parsed = []
+    for level in levels:
+        unknown = set(level) - set(LEVEL_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown load shedding field(s): {', '.join(sorted(unknown))}")
+        if 'at' not in level:
+            raise ValueError(f"Load shedding level without 'at': {level}")
+        parsed.append(dict(level, at=float(level['at'])))
+    return sorted(parsed, key=lambda level: level['at'])
+
+
+class LoadShedder:
+    """Quality ladder for requests that allow degradation while the queue is backed up
+
+    The pressure is either the number of queued and running jobs
+    (``signal='depth'``) or the estimated wait before a new job starts
+    (``signal='wait'``): jobs ahead times the average service time of a job
+    (its run on the device, without queueing or model loads), divided by the
+    jobs run at once. The highest level whose ``at`` the pressure has
+    reached caps the steps and the longer side of the image, raises the
+    guidance truncation and DeepCache interval, or switches to a faster
+    model. At ``reject_at`` (0 = never) every request is turned away.
+    """
+
+    def __init__(self, levels, reject_at=0, signal='wait', capacity=1, job_seconds=10.0, deep_cache_branch=1):
+        if signal not in ('wait', 'depth'):
+            raise ValueError(f"Unknown load shedding signal {signal!r} (use 'wait' or 'depth')")
+        self.levels = parse_levels(levels)
+        self.reject_at = float(reject_at)
+        self.signal = signal
+        self.capacity = max(1, int(capacity))
+        self.deep_cache_branch = deep_cache_branch
+        self._job_seconds = float(job_seconds)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """Fold one finished job's service time into the average"""
+        with self._lock:
+            self._job_seconds = 0.8 * self._job_seconds + 0.2 * seconds
+
+    def decide(self, depth, capacity=None, job_seconds=None):
+        """Pressure for ``depth`` jobs ahead, the level that applies (None = full quality) and whether to reject
+
+        ``job_seconds`` overrides the observed average, e.g. with the one the
+        workers of the shared queue report.
+        """
+        capacity = max(1, capacity or self.capacity)
+        if job_seconds is None:
+            with self._lock:
+                job_seconds = self._job_seconds
+        wait = depth * job_seconds / capacity
+        value = depth if self.signal == 'depth' else wait
+        metrics.set_gauge('load_shed.estimated_wait', round(wait, 2))
+
+        decision = {
+            'signal': self.signal,
+            'depth': depth,
+            'estimated_wait': round(wait, 1),
+            'level': None,
+            'reject': bool(self.reject_at) and value >= self.reject_at,
+            'retry_after': None
+        }
+        for index, level in enumerate(self.levels):
+            if value >= level['at']:
+                decision['level'] = index
+        if decision['reject']:
+            # Until the pressure has drained below the hard limit
+            if self.signal == 'depth':
+                excess = (depth - self.reject_at + 1) * job_seconds / capacity
+            else:
+                excess = wait - self.reject_at + job_seconds / capacity
+            decision['retry_after'] = max(1, math.ceil(excess))
+        return decision
+
+    def apply(self, parameters, level, model_ids=()):
+        """Degrade ``parameters`` in place to ladder ``level``; returns {field: {requested, applied}}"""
+        level = self.levels[level]
+        changes = {}
+
+        def change(field, applied):
+            if applied == parameters[field]:
+                return
+            changes[field] = {'requested': parameters[field], 'applied': applied}
+            parameters[field] = applied
+
+        max_steps = level.get('max_steps')
+        if max_steps and parameters['num_inference_steps'] > max_steps:
+            change('num_inference_steps', int(max_steps))
+
+        max_size = level.get('max_size')
+        width, height = int(parameters['width']), int(parameters['height'])
+        if max_size and max(width, height) > max_size:
+            # Keep the aspect ratio, on the multiple of 8 the VAE needs
+            scale = max_size / max(width, height)
+            change('width', max(64, int(width * scale) // 8 * 8))
+            change('height', max(64, int(height * scale) // 8 * 8))
+
+        truncation = level.get('guidance_truncation')
+        if truncation is not None and parameters['guidance_truncation'] < truncation:
+            change('guidance_truncation', float(truncation))
+
+        interval = level.get('deep_cache_interval')
+        current = parameters.get('deep_cache') or {}
+        if interval and interval > current.get('interval', 1):
+            changes['deep_cache_interval'] = {'requested': current.get('interval', 1), 'applied': int(interval)}
+            parameters['deep_cache'] = {
+                'interval': int(interval),
+                'branch': current.get('branch', self.deep_cache_branch)
+            }
+
+        model_id = level.get('model_id')
+        if model_id and model_id != parameters['model_id']:
+            if model_id in model_ids:
+                change('model_id', model_id)
+            else:
+                print(f"[LOAD_SHED] {model_id} is not served here; keeping {parameters['model_id']}")
+        return changes
+
+    def status(self):
+        with self._lock:
+            job_seconds = self._job_seconds
+        return {
+            'signal': self.signal,
+            'levels': self.levels,
+            'reject_at': self.reject_at or None,
+            'capacity': self.capacity,
+            'average_job_seconds': round(job_seconds, 2)
+        }
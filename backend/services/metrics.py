@@ -0,0 +1,117 @@
+# Copyright 2025 by trongton@gmail.com
+
+import os
+import threading
+import time
+from collections import deque
+
+
+class MetricsRegistry:
+    """Thread-safe in-process counters, gauges and timers exposed at /api/metrics
+
+    Timers keep count/sum/min/max plus a window of recent samples for
+    percentiles, so a snapshot is cheap and memory stays bounded.
+    """
+
+    def __init__(self, window=512):
+        self._lock = threading.Lock()
+        self._window = window
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}
+        self._started_at = time.time()
+        if hasattr(os, 'register_at_fork'):
+            # A lock held by another thread at fork time would never be released
+            # in the child (gunicorn workers are forked after the app is imported)
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def add_gauge(self, name, delta):
+        with self._lock:
+            self._gauges[name] = self._gauges.get(name, 0) + delta
+
+    def observe(self, name, value):
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = {
+                    'count': 0,
+                    'sum': 0.0,
+                    'min': value,
+                    'max': value,
+                    'recent': deque(maxlen=self._window)
+                }
+                self._timers[name] = timer
+            timer['count'] += 1
+            timer['sum'] += value
+            timer['min'] = min(timer['min'], value)
+            timer['max'] = max(timer['max'], value)
+            timer['recent'].append(value)
+
+    def time(self, name):
+        """Context manager recording the elapsed seconds of a block under ``name``"""
+        return _Timer(self, name)
+
+    def get(self, name, default=0):
+        with self._lock:
+            if name in self._counters:
+                return self._counters[name]
+            return self._gauges.get(name, default)
+
+    def snapshot(self):
+        with self._lock:
+            timers = {}
+            for name, timer in self._timers.items():
+                recent = sorted(timer['recent'])
+                timers[name] = {
+                    'count': timer['count'],
+                    'avg': round(timer['sum'] / timer['count'], 6) if timer['count'] else 0,
+                    'min': round(timer['min'], 6),
+                    'max': round(timer['max'], 6),
+                    'p50': round(percentile(recent, 50), 6),
+                    'p95': round(percentile(recent, 95), 6),
+                    'p99': round(percentile(recent, 99), 6)
+                }
+            return {
+                'uptime': round(time.time() - self._started_at, 1),
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'timers': timers
+            }
+
+
+class _Timer:
+    def __init__(self, registry, name):
+        self._registry = registry
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._registry.observe(self._name, time.perf_counter() - self._start)
+        return False
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list (0 for an empty list)"""
+    if not sorted_values:
+        return 0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+# Process-wide registry shared by the app and its services
+metrics = MetricsRegistry()
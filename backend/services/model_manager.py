@@ -0,0 +1,344 @@
+# Copyright 2025 by trongton@gmail.com
+
+import threading
+import time
+from contextlib import contextmanager
+from config import Config
+
+
+class ModelManager:
+    """Owns the active model wrapper and swaps devices without stalling traffic
+
+    Requests borrow the active wrapper through ``acquire()``. A device switch
+    loads and compiles the target pipeline in a background thread while the
+    current one keeps serving, then rebinds the active wrapper under a lock.
+    Jobs already running finish on the old pipeline, which is unloaded once
+    its in-flight count drains to zero.
+    """
+
+    def __init__(self, model_factory, device=None, standby_device=None):
+        self._factory = model_factory
+        self._lock = threading.Lock()
+        self._drained = threading.Condition(self._lock)
+        self._inflight = {}
+
+        self._active = model_factory(device or Config.DEVICE)
+        # Device traffic should return to once it is healthy again
+        self.preferred_device = device or Config.DEVICE
+
+        # Optional warm standby pipeline used for instant failover
+        self.standby_device = standby_device
+        self._standby = None
+        self._standby_thread = None
+
+        self._switch_thread = None
+        self._switch_state = {
+            'status': 'idle',
+            'target_device': None,
+            'started_at': None,
+            'finished_at': None,
+            'load_time': None,
+            'error': None
+        }
+        self._configure_fallback(self._active)
+
+    @property
+    def model(self):
+        """Currently active wrapper (may change at any time, use acquire() to pin it)"""
+        return self._active
+
+    @property
+    def device(self):
+        return self._active.device
+
+    @property
+    def model_loaded(self):
+        return self._active.model_loaded
+
+    @property
+    def in_use(self):
+        with self._lock:
+            return sum(self._inflight.values()) > 0
+
+    @contextmanager
+    def acquire(self):
+        """Pin the active wrapper for the duration of a job"""
+        with self._lock:
+            model = self._active
+            self._inflight[id(model)] = self._inflight.get(id(model), 0) + 1
+        try:
+            yield model
+        finally:
+            with self._lock:
+                self._inflight[id(model)] -= 1
+                if self._inflight[id(model)] <= 0:
+                    del self._inflight[id(model)]
+                    self._drained.notify_all()
+
+    def load_weights(self):
+        """Read the active wrapper's weights without compiling (pre-fork preload)"""
+        self._active.load_weights()
+
+    def load_model(self):
+        """Load the active wrapper in the foreground and warm the standby if configured"""
+        with self.acquire() as model:
+            model.load_model()
+        self.ensure_standby()
+
+    def unload_model(self):
+        """Drain in-flight jobs and unload the active and standby pipelines"""
+        with self._lock:
+            active = self._active
+            standby = self._standby
+            self._standby = None
+            while self._inflight.get(id(active), 0) > 0:
+                self._drained.wait()
+            if active.model_loaded:
+                active.unload_model()
+            self._configure_fallback(active)
+
+        if standby is not None and standby.model_loaded:
+            standby.unload_model()
+
+    def generate_image(self, **kwargs):
+        """Run a generation on the active wrapper, failing over to the standby on device errors"""
+        with self.acquire() as model:
+            try:
+                image = model.generate_image(**kwargs)
+                return image, model
+            except StopIteration:
+                raise
+            except Exception as e:
+                if not self._can_fail_over(model):
+                    raise
+                print(f"[SWAP] Generation failed on {model.device} ({e}), failing over to standby")
+
+        standby = self.fail_over()
+        with self.acquire() as model:
+            if model is not standby:
+                print(f"[SWAP] Standby was replaced during failover, using {model.device}")
+            image = model.generate_image(**kwargs)
+            return image, model
+
+    def switch_device(self, new_device, wait=False):
+        """Start a background switch to ``new_device``; returns the switch state"""
+        with self._lock:
+            if self._switch_state['status'] == 'switching':
+                if self._switch_state['target_device'] == new_device:
+                    return dict(self._switch_state)
+                raise RuntimeError(
+                    f"A switch to {self._switch_state['target_device']} is already in progress"
+                )
+
+            active = self._active
+            if active.device == new_device and self._switch_state['status'] != 'failed':
+                self.preferred_device = new_device
+                self._switch_state.update({
+                    'status': 'idle',
+                    'target_device': new_device,
+                    'error': None
+                })
+                return dict(self._switch_state)
+
+            self.preferred_device = new_device
+            self._switch_state.update({
+                'status': 'switching',
+                'target_device': new_device,
+                'started_at': time.time(),
+                'finished_at': None,
+                'load_time': None,
+                'error': None
+            })
+            self._switch_thread = threading.Thread(
+                target=self._run_switch,
+                args=(new_device,),
+                name=f"device-switch-{new_device}",
+                daemon=True
+            )
+            self._switch_thread.start()
+            thread = self._switch_thread
+
+        if wait:
+            thread.join()
+        return self.switch_status()
+
+    def switch_status(self):
+        with self._lock:
+            return dict(self._switch_state)
+
+    def standby_status(self):
+        with self._lock:
+            standby = self._standby
+            loading = self._standby_thread is not None and self._standby_thread.is_alive()
+        return {
+            'device': self.standby_device,
+            'loaded': bool(standby and standby.model_loaded),
+            'loading': loading
+        }
+
+    def ensure_standby(self):
+        """Warm a standby pipeline in the background if one is configured and useful"""
+        if not self.standby_device:
+            return
+        with self._lock:
+            if self._active.device == self.standby_device:
+                return
+            if self._standby is not None:
+                return
+            if self._standby_thread is not None and self._standby_thread.is_alive():
+                return
+            self._standby_thread = threading.Thread(
+                target=self._load_standby,
+                name=f"standby-{self.standby_device}",
+                daemon=True
+            )
+            self._standby_thread.start()
+
+    def recover(self, device):
+        """Move back to ``device`` after its breaker closed, if it is the preferred one"""
+        with self._lock:
+            if self.preferred_device != device or self._active.device == device:
+                return None
+        print(f"[SWAP] {device} is healthy again, switching back")
+        return self.switch_device(device)
+
+    def fail_over(self):
+        """Promote the warm standby to active and retire the failed wrapper"""
+        with self._lock:
+            standby = self._standby
+            if standby is None or not standby.model_loaded:
+                raise RuntimeError("No warm standby pipeline available for failover")
+            old = self._active
+            self._active = standby
+            self._standby = None
+            self._configure_fallback(standby)
+
+        print(f"[SWAP] Failed over from {old.device} to standby {standby.device}")
+        # Jobs still on the failing pipeline may take long to drain; the
+        # request that failed over goes on with the standby meanwhile
+        threading.Thread(
+            target=self._retire,
+            args=(old,),
+            name=f"retire-{old.device}",
+            daemon=True
+        ).start()
+        return standby
+
+    def _run_switch(self, new_device):
+        load_start = time.time()
+        try:
+            with self._lock:
+                standby = self._standby
+                promote_standby = (
+                    standby is not None
+                    and standby.device == new_device
+                    and standby.model_loaded
+                )
+                if promote_standby:
+                    self._standby = None
+                keep_lazy = not self._active.model_loaded
+
+            if promote_standby:
+                print(f"[SWAP] Promoting warm standby on {new_device}")
+                candidate = standby
+            else:
+                candidate = self._factory(new_device)
+                if keep_lazy:
+                    # Nothing is loaded yet, so there is nothing to keep serving;
+                    # keep the original lazy loading behaviour
+                    print(f"[SWAP] No model loaded, {new_device} will load on next generation")
+                else:
+                    print(f"[SWAP] Loading standby pipeline on {new_device} in background...")
+                    candidate.load_model()
+
+            with self._lock:
+                old = self._active
+                self._active = candidate
+                self._configure_fallback(candidate)
+                self._switch_state.update({
+                    'status': 'done',
+                    'target_device': candidate.device,
+                    'finished_at': time.time(),
+                    'load_time': round(time.time() - load_start, 2),
+                    'load_timings': getattr(candidate, 'load_timings', None)
+                })
+
+            print(f"[SWAP] Now serving on {candidate.device}, draining {old.device}")
+            self._retire(old)
+            if candidate.model_loaded:
+                self.ensure_standby()
+
+        except Exception as e:
+            print(f"[SWAP] Device switch to {new_device} failed: {e}")
+            import traceback
+            traceback.print_exc()
+            with self._lock:
+                self._switch_state.update({
+                    'status': 'failed',
+                    'finished_at': time.time(),
+                    'error': str(e)
+                })
+
+    def _retire(self, old):
+        """Wait for in-flight jobs on ``old`` to finish, then unload it or keep it as standby"""
+        with self._lock:
+            while self._inflight.get(id(old), 0) > 0:
+                self._drained.wait()
+            keep_as_standby = (
+                self.standby_device
+                and old.device == self.standby_device
+                and old.model_loaded
+                and self._standby is None
+                and self._active.device != self.standby_device
+            )
+            if keep_as_standby:
+                self._standby = old
+
+        if keep_as_standby:
+            print(f"[SWAP] Keeping {old.device} pipeline warm as standby")
+            return
+
+        if old.model_loaded:
+            try:
+                old.unload_model()
+            except Exception as unload_error:
+                print(f"Warning: Error during model unloading: {unload_error}")
+
+        import gc
+        gc.collect()
+
+    def _load_standby(self):
+        try:
+            print(f"[SWAP] Warming standby pipeline on {self.standby_device}...")
+            standby = self._factory(self.standby_device)
+            standby.load_model()
+            with self._lock:
+                if self._standby is None and self._active.device != standby.device:
+                    self._standby = standby
+                    self._configure_fallback(self._active)
+                    standby = None
+            if standby is not None:
+                standby.unload_model()
+            else:
+                print(f"[SWAP] Standby pipeline ready on {self.standby_device}")
+        except Exception as e:
+            print(f"[SWAP] Failed to warm standby on {self.standby_device}: {e}")
+
+    def _can_fail_over(self, model):
+        # Only fail over once the device's breaker says it is unhealthy;
+        # a single transient error is returned to the caller
+        device_healthy = getattr(model, 'device_healthy', None)
+        if device_healthy is not None and device_healthy():
+            return False
+        with self._lock:
+            return (
+                model is self._active
+                and self._standby is not None
+                and self._standby.model_loaded
+                and model.device != self._standby.device
+            )
+
+    def _configure_fallback(self, model):
+        # Let the wrapper reload itself on CPU only when no standby can take over
+        if hasattr(model, 'allow_cpu_fallback'):
+            model.allow_cpu_fallback = not self.standby_device or self._standby is None
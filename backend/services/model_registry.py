@@ -0,0 +1,245 @@
+# Copyright 2025 by trongton@gmail.com
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from .tracing import span
+
+
+def get_process_rss_mb():
+    """Resident set size of this process in MB, or None if psutil is unavailable"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except Exception:
+        return None
+
+
+class ModelRegistry:
+    """Serves several model ids from one process under a shared memory budget
+
+    Each model id gets its own ModelManager. Pipelines are loaded on first use,
+    their footprint is measured as the RSS growth during loading, and the least
+    recently used idle pipeline is unloaded whenever loading another one would
+    exceed ``memory_budget_mb``. Evicted OpenVINO models reload quickly from the
+    ``ov_models`` cache on their next request.
+
+    ``device`` is where new managers start; only ``switch_device`` changes
+    it, so one model failing over leaves the others where they were.
+    """
+
+    def __init__(self, manager_factory, model_ids, default_model_id=None,
+                 memory_budget_mb=0, footprint_estimate_mb=0, device=None):
+        self._manager_factory = manager_factory
+        self.device = device
+        self.model_ids = list(dict.fromkeys(model_ids))
+        self.default_model_id = default_model_id or self.model_ids[0]
+        if self.default_model_id not in self.model_ids:
+            self.model_ids.insert(0, self.default_model_id)
+        self.memory_budget_mb = memory_budget_mb
+        self.footprint_estimate_mb = footprint_estimate_mb
+
+        self._lock = threading.Lock()
+        # Signalled when a model is unpinned or finishes an idle device switch
+        self._changed = threading.Condition(self._lock)
+        self._load_lock = threading.Lock()
+        self._switching = set()
+        self._managers = OrderedDict()  # model_id -> ModelManager, least recently used first
+        self._pins = {}
+        self._footprints = {}
+        self._last_used = {}
+        self._load_times = {}
+        self._evictions = 0
+
+        # The default model always has a manager so device state has a home
+        self._get_or_create(self.default_model_id)
+
+    def resolve(self, model_id=None):
+        """Map a requested model id to a served one, raising ValueError for unknown ids"""
+        if not model_id:
+            return self.default_model_id
+        if model_id not in self.model_ids:
+            raise ValueError(f"Unknown model_id: {model_id}. Available: {', '.join(self.model_ids)}")
+        return model_id
+
+    def get(self, model_id=None):
+        """Return the manager for ``model_id`` without loading or touching LRU order"""
+        model_id = self.resolve(model_id)
+        with self._lock:
+            return self._get_or_create(model_id)
+
+    @property
+    def default(self):
+        return self.get(self.default_model_id)
+
+    @contextmanager
+    def use(self, model_id=None):
+        """Pin a model for a job, loading it (and evicting others) if needed"""
+        model_id = self.resolve(model_id)
+        with self._lock:
+            manager = self._get_or_create(model_id)
+            # A model moving to another device is loaded there below, where
+            # its footprint is measured, not lazily by the wrapper
+            while model_id in self._switching:
+                self._changed.wait()
+            self._pins[model_id] = self._pins.get(model_id, 0) + 1
+            self._managers.move_to_end(model_id)
+            self._last_used[model_id] = time.time()
+        try:
+            if not manager.model_loaded:
+                self._load(model_id, manager)
+            yield manager
+        finally:
+            with self._lock:
+                self._pins[model_id] -= 1
+                self._last_used[model_id] = time.time()
+                self._changed.notify_all()
+
+    def load_model(self, model_id=None):
+        with self.use(model_id):
+            pass
+
+    def load_weights(self, model_id=None):
+        """Read a model's weights into memory without compiling it (see wsgi.py)"""
+        self.get(model_id).load_weights()
+
+    def unload_model(self, model_id):
+        model_id = self.resolve(model_id)
+        with self._lock:
+            manager = self._managers.get(model_id)
+        if manager is not None:
+            manager.unload_model()
+
+    def switch_device(self, new_device, wait=False):
+        """Switch every model to ``new_device``; returns the default model's switch state"""
+        with self._lock:
+            self.device = new_device
+            others = [
+                (model_id, manager) for model_id, manager in self._managers.items()
+                if model_id != self.default_model_id
+            ]
+        for model_id, manager in others:
+            # Only the default model is pre-loaded on the target device; the others
+            # are unloaded and come back lazily so a switch cannot double memory use
+            threading.Thread(
+                target=self._switch_idle,
+                args=(model_id, manager, new_device),
+                daemon=True
+            ).start()
+        return self.default.switch_device(new_device, wait=wait)
+
+    def resident_mb(self):
+        with self._lock:
+            return self._resident_mb_locked()
+
+    def status(self):
+        """Per-model residency information for the API"""
+        with self._lock:
+            models = []
+            for model_id in self.model_ids:
+                manager = self._managers.get(model_id)
+                models.append({
+                    'model_id': model_id,
+                    'default': model_id == self.default_model_id,
+                    'loaded': bool(manager and manager.model_loaded),
+                    'device': manager.device if manager else None,
+                    'in_use': self._pins.get(model_id, 0) > 0,
+                    'footprint_mb': self._rounded(self._footprints.get(model_id)),
+                    'load_time': self._load_times.get(model_id),
+                    'last_used': self._last_used.get(model_id)
+                })
+            return {
+                'models': models,
+                'memory_budget_mb': self.memory_budget_mb,
+                'resident_mb': self._rounded(self._resident_mb_locked()),
+                'evictions': self._evictions
+            }
+
+    def _get_or_create(self, model_id):
+        manager = self._managers.get(model_id)
+        if manager is None:
+            manager = self._manager_factory(model_id, self.device)
+            self._managers[model_id] = manager
+            self._managers.move_to_end(model_id, last=False)
+        return manager
+
+    def _load(self, model_id, manager):
+        # Loads are serialized so RSS deltas are attributable to one model
+        with self._load_lock:
+            if manager.model_loaded:
+                return
+            self._make_room(model_id)
+
+            rss_before = get_process_rss_mb()
+            load_start = time.time()
+            with span('model.load', cat='load', model_id=model_id):
+                manager.load_model()
+            rss_after = get_process_rss_mb()
+
+            with self._lock:
+                self._load_times[model_id] = round(time.time() - load_start, 2)
+                if rss_before is not None and rss_after is not None:
+                    self._footprints[model_id] = max(rss_after - rss_before, 0.0)
+            print(f"[REGISTRY] Loaded {model_id} "
+                  f"(footprint: {self._rounded(self._footprints.get(model_id))} MB)")
+
+    def _make_room(self, model_id):
+        if not self.memory_budget_mb:
+            return
+        needed = self._footprints.get(model_id, self.footprint_estimate_mb)
+        while True:
+            # The victim is unloaded under the lock it was picked idle under,
+            # so use() cannot pin it in between
+            with self._lock:
+                resident = self._resident_mb_locked()
+                if resident + needed <= self.memory_budget_mb:
+                    return
+                victim = None
+                for candidate_id, candidate in self._managers.items():
+                    if candidate_id == model_id or not candidate.model_loaded:
+                        continue
+                    if candidate_id in self._switching:
+                        continue
+                    if self._pins.get(candidate_id, 0) > 0 or candidate.in_use:
+                        continue
+                    victim = candidate_id
+                    break
+                if victim is None:
+                    print(f"[REGISTRY] Memory budget of {self.memory_budget_mb} MB exceeded "
+                          f"but every resident model is busy, loading {model_id} anyway")
+                    return
+                self._evictions += 1
+                print(f"[REGISTRY] Evicting least recently used model {victim} "
+                      f"to make room for {model_id}")
+                self._managers[victim].unload_model()
+
+    def _resident_mb_locked(self):
+        total = 0.0
+        for model_id, manager in self._managers.items():
+            if manager.model_loaded:
+                total += self._footprints.get(model_id, self.footprint_estimate_mb)
+        return total
+
+    def _switch_idle(self, model_id, manager, new_device):
+        # Wait until no job holds the model, then keep new jobs out until it
+        # has moved; otherwise a job that passed use()'s load check would load
+        # the new lazy wrapper itself, unmeasured
+        with self._lock:
+            while self._pins.get(model_id, 0) > 0:
+                self._changed.wait()
+            self._switching.add(model_id)
+        try:
+            if manager.model_loaded:
+                manager.unload_model()
+            manager.switch_device(new_device, wait=True)
+        except Exception as e:
+            print(f"[REGISTRY] Failed to move idle model to {new_device}: {e}")
+        finally:
+            with self._lock:
+                self._switching.discard(model_id)
+                self._changed.notify_all()
+
+    @staticmethod
+    def _rounded(value):
+        return round(value, 1) if value is not None else None
@@ -0,0 +1,357 @@
+# Copyright 2025 by trongton@gmail.com
+
+import base64
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class OutputStore:
+    """Sharded on-disk image store with an embedded SQLite index
+
+    Files live under ``root_dir/ab/cd/<image_id>.<ext>`` where ``abcd`` comes
+    from a hash of the image id, so no directory grows without bound. Every
+    image has a row in ``index.sqlite3`` keyed by image id (O(1) lookup) that
+    records its generation metadata and size. A background thread enforces the
+    retention policy (max age, max count, max total bytes), oldest first.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS images (
+            image_id TEXT PRIMARY KEY,
+            relpath TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            size_bytes INTEGER NOT NULL DEFAULT 0,
+            format TEXT,
+            prompt TEXT,
+            negative_prompt TEXT,
+            width INTEGER,
+            height INTEGER,
+            num_inference_steps INTEGER,
+            guidance_scale REAL,
+            seed INTEGER,
+            model_id TEXT,
+            device TEXT,
+            generation_time REAL,
+            parameters TEXT,
+            thumbnail_relpath TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_images_created_id ON images (created_at, image_id);
+    '''
+
+    # Columns added after the first schema version, applied to existing indexes
+    MIGRATIONS = [
+        ('thumbnail_relpath', 'ALTER TABLE images ADD COLUMN thumbnail_relpath TEXT'),
+    ]
+
+    def __init__(self, root_dir, index_path=None, max_age_days=0, max_count=0,
+                 max_bytes=0, retention_interval=300):
+        self.root_dir = os.path.abspath(root_dir)
+        os.makedirs(self.root_dir, exist_ok=True)
+        self.index_path = index_path or os.path.join(self.root_dir, 'index.sqlite3')
+
+        self.max_age_days = max_age_days
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.retention_interval = retention_interval
+
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._conn.executescript(self.SCHEMA)
+        self._migrate()
+        self._conn.commit()
+        self._inherited_conns = []
+
+        self._stop_event = threading.Event()
+        self._retention_thread = None
+        self._evicted_count = 0
+        self._evicted_bytes = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.index_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def reopen_after_fork(self):
+        """Give a forked worker its own lock and index connection
+
+        SQLite connections must not be used across fork(). The inherited one is
+        kept referenced but never touched, so the child does not close the
+        parent's handle either. Retention keeps running in the parent only.
+        """
+        self._inherited_conns.append(self._conn)
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._stop_event = threading.Event()
+        self._retention_thread = None
+
+    @property
+    def retention_enabled(self):
+        return bool(self.max_age_days or self.max_count or self.max_bytes)
+
+    def shard_dir(self, image_id):
+        digest = hashlib.sha1(image_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.root_dir, digest[:2], digest[2:4])
+
+    def path_for(self, image_id, ext='png'):
+        """Absolute path for a file of ``image_id``, creating its shard directory"""
+        shard = self.shard_dir(image_id)
+        os.makedirs(shard, exist_ok=True)
+        return os.path.join(shard, f"{image_id}.{ext}")
+
+    def save_image(self, image_id, image, metadata=None, image_format='PNG'):
+        """Write a PIL image into its shard and index it"""
+        ext = image_format.lower()
+        path = self.path_for(image_id, ext)
+        image.save(path, format=image_format)
+        return self.record(image_id, path, metadata, image_format=image_format)
+
+    def record(self, image_id, path, metadata=None, image_format='PNG', size_bytes=None):
+        """Index a file already written under the store root"""
+        metadata = metadata or {}
+        if size_bytes is None:
+            size_bytes = os.path.getsize(path)
+        relpath = os.path.relpath(path, self.root_dir)
+        row = (
+            image_id,
+            relpath,
+            metadata.get('created_at', time.time()),
+            size_bytes,
+            image_format.upper(),
+            metadata.get('prompt'),
+            metadata.get('negative_prompt'),
+            metadata.get('width'),
+            metadata.get('height'),
+            metadata.get('num_inference_steps'),
+            metadata.get('guidance_scale'),
+            metadata.get('seed'),
+            metadata.get('model_id'),
+            metadata.get('device'),
+            metadata.get('generation_time'),
+            json.dumps(metadata.get('parameters') or {})
+        )
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)',
+                row
+            )
+            self._conn.commit()
+        return relpath
+
+    def get(self, image_id):
+        """Metadata row for ``image_id`` as a dict, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT * FROM images WHERE image_id = ?', (image_id,)
+            ).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def path(self, image_id):
+        """Absolute path of the stored image for ``image_id``, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT relpath FROM images WHERE image_id = ?', (image_id,)
+            ).fetchone()
+        if not row:
+            return None
+        return os.path.join(self.root_dir, row['relpath'])
+
+    def thumbnail_path(self, image_id):
+        """Absolute path of the thumbnail for ``image_id``, or None if not generated yet"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT thumbnail_relpath FROM images WHERE image_id = ?', (image_id,)
+            ).fetchone()
+        if not row or not row['thumbnail_relpath']:
+            return None
+        return os.path.join(self.root_dir, row['thumbnail_relpath'])
+
+    def set_thumbnail(self, image_id, path):
+        relpath = os.path.relpath(path, self.root_dir)
+        with self._lock:
+            self._conn.execute(
+                'UPDATE images SET thumbnail_relpath = ? WHERE image_id = ?', (relpath, image_id)
+            )
+            self._conn.commit()
+        return relpath
+
+    def query(self, limit=24, cursor=None, prompt=None, since=None, until=None,
+              width=None, height=None):
+        """Page through images newest first using the (created_at, image_id) index
+
+        ``cursor`` is the opaque ``next_cursor`` of the previous page. Returns
+        ``(items, next_cursor)`` where ``next_cursor`` is None on the last page.
+        """
+        clauses = []
+        args = []
+        if cursor:
+            created_at, image_id = self.decode_cursor(cursor)
+            clauses.append('(created_at < ? OR (created_at = ? AND image_id < ?))')
+            args += [created_at, created_at, image_id]
+        if prompt:
+            escaped = prompt.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            clauses.append("prompt LIKE ? ESCAPE '\\'")
+            args.append(f"%{escaped}%")
+        if since is not None:
+            clauses.append('created_at >= ?')
+            args.append(since)
+        if until is not None:
+            clauses.append('created_at < ?')
+            args.append(until)
+        if width:
+            clauses.append('width = ?')
+            args.append(width)
+        if height:
+            clauses.append('height = ?')
+            args.append(height)
+
+        sql = 'SELECT * FROM images'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY created_at DESC, image_id DESC LIMIT ?'
+        args.append(limit + 1)
+
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+
+        items = [self._row_to_dict(r) for r in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit and items:
+            next_cursor = self.encode_cursor(items[-1]['created_at'], items[-1]['image_id'])
+        return items, next_cursor
+
+    @staticmethod
+    def encode_cursor(created_at, image_id):
+        raw = f"{created_at!r}|{image_id}".encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Inverse of encode_cursor, raising ValueError for malformed cursors"""
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+            created_at, image_id = raw.split('|', 1)
+            return float(created_at), image_id
+        except Exception:
+            raise ValueError(f"Invalid cursor: {cursor}")
+
+    def delete(self, image_id):
+        """Remove an image, every derived file next to it and its index row"""
+        freed = 0
+        for path in glob.glob(os.path.join(self.shard_dir(image_id), f"{glob.escape(image_id)}.*")):
+            try:
+                freed += os.path.getsize(path)
+                os.remove(path)
+            except OSError as e:
+                print(f"[STORE] Could not remove {path}: {e}")
+        with self._lock:
+            self._conn.execute('DELETE FROM images WHERE image_id = ?', (image_id,))
+            self._conn.commit()
+        return freed
+
+    def stats(self):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT COUNT(*) AS count, COALESCE(SUM(size_bytes), 0) AS bytes, '
+                'MIN(created_at) AS oldest FROM images'
+            ).fetchone()
+        return {
+            'count': row['count'],
+            'total_bytes': row['bytes'],
+            'oldest': row['oldest'],
+            'retention': {
+                'max_age_days': self.max_age_days,
+                'max_count': self.max_count,
+                'max_bytes': self.max_bytes,
+                'interval': self.retention_interval
+            },
+            'evicted_count': self._evicted_count,
+            'evicted_bytes': self._evicted_bytes
+        }
+
+    def start_retention(self):
+        """Start the background eviction thread if any retention limit is set"""
+        if not self.retention_enabled:
+            return
+        if self._retention_thread is not None and self._retention_thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._retention_thread = threading.Thread(
+            target=self._retention_loop,
+            name='output-retention',
+            daemon=True
+        )
+        self._retention_thread.start()
+        print(f"[STORE] Retention enabled: max_age_days={self.max_age_days}, "
+              f"max_count={self.max_count}, max_bytes={self.max_bytes}")
+
+    def stop_retention(self):
+        self._stop_event.set()
+
+    def enforce_retention(self):
+        """Evict images beyond the configured limits, oldest first; returns evicted ids"""
+        victims = []
+        with self._lock:
+            if self.max_age_days:
+                cutoff = time.time() - self.max_age_days * 86400
+                victims += [r['image_id'] for r in self._conn.execute(
+                    'SELECT image_id FROM images WHERE created_at < ?', (cutoff,)
+                )]
+
+            if self.max_count:
+                victims += [r['image_id'] for r in self._conn.execute(
+                    'SELECT image_id FROM images ORDER BY created_at DESC LIMIT -1 OFFSET ?',
+                    (self.max_count,)
+                )]
+
+            if self.max_bytes:
+                total = self._conn.execute(
+                    'SELECT COALESCE(SUM(size_bytes), 0) FROM images'
+                ).fetchone()[0]
+                if total > self.max_bytes:
+                    for r in self._conn.execute(
+                        'SELECT image_id, size_bytes FROM images ORDER BY created_at ASC'
+                    ):
+                        if total <= self.max_bytes:
+                            break
+                        victims.append(r['image_id'])
+                        total -= r['size_bytes']
+
+        victims = list(dict.fromkeys(victims))
+        for image_id in victims:
+            freed = self.delete(image_id)
+            self._evicted_count += 1
+            self._evicted_bytes += freed
+
+        if victims:
+            print(f"[STORE] Retention evicted {len(victims)} images")
+        return victims
+
+    def _retention_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                self.enforce_retention()
+            except Exception as e:
+                print(f"[STORE] Retention pass failed: {e}")
+            self._stop_event.wait(self.retention_interval)
+
+    def _migrate(self):
+        columns = {r['name'] for r in self._conn.execute('PRAGMA table_info(images)')}
+        for column, statement in self.MIGRATIONS:
+            if column not in columns:
+                self._conn.execute(statement)
+
+    @staticmethod
+    def _row_to_dict(row):
+        record = dict(row)
+        try:
+            record['parameters'] = json.loads(record.get('parameters') or '{}')
+        except ValueError:
+            record['parameters'] = {}
+        return record
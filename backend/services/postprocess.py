@@ -0,0 +1,198 @@
+# Copyright 2025 by trongton@gmail.com
+
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import metrics
+from .tracing import add_span, bind, span
+
+
+MIME_TYPES = {
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'JPEG': 'image/jpeg'
+}
+
+EXTENSIONS = {
+    'PNG': 'png',
+    'WEBP': 'webp',
+    'JPEG': 'jpg'
+}
+
+
+def encode_image(image, image_format='PNG', level=None):
+    """Encode a PIL image to bytes
+
+    ``level`` is the zlib compression level (0-9) for PNG and the quality
+    (0-100) for WEBP and JPEG; None keeps Pillow's default.
+    """
+    image_format = image_format.upper()
+    options = {}
+    if image_format == 'PNG':
+        if level is not None:
+            options['compress_level'] = level
+    elif image_format in ('WEBP', 'JPEG'):
+        if level is not None:
+            options['quality'] = level
+        if image_format == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+    else:
+        raise ValueError(f"Unsupported image format: {image_format}")
+
+    buffered = io.BytesIO()
+    image.save(buffered, format=image_format, **options)
+    return buffered.getvalue()
+
+
+class OutputTarget:
+    """Format and compression level for one destination of a generated image"""
+
+    def __init__(self, image_format='PNG', level=None):
+        self.image_format = image_format.upper()
+        if self.image_format not in MIME_TYPES:
+            raise ValueError(f"Unsupported image format: {image_format}")
+        self.level = level
+
+    @property
+    def mime_type(self):
+        return MIME_TYPES[self.image_format]
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.image_format]
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, OutputTarget)
+            and self.image_format == other.image_format
+            and self.level == other.level
+        )
+
+
+class ImagePostProcessor:
+    """Encodes generated images and persists them off the request thread
+
+    The response encoding happens once on the caller's thread so the HTTP
+    response can go out immediately. When the disk target uses the same format
+    and level those bytes are reused, otherwise the disk encoding runs in the
+    pool. Disk writes, index updates and thumbnails run on a bounded thread
+    pool; when ``max_pending`` jobs are outstanding, submitters block and the
+    wait is recorded so disk backpressure shows up in /api/metrics. Until an
+    image is on disk and indexed, ``pending()`` hands out its response bytes
+    so its URL works right away.
+    """
+
+    def __init__(self, output_store, thumbnail_generator=None, response_target=None,
+                 disk_target=None, fsync=False, max_workers=2, max_pending=8):
+        self.output_store = output_store
+        self.thumbnail_generator = thumbnail_generator
+        self.response_target = response_target or OutputTarget('PNG')
+        self.disk_target = disk_target or OutputTarget('PNG')
+        self.fsync = fsync
+        self.max_pending = max_pending
+
+        self._slots = threading.BoundedSemaphore(max_pending)
+        # image_id -> (response bytes, mime type) while its write is queued
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='postprocess'
+        )
+        metrics.set_gauge('postprocess.pending', 0)
+        metrics.set_gauge('postprocess.max_pending', max_pending)
+
+    def process(self, image_id, image, metadata=None):
+        """Encode ``image`` for the response and queue its persistence
+
+        Returns ``(response_bytes, mime_type, relpath, future)``; the future
+        resolves to the stored path once the file is on disk and indexed.
+        """
+        with metrics.time('postprocess.response_encode'), span('encode', format=self.response_target.image_format):
+            response_bytes = encode_image(
+                image, self.response_target.image_format, self.response_target.level
+            )
+
+        disk_bytes = response_bytes if self.disk_target == self.response_target else None
+        path = self.output_store.path_for(image_id, self.disk_target.extension)
+        relpath = os.path.relpath(path, self.output_store.root_dir)
+
+        # Bounded queue: block here rather than let pending writes pile up in memory
+        wait_start = time.perf_counter()
+        if not self._slots.acquire(blocking=False):
+            metrics.inc('postprocess.backpressure_waits')
+            self._slots.acquire()
+        metrics.observe('postprocess.submit_wait', time.perf_counter() - wait_start)
+        add_span('postprocess.submit_wait', wait_start, cat='queue')
+        metrics.add_gauge('postprocess.pending', 1)
+        with self._pending_lock:
+            self._pending[image_id] = (response_bytes, self.response_target.mime_type)
+
+        future = self._executor.submit(
+            bind(self._persist), image_id, image, disk_bytes, path, metadata or {}, time.perf_counter()
+        )
+        return response_bytes, self.response_target.mime_type, relpath, future
+
+    def pending(self, image_id):
+        """``(bytes, mime_type)`` of an image whose write has not finished, else None"""
+        with self._pending_lock:
+            return self._pending.get(image_id)
+
+    def status(self):
+        return {
+            'pending': metrics.get('postprocess.pending'),
+            'max_pending': self.max_pending,
+            'response_format': self.response_target.image_format,
+            'response_level': self.response_target.level,
+            'disk_format': self.disk_target.image_format,
+            'disk_level': self.disk_target.level,
+            'fsync': self.fsync
+        }
+
+    def _persist(self, image_id, image, disk_bytes, path, metadata, queued_at):
+        metrics.observe('postprocess.queue_wait', time.perf_counter() - queued_at)
+        add_span('postprocess.queue_wait', queued_at, cat='queue')
+        try:
+            if disk_bytes is None:
+                with metrics.time('postprocess.disk_encode'), span('disk.encode'):
+                    disk_bytes = encode_image(
+                        image, self.disk_target.image_format, self.disk_target.level
+                    )
+
+            with metrics.time('postprocess.disk_write'), span('disk.write', bytes=len(disk_bytes)):
+                self._write(path, disk_bytes)
+
+            with span('index.record'):
+                self.output_store.record(
+                    image_id, path, metadata,
+                    image_format=self.disk_target.image_format,
+                    size_bytes=len(disk_bytes)
+                )
+            if self.thumbnail_generator is not None:
+                self.thumbnail_generator.submit(image_id, image)
+
+            metrics.inc('postprocess.written')
+            metrics.inc('postprocess.bytes_written', len(disk_bytes))
+            return path
+        except Exception as e:
+            metrics.inc('postprocess.failures')
+            print(f"[POSTPROCESS] Failed to persist {image_id}: {e}")
+            raise
+        finally:
+            with self._pending_lock:
+                self._pending.pop(image_id, None)
+            metrics.add_gauge('postprocess.pending', -1)
+            self._slots.release()
+
+    def _write(self, path, data):
+        # Write to a temporary name and rename so readers never see partial files
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                with metrics.time('postprocess.fsync'):
+                    os.fsync(f.fileno())
+        os.replace(tmp_path, path)
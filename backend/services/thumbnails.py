@@ -0,0 +1,51 @@
+# Copyright 2025 by trongton@gmail.com
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ThumbnailGenerator:
+    """Builds small WebP thumbnails on a thread pool after each generation
+
+    Thumbnails are written next to the original in the output store shard as
+    ``<image_id>.thumb.webp`` so retention removes them together.
+    """
+
+    EXTENSION = 'thumb.webp'
+
+    def __init__(self, output_store, size=256, quality=70, max_workers=2):
+        self.output_store = output_store
+        self.size = size
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='thumbnail'
+        )
+
+    def submit(self, image_id, image):
+        """Queue a thumbnail for ``image`` (a PIL image); returns a Future"""
+        return self._executor.submit(self._create, image_id, image.copy())
+
+    def ensure(self, image_id):
+        """Path of the thumbnail for ``image_id``, building it from the stored original if missing"""
+        path = self.output_store.thumbnail_path(image_id)
+        if path:
+            return path
+        original = self.output_store.path(image_id)
+        if not original:
+            return None
+        from PIL import Image
+        with Image.open(original) as image:
+            return self._create(image_id, image)
+
+    def _create(self, image_id, image):
+        try:
+            image.thumbnail((self.size, self.size))
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGB')
+            path = self.output_store.path_for(image_id, self.EXTENSION)
+            image.save(path, format='WEBP', quality=self.quality, method=4)
+            self.output_store.set_thumbnail(image_id, path)
+            return path
+        except Exception as e:
+            print(f"[THUMB] Failed to create thumbnail for {image_id}: {e}")
+            return None
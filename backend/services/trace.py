@@ -0,0 +1,32 @@
+# Copyright 2025 by trongton@gmail.com
+
+import json
+import os
+import threading
+
+
+class RequestTraceRecorder:
+    """Appends one JSON line per generation request for later replay
+
+    Each line holds the arrival time, the request parameters and the outcome,
+    which is what ``benchmarks/loadgen.py --trace`` needs to reproduce a real
+    traffic mix. Lines are written with a single O_APPEND write, so several
+    gunicorn workers can share one file.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+
+    def record(self, entry):
+        line = (json.dumps(entry, separators=(',', ':')) + '\n').encode('utf-8')
+        try:
+            with self._lock:
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line)
+                finally:
+                    os.close(fd)
+        except OSError as e:
+            print(f"[TRACE] Could not record request: {e}")
@@ -0,0 +1,250 @@
+# Copyright 2025 by trongton@gmail.com
+
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# perf_counter has the resolution, time.time() the common origin across processes
+_EPOCH_OFFSET = time.time() - time.perf_counter()
+_local = threading.local()
+
+
+def _micros(perf_time):
+    return int((perf_time + _EPOCH_OFFSET) * 1_000_000)
+
+
+class Trace:
+    """Timeline of one generation job as Chrome trace-event records
+
+    Spans are complete (``"ph": "X"``) events with microsecond timestamps,
+    one track per thread, so the JSON opens directly in Perfetto or
+    chrome://tracing. Events may be added from any thread that has the trace
+    active (see ``activate`` and ``bind``).
+    """
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id
+        self.created_at = time.time()
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = {}
+        # Latest span boundary per thread, where the next UNet step starts
+        self._marks = {}
+
+    def add_span(self, name, start, end, cat='generate', **args):
+        """Record a span from ``start`` to ``end`` (``time.perf_counter()`` values)"""
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': _micros(start),
+            'dur': max(0, int((end - start) * 1_000_000)),
+            'pid': os.getpid(),
+            'tid': thread.ident
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._events.append(event)
+            self._threads.setdefault(thread.ident, thread.name)
+            self._marks[thread.ident] = end
+
+    def mark(self, when=None):
+        with self._lock:
+            self._marks[threading.get_ident()] = time.perf_counter() if when is None else when
+
+    def step(self, name, **args):
+        """Span from this thread's last span boundary until now"""
+        now = time.perf_counter()
+        with self._lock:
+            start = self._marks.get(threading.get_ident(), now)
+        self.add_span(name, start, now, **args)
+
+    def to_chrome(self):
+        """Chrome trace-event JSON object (``traceEvents`` plus thread names)"""
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        metadata = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+            for tid, name in threads.items()
+        ]
+        return {
+            'traceEvents': metadata + sorted(events, key=lambda event: event['ts']),
+            'displayTimeUnit': 'ms',
+            'otherData': {'trace_id': self.trace_id, 'created_at': self.created_at}
+        }
+
+
+class Tracer:
+    """Samples requests for tracing and keeps their traces for a while
+
+    ``sample_rate`` is the fraction of generation jobs traced (0 disables
+    tracing). The last ``max_traces`` traces are kept for ``retention_seconds``
+    and served by id; with ``trace_dir`` each one is also written there as
+    ``<id>.json`` once the job's image is persisted.
+    """
+
+    def __init__(self, sample_rate=0.0, max_traces=100, retention_seconds=900, trace_dir=None):
+        self.sample_rate = max(0.0, min(float(sample_rate), 1.0))
+        self.max_traces = max_traces
+        self.retention_seconds = retention_seconds
+        self.trace_dir = trace_dir
+        self._lock = threading.Lock()
+        self._traces = OrderedDict()
+        if trace_dir:
+            os.makedirs(trace_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def sample(self):
+        """A new trace for this request, or None if it is not sampled"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return Trace()
+
+    def register(self, trace_id, trace):
+        """Make ``trace`` retrievable as ``trace_id``"""
+        trace.trace_id = trace_id
+        with self._lock:
+            self._traces[trace_id] = trace
+            self._prune_locked()
+
+    def get(self, trace_id):
+        with self._lock:
+            self._prune_locked()
+            return self._traces.get(trace_id)
+
+    def save(self, trace):
+        """Write ``trace`` to ``trace_dir`` if one is configured"""
+        if not self.trace_dir or trace.trace_id is None:
+            return
+        path = os.path.join(self.trace_dir, f"{trace.trace_id}.json")
+        try:
+            with open(path, 'w') as f:
+                json.dump(trace.to_chrome(), f)
+        except OSError as e:
+            print(f"[TRACE] Could not write {path}: {e}")
+
+    def status(self):
+        with self._lock:
+            return {
+                'sample_rate': self.sample_rate,
+                'retained': len(self._traces),
+                'max_traces': self.max_traces,
+                'retention_seconds': self.retention_seconds,
+                'trace_dir': self.trace_dir
+            }
+
+    def _prune_locked(self):
+        cutoff = time.time() - self.retention_seconds
+        while self._traces:
+            oldest = next(iter(self._traces.values()))
+            if len(self._traces) <= self.max_traces and oldest.created_at >= cutoff:
+                break
+            self._traces.popitem(last=False)
+
+
+def current_trace():
+    """Trace active on this thread, or None"""
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def activate(trace):
+    """Make ``trace`` the active trace of this thread for the block"""
+    previous = current_trace()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def bind(fn):
+    """Wrap ``fn`` so that it runs with the caller's trace active on whichever thread calls it"""
+    trace = current_trace()
+    if trace is None:
+        return fn
+
+    def traced(*args, **kwargs):
+        with activate(trace):
+            return fn(*args, **kwargs)
+    return traced
+
+
+@contextmanager
+def span(name, cat='generate', **args):
+    """Record the block as a span of the active trace (no-op without one)"""
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    trace.mark(start)
+    try:
+        yield
+    finally:
+        trace.add_span(name, start, time.perf_counter(), cat=cat, **args)
+
+
+def add_span(name, start, end=None, cat='generate', **args):
+    """Record a span that started at ``start`` (perf_counter) on the active trace"""
+    trace = current_trace()
+    if trace is not None:
+        trace.add_span(name, start, time.perf_counter() if end is None else end, cat=cat, **args)
+
+
+def step_span(name, **args):
+    """Record a span from the last span boundary on this thread until now"""
+    trace = current_trace()
+    if trace is not None:
+        trace.step(name, **args)
+
+
+@contextmanager
+def traced_lock(lock, name):
+    """Hold ``lock`` for the block, recording how long acquiring it took"""
+    with span('lock.wait', cat='lock', lock=name):
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def instrument_method(obj, attr, name):
+    """Record every call of ``obj.attr`` made under an active trace as a span
+
+    The wrapper is stored on the instance and only costs an attribute lookup
+    when nothing is traced. Instances copied afterwards keep calling the
+    original object's method, so instrument copies separately.
+    """
+    method = getattr(type(obj), attr, None)
+    if method is None or getattr(obj, attr, None) is None:
+        return False
+    bound = method.__get__(obj, type(obj))
+
+    def traced(*args, **kwargs):
+        if current_trace() is None:
+            return bound(*args, **kwargs)
+        with span(name):
+            return bound(*args, **kwargs)
+    obj.__dict__[attr] = traced
+    return True
+
+
+def instrument_pipeline(pipe):
+    """Trace the text encoder and VAE decode calls of a diffusers-style pipeline"""
+    if not instrument_method(pipe, 'encode_prompt', 'text_encode'):
+        instrument_method(pipe, '_encode_prompt', 'text_encode')
+    vae = getattr(pipe, 'vae', None)
+    if vae is not None:
+        instrument_method(vae, 'decode', 'vae.decode')
@@ -0,0 +1,188 @@
+# Copyright 2025 by trongton@gmail.com
+
+"""
+Inference worker for distributed mode (QUEUE_BACKEND set on every node)
+
+    python worker.py                                  # one job at a time
+    python worker.py --concurrency 2 --worker-id gpu-node-1
+
+Pulls generation jobs from the shared queue, runs them on this node's models
+(MODEL_ID / MODEL_IDS on DEVICE, with every setting of a regular server),
+reports per-step progress and pushes the response body or the error back to
+the queue. A job stopped through /api/stop on any API node is cancelled at
+its next step. The worker heartbeats its counters every
+QUEUE_HEARTBEAT_SECONDS so API nodes report per-worker throughput at
+/api/queue, and puts the jobs of workers that stopped heartbeating back in
+the queue.
+"""
+
+import argparse
+import collections
+import signal
+import sys
+import threading
+import time
+from config import Config
+from app import job_queue, job_tracker, model_registry, run_generation_job, init_worker
+from services import metrics
+from services.job_queue import default_worker_id
+
+# Window of the images/sec figure reported in heartbeats
+THROUGHPUT_WINDOW = 300
+# Recent jobs averaged into the reported service time (load shedding)
+SERVICE_TIME_JOBS = 20
+
+
+class QueueWorker:
+    """Claims jobs on ``concurrency`` threads and heartbeats from the caller's thread"""
+
+    def __init__(self, queue, worker_id, concurrency=1):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.concurrency = concurrency
+        self.started_at = time.time()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.stopped = 0
+        self._finished_at = collections.deque()
+        self._service_times = collections.deque(maxlen=SERVICE_TIME_JOBS)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def run(self):
+        # Register before claiming so no other worker takes our jobs for stale
+        self.heartbeat()
+        threads = [
+            threading.Thread(target=self._loop, name=f"queue-worker-{slot}", daemon=True)
+            for slot in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        print(f"[WORKER] {self.worker_id} pulling from the {self.queue.backend} queue "
+              f"({self.concurrency} concurrent job(s))")
+        while not self._stop.is_set():
+            # A queue outage must not end the process under its running jobs
+            try:
+                self.heartbeat()
+                requeued = self.queue.requeue_stale()
+                if requeued:
+                    print(f"[WORKER] Requeued {requeued} job(s) of unresponsive workers")
+            except Exception as e:
+                print(f"[WORKER] Heartbeat failed: {e}")
+            self._stop.wait(Config.QUEUE_HEARTBEAT_SECONDS)
+        print(f"[WORKER] Stopping, waiting for {self.running} running job(s)")
+        for thread in threads:
+            thread.join()
+        try:
+            self.heartbeat()
+        except Exception as e:
+            print(f"[WORKER] Final heartbeat failed: {e}")
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def heartbeat(self):
+        now = time.time()
+        with self._lock:
+            while self._finished_at and self._finished_at[0] < now - THROUGHPUT_WINDOW:
+                self._finished_at.popleft()
+            window = min(THROUGHPUT_WINDOW, max(now - self.started_at, 1.0))
+            info = {
+                'running': self.running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'stopped': self.stopped,
+                'concurrency': self.concurrency,
+                'images_per_sec': round(len(self._finished_at) / window, 4),
+                'service_seconds': (round(sum(self._service_times) / len(self._service_times), 3)
+                                    if self._service_times else None),
+                'started_at': self.started_at,
+                'state': 'stopping' if self._stop.is_set() else 'ready',
+                'device': model_registry.default.device,
+                'model_ids': model_registry.model_ids
+            }
+        self.queue.heartbeat(self.worker_id, info)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                record = self.queue.claim(self.worker_id, timeout=Config.QUEUE_HEARTBEAT_SECONDS)
+            except Exception as e:
+                print(f"[WORKER] Claim failed: {e}")
+                self._stop.wait(Config.QUEUE_HEARTBEAT_SECONDS)
+                continue
+            if record is not None:
+                self._process(record)
+
+    def _process(self, record):
+        job_id = record['job_id']
+        parameters = record['parameters']
+        print(f"[WORKER] Running job {job_id}: {parameters['prompt'][:50]}...")
+        with self._lock:
+            self.running += 1
+
+        def on_step(step, total_steps):
+            if self.queue.progress(job_id, step, total_steps):
+                raise StopIteration("Generation stopped by user")
+
+        # The local tracker runs the job like an in-process request; timings
+        # count from the enqueue on the API node
+        session_id = f"queue-{job_id}"
+        job, _ = job_tracker.submit(
+            None,
+            session_id,
+            parameters['num_inference_steps'],
+            lambda job: run_generation_job(job, parameters, record['created_at'], on_step=on_step)
+        )
+        status = job_tracker.wait(job, session_id)
+
+        result = None
+        if status == job.DONE:
+            result = dict(job.result, job_id=job_id, worker_id=self.worker_id, trace_url=None)
+            if not Config.QUEUE_INLINE_IMAGES:
+                result['image_data'] = None
+        try:
+            self.queue.complete(job_id, status, result=result, error=job.error)
+        except Exception as e:
+            print(f"[WORKER] Could not report job {job_id}: {e}")
+            status = job.FAILED
+
+        metrics.inc(f'queue.worker.{status}')
+        with self._lock:
+            self.running -= 1
+            if status == job.DONE:
+                self.completed += 1
+                self._finished_at.append(time.time())
+                if job.result['timings']['service_time'] is not None:
+                    self._service_times.append(job.result['timings']['service_time'])
+            elif status == job.STOPPED:
+                self.stopped += 1
+            else:
+                self.failed += 1
+        print(f"[WORKER] Job {job_id} {status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Jobs run at once (use with PIPELINED_STAGES or OV_INFER_SLOTS)')
+    parser.add_argument('--worker-id', default=None, help='Name in /api/queue (default host-pid)')
+    args = parser.parse_args()
+
+    if job_queue is None:
+        print("[WORKER] QUEUE_BACKEND is not set; nothing to pull jobs from")
+        return 1
+
+    # Loads the model in the background with PRELOAD_MODEL; jobs wait for it
+    init_worker(1)
+
+    worker = QueueWorker(job_queue, args.worker_id or default_worker_id(), max(1, args.concurrency))
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,12 @@
+# Copyright 2025 by trongton@gmail.com
+
+"""WSGI entry point for gunicorn (settings in gunicorn.conf.py)"""
+
+from config import Config
+from app import app, preload_weights
+
+__all__ = ['app']
+
+# With preload_app this runs once in the master, before the workers fork
+if Config.PRELOAD_MODEL:
+    preload_weights()
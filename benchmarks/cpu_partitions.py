@@ -0,0 +1,146 @@
+# Copyright 2025 by trongton@gmail.com
+
+"""
+CPU core partition benchmark: aggregate throughput for K pinned streams
+
+For each partition count K, splits the cores the way CPU_PARTITIONS does
+(whole physical cores, NUMA nodes kept together), loads one pinned stream
+per partition, keeps every stream busy for ``--images`` generations and
+reports images/sec, mean latency and the speedup over K=1 (a single stream
+using every core). The best K is the value to put in CPU_PARTITIONS.
+
+    python benchmarks/cpu_partitions.py --partitions 1,2,4,8 --steps 10 --size 256
+    python benchmarks/cpu_partitions.py --backend pytorch --partitions 1,2,4
+
+Needs the chosen backend's dependencies and model weights. Runs on the
+OpenVINO backend by default, following USE_OPENVINO.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+
+from config import Config  # noqa: E402
+from models import (  # noqa: E402
+    StableDiffusionModel, StableDiffusionModelOpenVINO, FakeStableDiffusionModel,
+    PartitionedCPUModel, partition_cpus, cpu_topology
+)
+
+BACKENDS = {
+    'openvino': (StableDiffusionModelOpenVINO, 'CPU'),
+    'pytorch': (StableDiffusionModel, 'cpu'),
+    'fake': (FakeStableDiffusionModel, 'cpu'),
+}
+
+
+def bench(count, topology, args):
+    factory, device = BACKENDS[args.backend]
+    partitions = partition_cpus(count, topology)
+    model = PartitionedCPUModel(lambda: factory(device, model_id=args.model_id), partitions,
+                                device=device, model_id=args.model_id)
+    load_start = time.time()
+    model.load_model()
+    load_time = time.time() - load_start
+
+    def generate(seed):
+        start = time.perf_counter()
+        model.generate_image(prompt=args.prompt, width=args.size, height=args.size,
+                             num_inference_steps=args.steps, seed=seed)
+        return time.perf_counter() - start
+
+    # One warmup generation per stream, all at once
+    warmup = [threading.Thread(target=generate, args=(i,)) for i in range(len(partitions))]
+    for thread in warmup:
+        thread.start()
+    for thread in warmup:
+        thread.join()
+
+    latencies = []
+    lock = threading.Lock()
+    remaining = [args.images]
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+                seed = remaining[0]
+            latency = generate(seed)
+            with lock:
+                latencies.append(latency)
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(len(partitions))]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'partitions': len(partitions),
+        'threads_per_stream': [p.threads for p in partitions],
+        'load_time': round(load_time, 2),
+        'images_per_sec': round(len(latencies) / elapsed, 4),
+        'mean_latency': round(sum(latencies) / len(latencies), 3),
+        'status': model.status()
+    }
+    model.unload_model()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--partitions', default='1,2,4', help='Comma-separated partition counts')
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        default='openvino' if Config.USE_OPENVINO else 'pytorch')
+    parser.add_argument('--model-id', default=Config.MODEL_ID)
+    parser.add_argument('--images', type=int, default=8, help='Generations per partition count')
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--prompt', default='a lighthouse on a cliff at sunset')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    Config.PIPELINED_STAGES = False
+    topology = cpu_topology()
+    print(f"{len(topology)} NUMA node(s), {sum(len(node) for node in topology)} physical cores")
+
+    results = []
+    for count in [int(value) for value in args.partitions.split(',')]:
+        print(f"Benchmarking {count} partition(s)...")
+        try:
+            result = bench(count, topology, args)
+        except Exception as e:
+            print(f"  failed: {e}")
+            results.append({'partitions': count, 'error': str(e)})
+            continue
+        results.append(result)
+        print(f"  {result['images_per_sec']} images/sec, mean latency {result['mean_latency']}s")
+
+    ok = [r for r in results if 'error' not in r]
+    single = next((r for r in ok if r['partitions'] == 1), None)
+    print()
+    print(f"{'partitions':>10} {'images/s':>10} {'latency s':>10} {'speedup':>8}")
+    for result in ok:
+        speedup = round(result['images_per_sec'] / single['images_per_sec'], 2) if single else None
+        result['speedup'] = speedup
+        print(f"{result['partitions']:>10} {result['images_per_sec']:>10} "
+              f"{result['mean_latency']:>10} {str(speedup):>8}")
+    if ok:
+        best = max(ok, key=lambda r: r['images_per_sec'])
+        print(f"\nBest throughput with CPU_PARTITIONS={best['partitions']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# Copyright 2025 by trongton@gmail.com
+
+"""
+PyTorch CPU execution benchmark: eager float32 against the CPU performance mode
+
+Loads StableDiffusionModel on the CPU once per variant, runs a few
+generations and reports load time (for the compiled variants this includes
+compilation and warmup, or only the warmup once TORCH_COMPILE_CACHE_DIR is
+populated), mean latency, seconds per step and the speedup over eager:
+
+    eager     float32, default layout, no compile (the regular CPU path)
+    bf16      channels_last + bf16 autocast, no compile
+    compiled  channels_last + bf16 autocast + torch.compile (CPU_PERF_MODE)
+
+bf16 follows CPU_BF16 (auto = only with native AVX512-BF16/AMX). Every
+variant uses the same thread count:
+
+    python benchmarks/cpu_perf.py --threads 16 --steps 20 --runs 3
+    python benchmarks/cpu_perf.py --variant eager --variant compiled --size 256
+
+Needs the PyTorch backend dependencies and the model weights.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+
+from config import Config  # noqa: E402
+from models import StableDiffusionModel  # noqa: E402
+from models.cpu_perf import configure_torch_threads  # noqa: E402
+
+VARIANTS = {
+    'eager': {'CPU_PERF_MODE': False},
+    'bf16': {'CPU_PERF_MODE': True, 'CPU_COMPILE': False, 'CPU_CHANNELS_LAST': True},
+    'compiled': {'CPU_PERF_MODE': True, 'CPU_COMPILE': True, 'CPU_CHANNELS_LAST': True},
+}
+
+
+def bench(variant, args):
+    for name, value in VARIANTS[variant].items():
+        setattr(Config, name, value)
+    Config.PIPELINED_STAGES = False
+
+    model = StableDiffusionModel('cpu', model_id=args.model_id)
+    load_start = time.time()
+    model.load_model()
+    load_time = time.time() - load_start
+
+    if model.cpu_perf is None:
+        # Eager mode has no warmup at load; keep first-call costs out of the timings
+        model.generate_image(args.prompt, width=args.size, height=args.size,
+                             num_inference_steps=2, seed=0)
+
+    latencies = []
+    for run in range(args.runs):
+        start = time.perf_counter()
+        model.generate_image(args.prompt, width=args.size, height=args.size,
+                             num_inference_steps=args.steps, seed=run + 1)
+        latencies.append(time.perf_counter() - start)
+
+    result = {
+        'variant': variant,
+        'load_time': round(load_time, 2),
+        'mean_latency': round(sum(latencies) / len(latencies), 3),
+        'min_latency': round(min(latencies), 3),
+        'step_time': round(min(latencies) / args.steps, 4),
+        'cpu_perf': model.cpu_perf.status() if model.cpu_perf else None
+    }
+    model.unload_model()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--variant', action='append', choices=sorted(VARIANTS),
+                        help='Variant to run (repeatable, default all)')
+    parser.add_argument('--model-id', default=Config.MODEL_ID)
+    parser.add_argument('--threads', type=int, default=0, help='Intra-op threads (0 = torch default)')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--prompt', default='a lighthouse on a cliff at sunset')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    # Same pools for every variant; the perf mode must not change them
+    threads = configure_torch_threads(args.threads, Config.CPU_INTER_OP_THREADS)
+    Config.CPU_INTRA_OP_THREADS = threads[0]
+    Config.CPU_INTER_OP_THREADS = 0
+    print(f"Using {threads[0]} intra-op / {threads[1]} inter-op threads")
+
+    results = []
+    for variant in args.variant or ['eager', 'bf16', 'compiled']:
+        print(f"Benchmarking {variant}...")
+        try:
+            result = bench(variant, args)
+        except Exception as e:
+            print(f"  failed: {e}")
+            results.append({'variant': variant, 'error': str(e)})
+            continue
+        results.append(result)
+        print(f"  load {result['load_time']}s, mean latency {result['mean_latency']}s, "
+              f"{result['step_time']}s/step")
+
+    eager = next((r for r in results if r['variant'] == 'eager' and 'error' not in r), None)
+    print()
+    print(f"{'variant':<10} {'latency s':>10} {'s/step':>8} {'load s':>8} {'speedup':>8}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['variant']:<10} {'failed':>10}")
+            continue
+        speedup = round(eager['min_latency'] / result['min_latency'], 2) if eager else None
+        result['speedup'] = speedup
+        print(f"{result['variant']:<10} {result['mean_latency']:>10} {result['step_time']:>8} "
+              f"{result['load_time']:>8} {str(speedup):>8}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
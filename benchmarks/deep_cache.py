@@ -0,0 +1,197 @@
+# Copyright 2025 by trongton@gmail.com
+
+"""
+Speed and image similarity of UNet feature reuse (DeepCache) per interval
+
+Generates the same prompts and seeds with every --interval on the PyTorch
+wrapper. Interval 1 runs the full UNet every step and is the reference. For
+each other interval the script reports the time per image, the speedup over
+the reference, the measured per-call UNet speedup, and how close the images
+are to the reference: PSNR (dB) and mean SSIM on the luminance.
+
+    python benchmarks/deep_cache.py                              # MODEL_ID on DEVICE
+    python benchmarks/deep_cache.py --interval 1,2,3,5 --steps 50 --size 512
+    python benchmarks/deep_cache.py --tiny --size 64 --steps 8   # random weights, no download
+    python benchmarks/deep_cache.py --min-ssim 0.85              # exit 1 below this SSIM
+
+With --tiny the images are noise, so only the timings mean anything.
+Results are written to benchmarks/results/deep_cache.json, and with
+--save-images the images are saved next to it.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+
+from config import Config  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, 'results', 'deep_cache.json')
+DEFAULT_PROMPTS = [
+    'a lighthouse on a cliff at sunset, oil painting',
+    'portrait of an old fisherman, dramatic lighting, photo',
+    'a bowl of ramen on a wooden table, studio photo'
+]
+
+
+def luminance(image):
+    import numpy as np
+    return np.asarray(image.convert('L'), dtype=np.float64)
+
+
+def psnr(a, b):
+    import numpy as np
+    mse = float(np.mean((a - b) ** 2))
+    return float('inf') if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def _box_mean(x, size):
+    """Mean over every size x size window (valid positions only)"""
+    import numpy as np
+    c = np.pad(x.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    total = c[size:, size:] - c[:-size, size:] - c[size:, :-size] + c[:-size, :-size]
+    return total / (size * size)
+
+
+def ssim(a, b, size=7):
+    """Mean SSIM with a uniform window (as in scikit-image's default)"""
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mu_a, mu_b = _box_mean(a, size), _box_mean(b, size)
+    var_a = _box_mean(a * a, size) - mu_a ** 2
+    var_b = _box_mean(b * b, size) - mu_b ** 2
+    cov = _box_mean(a * b, size) - mu_a * mu_b
+    value = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(value.mean())
+
+
+def generate(model, prompt, seed, size, steps, interval, branch):
+    stats = {}
+    deep_cache = {'interval': interval, 'branch': branch} if interval > 1 else None
+    start = time.perf_counter()
+    image = model.generate_image(
+        prompt,
+        width=size,
+        height=size,
+        num_inference_steps=steps,
+        seed=seed,
+        stats=stats,
+        deep_cache=deep_cache
+    )
+    return image, time.perf_counter() - start, stats['guidance'].get('deep_cache')
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-id', default=None, help='Model to run (default MODEL_ID)')
+    parser.add_argument('--tiny', action='store_true', help='Use the random-weight pipeline of model_matrix.py')
+    parser.add_argument('--device', default=None, help='Torch device (default DEVICE)')
+    parser.add_argument('--interval', type=parse_ints, default=[1, 2, 3, 5], help='Comma-separated intervals')
+    parser.add_argument('--branch', type=int, default=Config.DEEP_CACHE_BRANCH, help='Shallow blocks recomputed')
+    parser.add_argument('--steps', type=int, default=30)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--prompt', action='append', help='Prompt to generate (repeatable)')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--min-ssim', type=float, default=None, help='Exit 1 if any interval falls below this SSIM')
+    parser.add_argument('--save-images', action='store_true', help='Save every image next to the results file')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='Results file')
+    args = parser.parse_args()
+
+    if 1 not in args.interval:
+        args.interval = [1] + args.interval
+    Config.PIPELINED_STAGES = False
+    # torch.compile'd UNets run without the cache
+    Config.CPU_COMPILE = False
+
+    from models import StableDiffusionModel
+    model_id = args.model_id or Config.MODEL_ID
+    if args.tiny:
+        from model_matrix import build_tiny_pipeline
+        model_id = build_tiny_pipeline(os.path.join(tempfile.mkdtemp(prefix='tiny-sd-'), 'tiny-sd'))
+    model = StableDiffusionModel((args.device or Config.DEVICE).lower(), model_id=model_id)
+    model.allow_cpu_fallback = False
+    model.load_model()
+    prompts = args.prompt or DEFAULT_PROMPTS
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Warm up kernels and allocator at the measured size
+    model.generate_image('warmup', width=args.size, height=args.size, num_inference_steps=2, seed=0)
+
+    references = {}
+    results = []
+    for interval in args.interval:
+        times, psnrs, ssims, call_speedups = [], [], [], []
+        for index, prompt in enumerate(prompts):
+            image, elapsed, cache_stats = generate(
+                model, prompt, args.seed + index, args.size, args.steps, interval, args.branch
+            )
+            times.append(elapsed)
+            if cache_stats and cache_stats.get('measured_speedup'):
+                call_speedups.append(cache_stats['measured_speedup'])
+            if args.save_images:
+                image.save(os.path.join(output_dir, f'deep_cache-i{interval}-p{index}.png'))
+            if interval == 1:
+                references[index] = luminance(image)
+            else:
+                current = luminance(image)
+                psnrs.append(psnr(references[index], current))
+                ssims.append(ssim(references[index], current))
+            if cache_stats and not cache_stats['supported']:
+                print(f"  interval {interval}: cache not applied ({cache_stats['reason']})")
+
+        result = {
+            'interval': interval,
+            'seconds_per_image': round(statistics.median(times), 3),
+            'unet_call_speedup': round(statistics.median(call_speedups), 3) if call_speedups else None,
+            'psnr': round(min(psnrs), 2) if psnrs else None,
+            'ssim': round(min(ssims), 4) if ssims else None
+        }
+        results.append(result)
+        print(f"  interval {interval}: {result['seconds_per_image']}s/image")
+
+    reference_time = results[0]['seconds_per_image']
+    print()
+    print(f"{'interval':>8} {'s/image':>9} {'speedup':>8} {'UNet call':>10} {'min PSNR':>9} {'min SSIM':>9}")
+    failed = []
+    for result in results:
+        result['speedup'] = round(reference_time / result['seconds_per_image'], 3)
+        below = args.min_ssim is not None and result['ssim'] is not None and result['ssim'] < args.min_ssim
+        if below:
+            failed.append(result['interval'])
+        print(f"{result['interval']:>8} {result['seconds_per_image']:>9} {result['speedup']:>8} "
+              f"{str(result['unet_call_speedup'] or '-'):>10} {str(result['psnr'] or '-'):>9} "
+              f"{str(result['ssim'] or '-'):>9}{'  BELOW --min-ssim' if below else ''}")
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'model_id': 'tiny' if args.tiny else model_id,
+        'device': model.device,
+        'size': args.size,
+        'steps': args.steps,
+        'branch': args.branch,
+        'prompts': prompts,
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+    model.unload_model()
+
+    if failed:
+        print(f"\nInterval(s) {', '.join(map(str, failed))} fell below SSIM {args.min_ssim}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
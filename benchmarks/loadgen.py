@@ -0,0 +1,366 @@
+# Copyright 2025 by trongton@gmail.com
+
+"""
+Load generator for /api/generate
+
+Arrival modes:
+    closed   - ``--concurrency`` clients, each sends its next request as soon
+               as the previous one returns
+    poisson  - open loop, requests arrive at ``--rate`` per second with
+               exponential inter-arrival times regardless of how the server
+               keeps up
+    replay   - replays a trace recorded by the server (REQUEST_TRACE_FILE),
+               keeping its parameters and inter-arrival gaps (``--speed``
+               compresses time)
+
+Optionally every request also follows its progress stream (``--progress``)
+and a fraction of them is cancelled through /api/stop (``--stop-fraction``).
+
+Reports p50/p95/p99 latency, queue time (server estimate), time to first
+progress event, images/sec and error rates by kind.
+
+CI-friendly run without model weights (starts the server with FAKE_MODEL):
+    python benchmarks/loadgen.py --spawn-fake --mode poisson --rate 4 --duration 30
+
+Against a running server:
+    python benchmarks/loadgen.py --url http://localhost:5000 --mode closed --concurrency 4 --requests 40
+    python benchmarks/loadgen.py --mode replay --trace backend/request_trace.jsonl --speed 2
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+import requests
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+
+PROMPTS = [
+    'a lighthouse on a cliff at sunset',
+    'a watercolor painting of a fox in the snow',
+    'a futuristic city skyline at night, neon lights',
+    'a bowl of ramen, studio photo',
+    'an astronaut riding a horse on the moon'
+]
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list (None for an empty list)"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class LoadGenerator:
+    """Sends generation requests and collects one result record per request"""
+
+    def __init__(self, base_url, follow_progress=False, stop_fraction=0.0, timeout=3600):
+        self.base_url = base_url.rstrip('/')
+        self.follow_progress = follow_progress
+        self.stop_fraction = stop_fraction
+        self.timeout = timeout
+        self.results = []
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def run_request(self, payload, scheduled_at=None):
+        """Send one request (blocking) and record its outcome"""
+        session_id = str(uuid.uuid4())
+        payload = dict(payload, session_id=session_id)
+        record = {
+            'session_id': session_id,
+            'scheduled_at': scheduled_at,
+            'sent_at': time.time(),
+            'steps': payload.get('num_inference_steps'),
+            'status': None,
+            'latency': None,
+            'queue_time': None,
+            'first_progress': None,
+            'progress_events': 0,
+            'stop_sent': False
+        }
+        # Open-loop arrivals that are dispatched late count the delay as client lag
+        if scheduled_at is not None:
+            record['dispatch_lag'] = round(record['sent_at'] - scheduled_at, 4)
+
+        progress_thread = None
+        if self.follow_progress:
+            progress_thread = threading.Thread(target=self._follow, args=(session_id, record), daemon=True)
+            progress_thread.start()
+
+        start = time.perf_counter()
+        try:
+            response = requests.post(f"{self.base_url}/api/generate", json=payload, timeout=self.timeout)
+            record['latency'] = time.perf_counter() - start
+            body = response.json() if response.headers.get('Content-Type', '').startswith('application/json') else {}
+            if response.status_code == 200 and body.get('success'):
+                record['status'] = 'ok'
+                record['queue_time'] = (body.get('timings') or {}).get('queue_time')
+            elif body.get('stopped'):
+                record['status'] = 'stopped'
+            else:
+                record['status'] = f"http_{response.status_code}"
+                record['error'] = str(body.get('error', ''))[:200]
+        except requests.Timeout:
+            record['latency'] = time.perf_counter() - start
+            record['status'] = 'timeout'
+        except requests.RequestException as e:
+            record['latency'] = time.perf_counter() - start
+            record['status'] = 'connection_error'
+            record['error'] = str(e)[:200]
+
+        if progress_thread is not None:
+            progress_thread.join(timeout=5)
+        with self._lock:
+            self.results.append(record)
+        return record
+
+    def _follow(self, session_id, record):
+        """Read the SSE progress stream of a request, optionally stopping it midway"""
+        stop = random.random() < self.stop_fraction
+        try:
+            with requests.get(f"{self.base_url}/api/progress/{session_id}", stream=True,
+                              timeout=self.timeout) as stream:
+                for line in stream.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith('data:'):
+                        continue
+                    event = json.loads(line[5:])
+                    if event.get('type') == 'progress' and event.get('current_step', 0) > 0:
+                        record['progress_events'] += 1
+                        if record['first_progress'] is None:
+                            record['first_progress'] = time.time() - record['sent_at']
+                        if stop and not record['stop_sent']:
+                            record['stop_sent'] = True
+                            requests.post(f"{self.base_url}/api/stop/{session_id}", timeout=30)
+                    if event.get('type') in ('complete', 'done'):
+                        break
+        except (requests.RequestException, ValueError):
+            pass
+
+    def spawn(self, payload, scheduled_at=None):
+        thread = threading.Thread(target=self.run_request, args=(payload, scheduled_at), daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def wait(self):
+        for thread in self._threads:
+            thread.join()
+
+
+def make_payload(args, rng):
+    return {
+        'prompt': rng.choice(PROMPTS),
+        'width': args.size,
+        'height': args.size,
+        'num_inference_steps': args.steps,
+        'guidance_scale': args.guidance,
+        'seed': rng.randint(0, 2 ** 31 - 1)
+    }
+
+
+def run_closed(gen, args, rng):
+    deadline = time.time() + args.duration if args.duration else None
+    remaining = [args.requests]
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if args.requests and remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+                payload = make_payload(args, rng)
+            if deadline and time.time() >= deadline:
+                return
+            gen.run_request(payload)
+
+    clients = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+
+def run_poisson(gen, args, rng):
+    start = time.time()
+    next_at = start
+    sent = 0
+    while True:
+        next_at += rng.expovariate(args.rate)
+        if args.duration and next_at - start >= args.duration:
+            break
+        if args.requests and sent >= args.requests:
+            break
+        time.sleep(max(0.0, next_at - time.time()))
+        gen.spawn(make_payload(args, rng), scheduled_at=next_at)
+        sent += 1
+    gen.wait()
+
+
+def run_replay(gen, args):
+    entries = []
+    with open(args.trace) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry['ts'])
+    if args.requests:
+        entries = entries[:args.requests]
+    if not entries:
+        sys.exit(f"No requests in trace {args.trace}")
+
+    first_ts = entries[0]['ts']
+    start = time.time()
+    for entry in entries:
+        scheduled_at = start + (entry['ts'] - first_ts) / args.speed
+        time.sleep(max(0.0, scheduled_at - time.time()))
+        payload = {k: v for k, v in entry['request'].items() if v is not None}
+        gen.spawn(payload, scheduled_at=scheduled_at)
+    gen.wait()
+
+
+def summarize(results, elapsed):
+    statuses = Counter(r['status'] for r in results)
+    ok = [r for r in results if r['status'] == 'ok']
+    latencies = sorted(r['latency'] for r in ok)
+    queue_times = sorted(r['queue_time'] for r in ok if r['queue_time'] is not None)
+    first_progress = sorted(r['first_progress'] for r in results if r['first_progress'] is not None)
+    lags = sorted(r['dispatch_lag'] for r in results if r.get('dispatch_lag') is not None)
+
+    def dist(values):
+        return {
+            'p50': _round(percentile(values, 50)),
+            'p95': _round(percentile(values, 95)),
+            'p99': _round(percentile(values, 99)),
+            'max': _round(values[-1] if values else None)
+        }
+
+    total = len(results)
+    failed = total - statuses.get('ok', 0) - statuses.get('stopped', 0)
+    return {
+        'requests': total,
+        'elapsed': round(elapsed, 2),
+        'statuses': dict(statuses),
+        'images_per_sec': round(len(ok) / elapsed, 3) if elapsed > 0 else None,
+        'error_rate': round(failed / total, 4) if total else None,
+        'latency': dist(latencies),
+        'queue_time': dist(queue_times),
+        'first_progress': dist(first_progress),
+        'dispatch_lag': dist(lags) if lags else None
+    }
+
+
+def _round(value):
+    return round(value, 4) if value is not None else None
+
+
+def spawn_fake_server(args):
+    """Start the Flask app with the fixed-latency fake backend"""
+    env = dict(
+        os.environ,
+        FAKE_MODEL='True',
+        FAKE_STEP_SECONDS=str(args.fake_step_seconds),
+        PORT=str(args.port),
+        HOST='127.0.0.1',
+        DEBUG='False'
+    )
+    server = subprocess.Popen(
+        [sys.executable, 'app.py'],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL if not args.verbose else None,
+        stderr=subprocess.DEVNULL if not args.verbose else None
+    )
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{args.port}/api/health", timeout=2)
+            return server
+        except requests.RequestException:
+            if server.poll() is not None:
+                sys.exit("Fake server exited during startup (run with --verbose)")
+            time.sleep(0.5)
+    server.kill()
+    sys.exit("Fake server did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--mode', choices=['closed', 'poisson', 'replay'], default='closed')
+    parser.add_argument('--concurrency', type=int, default=2, help='Clients in closed-loop mode')
+    parser.add_argument('--rate', type=float, default=1.0, help='Arrivals per second in poisson mode')
+    parser.add_argument('--requests', type=int, default=0, help='Stop after this many requests (0 = no limit)')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds of arrivals (0 = no limit)')
+    parser.add_argument('--trace', help='Trace file recorded with REQUEST_TRACE_FILE (replay mode)')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay time compression factor')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--guidance', type=float, default=7.5)
+    parser.add_argument('--progress', action='store_true', help='Follow each request\'s progress stream')
+    parser.add_argument('--stop-fraction', type=float, default=0.0,
+                        help='Fraction of requests cancelled via /api/stop after their first progress event')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for arrivals and prompts')
+    parser.add_argument('--spawn-fake', action='store_true', help='Start a local server with the fake backend')
+    parser.add_argument('--fake-step-seconds', type=float, default=0.05)
+    parser.add_argument('--port', type=int, default=5058, help='Port of the spawned fake server')
+    parser.add_argument('--out', help='Write one JSON line per request to this file')
+    parser.add_argument('--json', help='Write the summary to this file')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.mode == 'replay' and not args.trace:
+        parser.error('--trace is required in replay mode')
+    if not args.requests and not args.duration and args.mode != 'replay':
+        parser.error('set --requests or --duration')
+
+    server = None
+    if args.spawn_fake:
+        server = spawn_fake_server(args)
+        args.url = f"http://127.0.0.1:{args.port}"
+
+    rng = random.Random(args.seed)
+    gen = LoadGenerator(args.url, follow_progress=args.progress or args.stop_fraction > 0,
+                        stop_fraction=args.stop_fraction)
+    start = time.time()
+    try:
+        if args.mode == 'closed':
+            run_closed(gen, args, rng)
+        elif args.mode == 'poisson':
+            run_poisson(gen, args, rng)
+        else:
+            run_replay(gen, args)
+    finally:
+        elapsed = time.time() - start
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    summary = summarize(gen.results, elapsed)
+    print(f"Requests: {summary['requests']} in {summary['elapsed']}s  statuses: {summary['statuses']}")
+    print(f"Throughput: {summary['images_per_sec']} images/sec  error rate: {summary['error_rate']}")
+    for name in ('latency', 'queue_time', 'first_progress', 'dispatch_lag'):
+        if summary[name]:
+            values = summary[name]
+            print(f"{name:>15}: p50 {values['p50']}  p95 {values['p95']}  p99 {values['p99']}  max {values['max']}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            for record in gen.results:
+                f.write(json.dumps(record) + '\n')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
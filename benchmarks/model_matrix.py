@@ -0,0 +1,405 @@
+# Copyright 2025 by trongton@gmail.com
+
+"""
+Backend benchmark matrix on a tiny random-weight pipeline, with a baseline check
+
+Builds a Stable Diffusion pipeline with a small UNet, VAE and CLIP text
+encoder from configs and random weights (seeded, no downloads) and saves it
+in diffusers format. StableDiffusionModel and StableDiffusionModelOpenVINO
+then load it like any local model (OpenVINO exports it first), and every
+combination of the matrix is measured:
+
+    size      square resolution of the generated image
+    steps     denoising steps
+    batch     requests submitted together; above 1 they run through the
+              pipelined stages (PIPELINED_STAGES), which is how the
+              wrappers overlap concurrent requests
+    threads   CPU threads of the wrapper (cpu_threads; 0 = backend default)
+
+For each cell the results file gets the median request latency, steps/sec,
+images/sec and the peak RSS while the cell ran. With a baseline, cells whose
+latency grew (or steps/sec fell) by more than --threshold, and cells that ran
+in the baseline but failed or did not run now, are reported as regressions
+and the script exits with status 1:
+
+    python benchmarks/model_matrix.py --update-baseline
+    python benchmarks/model_matrix.py                       # compare with it
+    python benchmarks/model_matrix.py --backend pytorch --size 64,128 --steps 4 --threads 1,4
+
+The weights are random, so images are noise; the numbers track the cost of
+the backend code paths, not image quality. Baselines are only comparable on
+the same machine. Needs the PyTorch (and for OpenVINO, optimum-intel)
+dependencies; runs CPU-only.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+
+from config import Config  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baselines', 'model_matrix.json')
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, 'results', 'model_matrix.json')
+
+# Same shapes as the diffusers test suite's tiny pipeline, with a four-level
+# VAE so latents are 1/8 of the image like real checkpoints
+TINY_UNET = dict(
+    block_out_channels=(32, 64),
+    layers_per_block=2,
+    sample_size=32,
+    in_channels=4,
+    out_channels=4,
+    down_block_types=('DownBlock2D', 'CrossAttnDownBlock2D'),
+    up_block_types=('CrossAttnUpBlock2D', 'UpBlock2D'),
+    cross_attention_dim=32
+)
+TINY_VAE = dict(
+    block_out_channels=(32, 32, 64, 64),
+    in_channels=3,
+    out_channels=3,
+    down_block_types=('DownEncoderBlock2D',) * 4,
+    up_block_types=('UpDecoderBlock2D',) * 4,
+    latent_channels=4,
+    sample_size=64
+)
+TINY_CLIP = dict(
+    bos_token_id=0,
+    eos_token_id=1,
+    pad_token_id=1,
+    hidden_size=32,
+    intermediate_size=37,
+    layer_norm_eps=1e-05,
+    num_attention_heads=4,
+    num_hidden_layers=5,
+    vocab_size=1000,
+    max_position_embeddings=77
+)
+
+
+def _bytes_to_unicode():
+    # Byte-to-character table of the CLIP BPE tokenizer
+    printable = (list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1))
+                 + list(range(ord('®'), ord('ÿ') + 1)))
+    chars = printable[:]
+    extra = 0
+    for byte in range(256):
+        if byte not in printable:
+            printable.append(byte)
+            chars.append(256 + extra)
+            extra += 1
+    return [chr(c) for c in chars]
+
+
+def build_tiny_tokenizer(directory):
+    """CLIP tokenizer with a character-level vocabulary (no merges), written locally"""
+    from transformers import CLIPTokenizer
+    vocab = {'<|startoftext|>': 0, '<|endoftext|>': 1}
+    for char in _bytes_to_unicode():
+        vocab.setdefault(char, len(vocab))
+        vocab.setdefault(char + '</w>', len(vocab))
+    os.makedirs(directory, exist_ok=True)
+    vocab_file = os.path.join(directory, 'vocab.json')
+    merges_file = os.path.join(directory, 'merges.txt')
+    with open(vocab_file, 'w') as f:
+        json.dump(vocab, f)
+    with open(merges_file, 'w') as f:
+        f.write('#version: 0.2\n')
+    return CLIPTokenizer(vocab_file, merges_file, model_max_length=TINY_CLIP['max_position_embeddings'])
+
+
+def build_tiny_pipeline(path, seed=0):
+    """Save a random-weight Stable Diffusion pipeline to ``path`` and return ``path``"""
+    import torch
+    from diffusers import (
+        AutoencoderKL, DPMSolverMultistepScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    )
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    if os.path.exists(os.path.join(path, 'model_index.json')):
+        return path
+    torch.manual_seed(seed)
+    pipe = StableDiffusionPipeline(
+        unet=UNet2DConditionModel(**TINY_UNET),
+        vae=AutoencoderKL(**TINY_VAE),
+        text_encoder=CLIPTextModel(CLIPTextConfig(**TINY_CLIP)),
+        tokenizer=build_tiny_tokenizer(path + '-tokenizer'),
+        scheduler=DPMSolverMultistepScheduler(),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False
+    )
+    pipe.save_pretrained(path)
+    return path
+
+
+class PeakRSS:
+    """Samples this process's RSS on a background thread and keeps the peak"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+        try:
+            import psutil
+            self._process = psutil.Process()
+        except ImportError:
+            self._process = None
+
+    def __enter__(self):
+        if self._process is not None:
+            self.peak_mb = self._sample()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        else:
+            # Without psutil only the process-lifetime peak is available
+            self.peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def _sample(self):
+        return self._process.memory_info().rss / 1024 / 1024
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, self._sample())
+
+
+def make_model(backend, model_path, threads, workdir, default_threads):
+    if backend == 'openvino':
+        from models import StableDiffusionModelOpenVINO
+        model = StableDiffusionModelOpenVINO('CPU', model_id=model_path)
+        # Keep the exported IR next to the tiny pipeline, not in ov_models/
+        model.ov_cache_dir = workdir
+    else:
+        import torch
+        from models import StableDiffusionModel
+        model = StableDiffusionModel('cpu', model_id=model_path)
+        # load_model() only sets the thread count when one is given
+        torch.set_num_threads(threads or default_threads)
+    model.allow_cpu_fallback = False
+    model.cpu_threads = threads or None
+    return model
+
+
+def run_cell(model, size, steps, batch, repeat, prompt):
+    """Time ``repeat`` rounds of ``batch`` simultaneous generations"""
+    Config.PIPELINED_STAGES = batch > 1
+    latencies = []
+    errors = []
+
+    def generate(seed):
+        start = time.perf_counter()
+        try:
+            model.generate_image(prompt, width=size, height=size, num_inference_steps=steps, seed=seed)
+        except Exception as e:
+            errors.append(e)
+            return
+        latencies.append(time.perf_counter() - start)
+
+    # Warmup round: first calls at a new shape build kernels / caches
+    generate(0)
+    latencies.clear()
+
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        for round_index in range(repeat):
+            threads = [
+                threading.Thread(target=generate, args=(round_index * batch + i + 1,))
+                for i in range(batch)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        wall = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+
+    images = repeat * batch
+    return {
+        'latency': round(statistics.median(latencies), 4),
+        'latency_min': round(min(latencies), 4),
+        'steps_per_sec': round(images * steps / wall, 3),
+        'images_per_sec': round(images / wall, 4),
+        'peak_rss_mb': round(rss.peak_mb, 1) if rss.peak_mb is not None else None
+    }
+
+
+def cell_key(result):
+    return f"{result['backend']}/{result['size']}px/{result['steps']}steps/b{result['batch']}/t{result['threads']}"
+
+
+def compare(results, baseline, threshold):
+    """Annotate results with their change against ``baseline``; returns the regressions
+
+    A cell the baseline ran successfully counts as a regression when it
+    errored in this run, or is missing because its backend failed to load;
+    missing cells are added to ``results`` with ``missing`` set.
+    """
+    previous = {cell_key(result): result for result in baseline.get('results', []) if 'error' not in result}
+    regressions = []
+    seen = set()
+    for result in results:
+        if 'size' not in result:
+            # The backend failed to load; its cells are reported as missing below
+            continue
+        key = cell_key(result)
+        seen.add(key)
+        before = previous.get(key)
+        if before is None:
+            continue
+        if 'error' in result:
+            result['regression'] = True
+            regressions.append(result)
+            continue
+        latency_change = result['latency'] / before['latency'] - 1
+        throughput_change = result['steps_per_sec'] / before['steps_per_sec'] - 1
+        result['baseline_latency'] = before['latency']
+        result['latency_change'] = round(latency_change, 4)
+        result['steps_per_sec_change'] = round(throughput_change, 4)
+        result['regression'] = latency_change > threshold or throughput_change < -threshold
+        if result['regression']:
+            regressions.append(result)
+    for key, before in previous.items():
+        if key in seen:
+            continue
+        missing = {field: before[field] for field in ('backend', 'threads', 'size', 'steps', 'batch')}
+        missing.update(error='not run', missing=True, regression=True)
+        results.append(missing)
+        regressions.append(missing)
+    return regressions
+
+
+def environment():
+    import torch
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads()
+    }
+    try:
+        import openvino
+        info['openvino'] = openvino.__version__
+    except ImportError:
+        pass
+    return info
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', action='append', choices=['pytorch', 'openvino'],
+                        help='Backend to run (repeatable, default both)')
+    parser.add_argument('--size', type=parse_ints, default=[64, 128], help='Comma-separated resolutions')
+    parser.add_argument('--steps', type=parse_ints, default=[4, 8], help='Comma-separated step counts')
+    parser.add_argument('--batch', type=parse_ints, default=[1, 2], help='Comma-separated batch sizes')
+    parser.add_argument('--threads', type=parse_ints, default=[0], help='Comma-separated thread counts')
+    parser.add_argument('--repeat', type=int, default=3, help='Measured rounds per cell')
+    parser.add_argument('--prompt', default='a lighthouse on a cliff at sunset')
+    parser.add_argument('--workdir', help='Where the tiny pipeline is built (default: a temporary directory)')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='Results file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='Relative slowdown counted as a regression (0.15 = 15%%)')
+    parser.add_argument('--update-baseline', action='store_true', help='Store these results as the baseline')
+    args = parser.parse_args()
+
+    Config.SAFETY_CHECKER_ENABLED = False
+    Config.CPU_PERF_MODE = False
+    Config.OV_INFER_SLOTS = 1
+    # Measure compiles the same way on every run
+    Config.OV_COMPILE_CACHE = False
+    workdir = args.workdir or tempfile.mkdtemp(prefix='tiny-sd-')
+    model_path = build_tiny_pipeline(os.path.join(os.path.abspath(workdir), 'tiny-sd'))
+    print(f"Tiny pipeline in {model_path}")
+    import torch
+    default_threads = torch.get_num_threads()
+
+    results = []
+    for backend in args.backend or ['pytorch', 'openvino']:
+        for threads in args.threads:
+            cell = {'backend': backend, 'threads': threads}
+            try:
+                model = make_model(backend, model_path, threads, workdir, default_threads)
+                load_start = time.time()
+                model.load_model()
+                load_time = round(time.time() - load_start, 3)
+            except Exception as e:
+                print(f"{backend} with {threads} threads failed to load: {e}")
+                results.append(dict(cell, error=str(e)))
+                continue
+
+            for size in args.size:
+                for steps in args.steps:
+                    for batch in args.batch:
+                        result = dict(cell, size=size, steps=steps, batch=batch, load_time=load_time)
+                        try:
+                            result.update(run_cell(model, size, steps, batch, args.repeat, args.prompt))
+                        except Exception as e:
+                            result['error'] = str(e)
+                            print(f"  {cell_key(result)} failed: {e}")
+                        else:
+                            print(f"  {cell_key(result)}: {result['latency']}s, "
+                                  f"{result['steps_per_sec']} steps/s, peak RSS {result['peak_rss_mb']} MB")
+                        results.append(result)
+            model.unload_model()
+
+    regressions = []
+    if not args.update_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    print()
+    print(f"{'cell':<36} {'latency s':>10} {'steps/s':>9} {'RSS MB':>8} {'vs base':>8}")
+    for result in results:
+        if 'error' in result:
+            if result.get('regression'):
+                status = 'missing' if result.get('missing') else 'failed'
+                print(f"{cell_key(result):<36} {status:>10} {'-':>9} {'-':>8} {'-':>8}  REGRESSION")
+            continue
+        change = result.get('latency_change')
+        marker = '  REGRESSION' if result.get('regression') else ''
+        print(f"{cell_key(result):<36} {result['latency']:>10} {result['steps_per_sec']:>9} "
+              f"{str(result['peak_rss_mb']):>8} {(f'{change:+.1%}' if change is not None else '-'):>8}{marker}")
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'threshold': args.threshold,
+        'results': results
+    }
+    for path in [args.output] + ([args.baseline] if args.update_baseline else []):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {path}")
+
+    if regressions:
+        print(f"\n{len(regressions)} cell(s) regressed by more than {args.threshold:.0%} against {args.baseline}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
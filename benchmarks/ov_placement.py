@@ -0,0 +1,158 @@
+# Copyright 2025 by trongton@gmail.com
+
+"""
+OpenVINO submodel placement benchmark
+
+Loads the OpenVINO pipeline once per placement, runs a few generations and
+reports compile time, mean latency, time spent in each submodel, host RSS and
+peak GPU memory, so placements such as "everything on GPU" and "UNet on GPU,
+text encoder and VAE on CPU" can be compared on the same machine.
+
+Placements use the OV_SUBMODEL_DEVICES syntax; "all=<DEVICE>" puts every part
+on one device:
+
+    python benchmarks/ov_placement.py \\
+        --placement all=GPU \\
+        --placement unet=GPU,text_encoder=CPU,vae_decoder=CPU,vae_encoder=CPU \\
+        --placement all=CPU --runs 3 --steps 20
+
+Needs the OpenVINO backend dependencies and the ov_models cache (or network
+access for the first export).
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+
+from config import Config  # noqa: E402
+from models import StableDiffusionModelOpenVINO  # noqa: E402
+from models.memory_watchdog import get_host_memory_info  # noqa: E402
+
+
+class TimedRequest:
+    """Wraps a compiled model and accumulates the time spent in its calls"""
+
+    def __init__(self, request, totals, name):
+        self._request = request
+        self._totals = totals
+        self._name = name
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._request(*args, **kwargs)
+        finally:
+            self._totals[self._name] += time.perf_counter() - start
+
+    def __getattr__(self, attr):
+        return getattr(self._request, attr)
+
+
+def parse_placement(spec):
+    parts = dict(item.split('=', 1) for item in spec.replace(' ', '').split(',') if '=' in item)
+    if 'all' in parts:
+        device = parts.pop('all')
+        parts = dict({name: device for name in StableDiffusionModelOpenVINO.SUBMODELS}, **parts)
+    return parts
+
+
+def bench(spec, args):
+    placement = parse_placement(spec)
+    # The wrapper runs on the UNet's device; other parts follow the placement
+    device = placement.get('unet', 'CPU')
+    Config.OV_SUBMODEL_DEVICES = placement
+
+    model = StableDiffusionModelOpenVINO(device, model_id=args.model_id)
+    model.allow_cpu_fallback = False
+    load_start = time.time()
+    model.load_model()
+    load_time = time.time() - load_start
+
+    totals = defaultdict(float)
+    for name in StableDiffusionModelOpenVINO.SUBMODELS:
+        part = getattr(model.pipe, name, None)
+        if part is not None and part.request is not None:
+            part.request = TimedRequest(part.request, totals, name)
+
+    # One untimed run so first-inference allocations are not measured
+    model.generate_image(args.prompt, width=args.size, height=args.size,
+                         num_inference_steps=args.steps, seed=0)
+    totals.clear()
+
+    latencies = []
+    peak_device_mb = None
+    for run in range(args.runs):
+        start = time.perf_counter()
+        model.generate_image(args.prompt, width=args.size, height=args.size,
+                             num_inference_steps=args.steps, seed=run + 1)
+        latencies.append(time.perf_counter() - start)
+        device_memory = model._get_device_memory_info()
+        if device_memory and device_memory.get('used_mb') is not None:
+            peak_device_mb = max(peak_device_mb or 0, device_memory['used_mb'])
+
+    result = {
+        'placement': spec,
+        'resolved': model.placement,
+        'load_time': round(load_time, 2),
+        'mean_latency': round(sum(latencies) / len(latencies), 3),
+        'min_latency': round(min(latencies), 3),
+        'per_part': {name: round(total / args.runs, 3) for name, total in totals.items()},
+        'rss_mb': get_host_memory_info()['rss_mb'],
+        'peak_device_mb': peak_device_mb
+    }
+    model.unload_model()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--placement', action='append', help='Placement to compare (repeatable)')
+    parser.add_argument('--model-id', default=Config.MODEL_ID)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--prompt', default='a lighthouse on a cliff at sunset')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    placements = args.placement or [
+        'all=GPU',
+        'unet=GPU,text_encoder=CPU,vae_decoder=CPU,vae_encoder=CPU',
+        'all=CPU'
+    ]
+
+    results = []
+    for spec in placements:
+        print(f"Benchmarking placement {spec}...")
+        try:
+            result = bench(spec, args)
+        except Exception as e:
+            print(f"  failed: {e}")
+            results.append({'placement': spec, 'error': str(e)})
+            continue
+        results.append(result)
+        print(f"  load {result['load_time']}s, mean latency {result['mean_latency']}s, "
+              f"rss {result['rss_mb']} MB, peak GPU {result['peak_device_mb']} MB")
+        print(f"  per part: {result['per_part']}")
+
+    print()
+    print(f"{'placement':<60} {'latency s':>10} {'load s':>8} {'GPU MB':>8}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['placement']:<60} {'failed':>10}")
+            continue
+        print(f"{result['placement']:<60} {result['mean_latency']:>10} "
+              f"{result['load_time']:>8} {str(result['peak_device_mb']):>8}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+# Copyright 2025 by trongton@gmail.com
+
+"""
+Pre-fork serving benchmark: memory per worker and aggregate throughput
+
+Starts ``gunicorn -c gunicorn.conf.py wsgi:app`` from backend/ with N workers
+on CPU, waits until every worker has compiled its pipeline, keeps
+``concurrency`` requests in flight for ``--duration`` seconds and reports:
+
+- RSS, PSS and USS per worker (PSS counts shared pages once, USS is what a
+  worker holds privately, RSS - USS is what it shares with the master)
+- total PSS of master + workers, i.e. the real memory cost of N workers
+- aggregate images/sec and mean latency
+
+Usage:
+    python benchmarks/prefork_workers.py --workers 1,2,4 --steps 4 --size 256
+
+Requires psutil and requests, plus the model weights (or the ov_models cache).
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+
+
+def wait_until_ready(base_url, workers, timeout):
+    """Wait until the model is loaded in every worker (health answered by random workers)"""
+    deadline = time.time() + timeout
+    consecutive = 0
+    while time.time() < deadline:
+        try:
+            health = requests.get(f"{base_url}/api/health", timeout=5).json()
+            consecutive = consecutive + 1 if health.get('model_loaded') else 0
+        except requests.RequestException:
+            consecutive = 0
+        if consecutive >= workers * 4:
+            return True
+        time.sleep(0.5)
+    return False
+
+
+def memory_breakdown(master_pid):
+    """RSS/PSS/USS in MB for the master and each worker"""
+    def sample(process):
+        info = process.memory_full_info()
+        return {
+            'pid': process.pid,
+            'rss_mb': round(info.rss / 1024 / 1024, 1),
+            'pss_mb': round(getattr(info, 'pss', 0) / 1024 / 1024, 1),
+            'uss_mb': round(info.uss / 1024 / 1024, 1)
+        }
+
+    master = psutil.Process(master_pid)
+    return sample(master), [sample(child) for child in master.children()]
+
+
+def run_load(base_url, payload, concurrency, duration):
+    """Closed loop: each thread sends the next request when its previous one returns"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def worker():
+        while time.time() < stop_at:
+            start = time.perf_counter()
+            try:
+                response = requests.post(f"{base_url}/api/generate", json=payload, timeout=3600)
+                ok = response.status_code == 200 and response.json().get('success')
+            except requests.RequestException:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    return latencies, errors[0], elapsed
+
+
+def bench(workers, args):
+    port = args.port
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(
+        os.environ,
+        WEB_WORKERS=str(workers),
+        PORT=str(port),
+        HOST='127.0.0.1',
+        DEVICE=args.device,
+        PRELOAD_MODEL='True',
+        DEBUG='False'
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL if not args.verbose else None,
+        stderr=subprocess.DEVNULL if not args.verbose else None
+    )
+    try:
+        if not wait_until_ready(base_url, workers, args.startup_timeout):
+            raise RuntimeError(f"Server with {workers} workers did not become ready")
+
+        payload = {
+            'prompt': args.prompt,
+            'width': args.size,
+            'height': args.size,
+            'num_inference_steps': args.steps,
+            'seed': 42
+        }
+        concurrency = args.concurrency or workers
+        # One round of requests first so lazy allocations are not measured
+        warmup = [
+            threading.Thread(target=requests.post, args=(f"{base_url}/api/generate",),
+                             kwargs={'json': payload, 'timeout': 3600})
+            for _ in range(concurrency)
+        ]
+        for thread in warmup:
+            thread.start()
+        for thread in warmup:
+            thread.join()
+
+        latencies, errors, elapsed = run_load(base_url, payload, concurrency, args.duration)
+        master, children = memory_breakdown(server.pid)
+        return {
+            'workers': workers,
+            'concurrency': concurrency,
+            'images': len(latencies),
+            'errors': errors,
+            'images_per_sec': round(len(latencies) / elapsed, 3),
+            'mean_latency': round(sum(latencies) / len(latencies), 2) if latencies else None,
+            'master': master,
+            'workers_memory': children,
+            'total_pss_mb': round(master['pss_mb'] + sum(c['pss_mb'] for c in children), 1),
+            'total_rss_mb': round(master['rss_mb'] + sum(c['rss_mb'] for c in children), 1)
+        }
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,2,4', help='Comma separated worker counts')
+    parser.add_argument('--concurrency', type=int, default=0, help='Requests in flight (default: one per worker)')
+    parser.add_argument('--duration', type=float, default=120, help='Seconds of load per worker count')
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--prompt', default='a lighthouse on a cliff at sunset')
+    parser.add_argument('--device', default='CPU')
+    parser.add_argument('--port', type=int, default=5057)
+    parser.add_argument('--startup-timeout', type=float, default=1800)
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='Show server output')
+    args = parser.parse_args()
+
+    if psutil is None:
+        sys.exit("psutil is required: pip install psutil")
+
+    results = []
+    for workers in [int(w) for w in args.workers.split(',')]:
+        print(f"Benchmarking {workers} worker(s)...")
+        result = bench(workers, args)
+        results.append(result)
+
+        print(f"  throughput: {result['images_per_sec']} images/sec "
+              f"({result['images']} images, {result['errors']} errors, "
+              f"mean latency {result['mean_latency']}s)")
+        print(f"  master: rss {result['master']['rss_mb']} MB, pss {result['master']['pss_mb']} MB")
+        for child in result['workers_memory']:
+            print(f"  worker {child['pid']}: rss {child['rss_mb']} MB, pss {child['pss_mb']} MB, "
+                  f"uss {child['uss_mb']} MB, shared {round(child['rss_mb'] - child['uss_mb'], 1)} MB")
+        print(f"  total: pss {result['total_pss_mb']} MB (rss sum {result['total_rss_mb']} MB)")
+
+    print()
+    print(f"{'workers':>8} {'img/s':>8} {'pss MB':>10} {'rss sum MB':>12}")
+    for result in results:
+        print(f"{result['workers']:>8} {result['images_per_sec']:>8} "
+              f"{result['total_pss_mb']:>10} {result['total_rss_mb']:>12}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
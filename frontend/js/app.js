@@ -14,6 +14,8 @@ const stepsValue = document.getElementById('steps-value');
 const guidanceInput = document.getElementById('guidance');
 const guidanceValue = document.getElementById('guidance-value');
 const seedInput = document.getElementById('seed');
+const modelGroup = document.getElementById('model-group');
+const modelSelect = document.getElementById('model-id');
 const nsfwCheckbox = document.getElementById('nsfw-enabled');
 const deviceGpuRadio = document.getElementById('device-gpu');
 const deviceCpuRadio = document.getElementById('device-cpu');
@@ -30,13 +32,20 @@ const newGenerationBtn = document.getElementById('new-generation-btn');
 const stopBtn = document.getElementById('stop-btn');
 const btnSpinner = document.getElementById('btn-spinner');
 const btnText = document.getElementById('btn-text');
+const historyGrid = document.getElementById('history-grid');
+const historySearch = document.getElementById('history-search');
+const historyMoreBtn = document.getElementById('history-more-btn');
+const historyEmpty = document.getElementById('history-empty');
 
 // State
 let isGenerating = false;
 let lastGeneratedImageData = null;
 let lastParameters = null;
 let progressEventSource = null;
+let progressLastEventId = null;
 let currentSessionId = null;
+let historyCursor = null;
+let historySearchTimer = null;
 
 // Initialize
 document.addEventListener('DOMContentLoaded', () => {
@@ -44,6 +53,8 @@ document.addEventListener('DOMContentLoaded', () => {
     setupEventListeners();
     checkAPIHealth();
     loadCurrentDevice();
+    loadModels();
+    loadHistory(true);
 });
 
 // Setup Event Listeners
@@ -99,6 +110,13 @@ function setupEventListeners() {
     
     // Stop button
     stopBtn.addEventListener('click', handleStop);
+    
+    // History gallery
+    historyMoreBtn.addEventListener('click', () => loadHistory(false));
+    historySearch.addEventListener('input', () => {
+        clearTimeout(historySearchTimer);
+        historySearchTimer = setTimeout(() => loadHistory(true), 300);
+    });
 }
 
 // Check API Health
@@ -153,6 +171,10 @@ async function handleGenerate() {
         seed: seedInput.value ? parseInt(seedInput.value) : null
     };
     
+    if (modelSelect.value) {
+        params.model_id = modelSelect.value;
+    }
+    
     // Start generation
     isGenerating = true;
     generateBtn.disabled = true;
@@ -208,6 +230,7 @@ async function handleGenerate() {
             lastParameters = data.parameters;
             const timeMsg = data.generation_time ? ` in ${data.generation_time}s` : '';
             showStatus(`✅ Image generated successfully${timeMsg}!`, 'success');
+            loadHistory(true);
         } else {
             throw new Error(data.error || 'Generation failed');
         }
@@ -285,14 +308,23 @@ function generateTempSessionId() {
 }
 
 // Connect to SSE progress stream
-function connectProgressStream(sessionId, totalSteps) {
+// Events carry ids; the browser resends the last one (Last-Event-ID) when it
+// reconnects on its own, and a manual reopen passes it as a query parameter,
+// so the server replays whatever was missed.
+function connectProgressStream(sessionId, totalSteps, resumeAfter = null) {
     // Close existing connection if any
     if (progressEventSource) {
         progressEventSource.close();
     }
+    if (resumeAfter === null) {
+        progressLastEventId = null;
+    }
     
     console.log('Connecting to progress stream:', sessionId);
-    const url = `${API_BASE_URL}/api/progress/${sessionId}`;
+    let url = `${API_BASE_URL}/api/progress/${sessionId}`;
+    if (resumeAfter !== null) {
+        url += `?last_event_id=${encodeURIComponent(resumeAfter)}`;
+    }
     progressEventSource = new EventSource(url);
     
     progressEventSource.onopen = () => {
@@ -301,6 +333,9 @@ function connectProgressStream(sessionId, totalSteps) {
     
     progressEventSource.onmessage = (event) => {
         console.log('Progress event received:', event.data);
+        if (event.lastEventId) {
+            progressLastEventId = event.lastEventId;
+        }
         try {
             const data = JSON.parse(event.data);
             console.log('Parsed progress data:', data);
@@ -323,10 +358,24 @@ function connectProgressStream(sessionId, totalSteps) {
     };
     
     progressEventSource.onerror = (error) => {
-        console.error('Progress stream error:', error);
-        console.log('EventSource readyState:', progressEventSource.readyState);
-        progressEventSource.close();
+        const source = progressEventSource;
+        if (!source) {
+            return;
+        }
+        console.warn('Progress stream error, readyState:', source.readyState, error);
+        if (source.readyState !== EventSource.CLOSED) {
+            // CONNECTING: the browser reconnects by itself and resumes from the last event id
+            return;
+        }
+        // The browser gave up (e.g. an HTTP error); reopen while the generation is running
         progressEventSource = null;
+        if (isGenerating && currentSessionId === sessionId) {
+            setTimeout(() => {
+                if (isGenerating && currentSessionId === sessionId && !progressEventSource) {
+                    connectProgressStream(sessionId, totalSteps, progressLastEventId || 0);
+                }
+            }, 2000);
+        }
     };
 }
 
@@ -393,7 +442,9 @@ function handleDownload() {
     // Create download link
     const link = document.createElement('a');
     link.href = lastGeneratedImageData;
-    link.download = `stable-diffusion-${Date.now()}.png`;
+    const mimeMatch = lastGeneratedImageData.match(/^data:image\/(\w+)/);
+    const extension = mimeMatch ? mimeMatch[1].replace('jpeg', 'jpg') : 'png';
+    link.download = `stable-diffusion-${Date.now()}.${extension}`;
     document.body.appendChild(link);
     link.click();
     document.body.removeChild(link);
@@ -492,9 +543,17 @@ async function switchDevice(newDevice) {
         const data = await response.json();
         
         if (data.success) {
-            deviceStatus.textContent = `Current: ${data.device} (${data.backend})`;
-            deviceStatus.className = 'device-status success';
-            showStatus(`✅ Switched to ${data.device}. Model will reload on next generation.`, 'success');
+            if (data.switch && data.switch.status === 'switching') {
+                // The current device keeps serving while the target loads
+                deviceStatus.textContent = `Current: ${data.current_device}, loading ${data.device}... (${data.backend})`;
+                deviceStatus.className = 'device-status info';
+                showStatus(`⏳ ${data.message}`, 'info');
+                pollDeviceSwitch();
+            } else {
+                deviceStatus.textContent = `Current: ${data.current_device} (${data.backend})`;
+                deviceStatus.className = 'device-status success';
+                showStatus(`✅ ${data.message}`, 'success');
+            }
         } else {
             throw new Error(data.error || 'Failed to switch device');
         }
@@ -510,6 +569,106 @@ async function switchDevice(newDevice) {
     }
 }
 
+// Load served models into the model selector
+async function loadModels() {
+    try {
+        const response = await fetch(`${API_BASE_URL}/api/models`);
+        const data = await response.json();
+        
+        modelSelect.innerHTML = '';
+        data.models.forEach(model => {
+            const option = document.createElement('option');
+            option.value = model.model_id;
+            option.textContent = model.model_id;
+            option.selected = model.default;
+            modelSelect.appendChild(option);
+        });
+        
+        // Only worth showing when there is a choice
+        modelGroup.style.display = data.models.length > 1 ? 'block' : 'none';
+    } catch (error) {
+        console.error('Error loading models:', error);
+        modelGroup.style.display = 'none';
+    }
+}
+
+// Load a page of past generations (thumbnails only)
+async function loadHistory(reset) {
+    if (reset) {
+        historyCursor = null;
+    }
+    
+    const query = new URLSearchParams();
+    if (historyCursor) {
+        query.set('cursor', historyCursor);
+    }
+    const search = historySearch.value.trim();
+    if (search) {
+        query.set('prompt', search);
+    }
+    
+    try {
+        const response = await fetch(`${API_BASE_URL}/api/history?${query.toString()}`);
+        const data = await response.json();
+        
+        if (reset) {
+            historyGrid.innerHTML = '';
+        }
+        
+        data.items.forEach(item => {
+            const thumb = document.createElement('img');
+            thumb.src = `${API_BASE_URL}${item.thumbnail_url}`;
+            thumb.alt = item.prompt;
+            thumb.title = item.prompt;
+            thumb.loading = 'lazy';
+            thumb.className = 'history-thumb';
+            thumb.addEventListener('click', () => showHistoryImage(item));
+            historyGrid.appendChild(thumb);
+        });
+        
+        historyCursor = data.next_cursor;
+        historyMoreBtn.style.display = historyCursor ? 'block' : 'none';
+        historyEmpty.style.display = historyGrid.children.length === 0 ? 'block' : 'none';
+    } catch (error) {
+        console.error('Error loading history:', error);
+    }
+}
+
+// Show a past generation; the full-size image is fetched only now
+function showHistoryImage(item) {
+    const imageUrl = `${API_BASE_URL}${item.image_url}`;
+    const placeholder = imageContainer.querySelector('.placeholder');
+    if (placeholder) {
+        placeholder.style.display = 'none';
+    }
+    displayGeneratedImage(imageUrl, item, item.generation_time);
+    lastGeneratedImageData = imageUrl;
+    lastParameters = item;
+}
+
+// Poll device status until a background switch finishes
+async function pollDeviceSwitch() {
+    try {
+        const response = await fetch(`${API_BASE_URL}/api/device`);
+        const data = await response.json();
+        
+        if (data.switch && data.switch.status === 'switching') {
+            setTimeout(pollDeviceSwitch, 1000);
+            return;
+        }
+        
+        if (data.switch && data.switch.status === 'failed') {
+            showStatus(`Error: ${data.switch.error}`, 'error');
+        } else {
+            showStatus(`✅ Now running on ${data.current_device}`, 'success');
+        }
+        loadCurrentDevice();
+    } catch (error) {
+        console.error('Error polling device switch:', error);
+        loadCurrentDevice();
+    }
+}
+
 // Add example prompt functionality (optional)
 function loadRandomExample() {
     const randomPrompt = examplePrompts[Math.floor(Math.random() * examplePrompts.length)];